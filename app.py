@@ -1,10 +1,19 @@
-from flask import Flask, render_template, request, send_file, flash, redirect, url_for
+from flask import Flask, render_template, request, send_file, flash, redirect, url_for, Response, jsonify
+from conversion_metrics import render_metrics
 import os
 import shutil
+import tempfile
 import logging
 from logging.handlers import RotatingFileHandler
-from xlsx_to_corrected_edgar_xml import create_perfect_edgar_xml as convert_xlsx_to_xml_13f
-from finra_6151_converter import perform_6151_conversion
+from conversion_scheduler import SchedulerBusy, shared_scheduler
+from conversion_progress import PROGRESS_CLIENT_POLL_MS, valid_progress_id, current_progress
+from chunked_uploads import UploadError, shared_upload_store
+from web_conversion import (UPLOAD_FOLDER, MAX_CONTENT_LENGTH, STREAMING_THRESHOLD_BYTES, UPLOAD_RETENTION_SECONDS,
+                            WEB_RECORD_FILINGS, ConversionRequestError,
+                            allowed_extensions, cleanup_uploads, new_request_folder, request_file_path,
+                            submit_conversion, conversion_result_page, download_variant, file_etag)
+from batch_conversion import (BATCH_MAX_WORKERS, BATCH_INPUT_EXTENSIONS, extract_archive, unique_input_path,
+                              parse_manifest, build_jobs, iter_batch_zip)
 from werkzeug.utils import secure_filename
 
 app = Flask(__name__)
@@ -23,8 +32,9 @@ if not app.debug:
     app.logger.info('Application startup')
 # --- End Logging Configuration ---
 
-app.config['UPLOAD_FOLDER'] = 'uploads'
-app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB limit
+app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+app.config['MAX_CONTENT_LENGTH'] = MAX_CONTENT_LENGTH
+app.config['STREAMING_THRESHOLD_BYTES'] = STREAMING_THRESHOLD_BYTES
 
 # Load secret key from environment variable or use a default for development
 app.secret_key = os.environ.get('FLASK_SECRET_KEY', 'dev_secret_key_۱۲۳')
@@ -32,11 +42,10 @@ app.secret_key = os.environ.get('FLASK_SECRET_KEY', 'dev_secret_key_۱۲۳')
 # Ensure upload directory exists
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
-def cleanup_uploads():
-    """Remove all files from uploads directory"""
-    if os.path.exists(app.config['UPLOAD_FOLDER']):
-        shutil.rmtree(app.config['UPLOAD_FOLDER'])
-    os.makedirs(app.config['UPLOAD_FOLDER'])
+@app.context_processor
+def progress_settings():
+    # index.html polls /progress/<id> this often (no progress_stream: this server does not stream events)
+    return {'progress_poll_ms': PROGRESS_CLIENT_POLL_MS}
 
 @app.route('/')
 def index():
@@ -45,12 +54,18 @@ def index():
 @app.route('/convert', methods=['POST'])
 def convert():
     try:
-        if 'file' not in request.files:
+        # A file sent beforehand through /uploads is named by its upload id instead of being posted again
+        stored_upload = shared_upload_store().stored_upload(request.form.get('upload_id'), request.form.get('upload_filename'))
+        if request.form.get('upload_id') and stored_upload is None:
+            flash('The uploaded file is no longer available. Please upload it again.', 'error')
+            app.logger.warning(f"Conversion of unknown stored upload '{request.form.get('upload_id')}'.")
+            return redirect(url_for('index'))
+        if stored_upload is None and 'file' not in request.files:
             flash('No file uploaded', 'error')
             app.logger.warning('File upload attempt with no file part.')
             return redirect(url_for('index'))
             
-        file = request.files['file']
+        file = stored_upload or request.files['file']
         if file.filename == '':
             flash('No file selected', 'error')
             app.logger.warning('File upload attempt with no file selected.')
@@ -62,81 +77,49 @@ def convert():
             app.logger.warning('Conversion attempt with no conversion type specified.')
             return redirect(url_for('index'))
             
-        if file and file.filename.endswith('.xlsx'):
-            # Cleanup previous uploads
-            cleanup_uploads()
+        allowed = allowed_extensions(conversion_type)
+        if file and file.filename.lower().endswith(allowed):
+            # Other threads may still be converting or sending their files, so only old uploads are removed
+            cleanup_uploads(app.config['UPLOAD_FOLDER'], UPLOAD_RETENTION_SECONDS)
             
-            # Save uploaded file
+            # Save uploaded file in a folder of its own; the result is downloaded by the folder's random token
             original_filename_secure = secure_filename(file.filename)
-            filepath = os.path.join(app.config['UPLOAD_FOLDER'], original_filename_secure)
+            download_token, request_folder = new_request_folder(app.config['UPLOAD_FOLDER'])
+            filepath = os.path.join(request_folder, original_filename_secure)
             file.save(filepath)
             app.logger.info(f"File '{original_filename_secure}' uploaded successfully.")
             
-            output_xml_filename = None
-            xml_is_valid = None 
-            xml_validation_errors = [] 
-            
             try:
-                if conversion_type == '13F':
-                    output_xml_filename = original_filename_secure.lower().replace('.xlsx', '.xml')
-                    output_path = os.path.join(app.config['UPLOAD_FOLDER'], output_xml_filename)
-                    app.logger.info(f"Starting 13F conversion for '{original_filename_secure}' to '{output_xml_filename}'.")
-                    convert_xlsx_to_xml_13f(filepath, output_path)
-                    flash(f'Successfully converted (13F) {original_filename_secure} to {output_xml_filename}', 'success')
-                    app.logger.info(f"13F conversion successful for '{original_filename_secure}'. Output: {output_xml_filename}")
-                
-                elif conversion_type == '6151':
-                    firm_name = request.form.get('firm_name')
-                    year = request.form.get('year')
-                    qtr = request.form.get('qtr')
-
-                    if not all([firm_name, year, qtr]):
-                        flash('Firm Name, Year, and Quarter are required for 6151 conversion.', 'error')
-                        app.logger.warning(f"Missing parameters for 6151 conversion of '{original_filename_secure}'. Firm: {firm_name}, Year: {year}, Qtr: {qtr}")
-                        return redirect(url_for('index'))
-                    
-                    app.logger.info(f"Starting 6151 conversion for '{original_filename_secure}'. Firm: {firm_name}, Year: {year}, Qtr: {qtr}")
-                    generated_xml_full_path, xml_is_valid, xml_validation_errors = perform_6151_conversion(
-                        excel_filepath=filepath, 
-                        output_dir=app.config['UPLOAD_FOLDER'], 
-                        firm_name=firm_name, 
-                        year=year, 
-                        qtr=qtr
-                    )
-
-                    if generated_xml_full_path:
-                        output_xml_filename = os.path.basename(generated_xml_full_path)
-                        app.logger.info(f"6151 conversion for '{original_filename_secure}' produced '{output_xml_filename}'. Validation status: {'VALID' if xml_is_valid else 'INVALID'}")
-                        if xml_is_valid:
-                            flash(f'Successfully converted (6151) {original_filename_secure} to {output_xml_filename}. XML is valid.', 'success')
-                        else:
-                            error_summary = "; ".join(xml_validation_errors[:3]) 
-                            flash(f'Converted (6151) {original_filename_secure} to {output_xml_filename}, but XML validation failed: {error_summary}', 'warning')
-                            app.logger.warning(f"XML validation failed for '{output_xml_filename}'. Errors: {xml_validation_errors}")
-                    else:
-                        error_summary = "; ".join(xml_validation_errors[:3]) if xml_validation_errors else "Unknown error during XML creation."
-                        flash(f'Failed to convert (6151) {original_filename_secure}: {error_summary}', 'error')
-                        app.logger.error(f"6151 XML creation failed for '{original_filename_secure}'. Errors: {xml_validation_errors}")
-                        return redirect(url_for('index')) 
-                
-                else:
-                    flash('Invalid conversion type selected.', 'error')
-                    app.logger.error(f"Invalid conversion type '{conversion_type}' selected for file '{original_filename_secure}'.")
+                task, output_xml_filename, profiled = submit_conversion(conversion_type, filepath, request.form, app.logger,
+                                                                        request_folder, app.config['STREAMING_THRESHOLD_BYTES'],
+                                                                        admin_token=request.headers.get('X-Admin-Token'),
+                                                                        input_sha256=stored_upload.sha256 if stored_upload else None)
+                messages, page = conversion_result_page(conversion_type, original_filename_secure, output_xml_filename,
+                                                        task.result(), app.logger, profiled, request_folder, download_token)
+                for category, message in messages:
+                    flash(message, category)
+                if page is None:
                     return redirect(url_for('index'))
+                return render_template('index.html', **page)
+
+            except ConversionRequestError as e:
+                flash(str(e), 'error')
+                return redirect(url_for('index'))
+
+            except SchedulerBusy as e:
+                # Too much work queued (or too little memory): ask the client to come back later
+                flash(str(e), 'warning')
+                app.logger.warning(f"Conversion of '{original_filename_secure}' rejected by the scheduler: {e}")
+                response = app.make_response((render_template('index.html'), 503))
+                response.headers['Retry-After'] = str(e.retry_after)
+                return response
 
-                return render_template('index.html', 
-                                     converted_file=output_xml_filename,
-                                     original_filename=original_filename_secure,
-                                     conversion_type_processed=conversion_type,
-                                     xml_is_valid=xml_is_valid, 
-                                     xml_validation_errors=xml_validation_errors) 
-            
             except Exception as e:
                 flash(f'Conversion error for {conversion_type}: {str(e)}', 'error')
                 app.logger.error(f"Conversion error for {conversion_type} on file {original_filename_secure}: {str(e)}", exc_info=True)
                 return redirect(url_for('index'))
                 
-        flash('Invalid file type. Please upload a .xlsx file.', 'error')
+        flash(f"Invalid file type. Please upload a {', '.join(allowed)} file.", 'error')
         app.logger.warning(f"Invalid file type uploaded: '{file.filename if file else 'N/A'}'.")
         return redirect(url_for('index'))
         
@@ -145,16 +128,141 @@ def convert():
         app.logger.error(f"An unexpected error occurred in /convert route: {str(e)}", exc_info=True)
         return redirect(url_for('index'))
 
-@app.route('/download/<filename>')
-def download_file(filename):
+# --- Resumable chunked uploads (chunked_uploads.py) ---
+@app.errorhandler(UploadError)
+def upload_error(e):
+    return jsonify(e.as_dict()), e.status
+
+@app.route('/uploads', methods=['POST'])
+def initiate_upload():
+    """Starts an upload: JSON {"filename", "size"[, "sha256"]}; the status carries the upload id to continue with."""
+    data = request.get_json(silent=True) or {}
+    return jsonify(shared_upload_store().initiate(data.get('filename'), data.get('size'), data.get('sha256')))
+
+@app.route('/uploads/<upload_id>', methods=['GET', 'PUT'])
+def upload_chunk(upload_id):
+    """GET: how much of the upload has arrived. PUT: the next chunk, at the Upload-Offset header's byte."""
+    if request.method == 'GET':
+        return jsonify(shared_upload_store().status(upload_id))
+    return jsonify(shared_upload_store().append(upload_id, request.headers.get('Upload-Offset'), request.get_data(cache=False)))
+
+@app.route('/uploads/<upload_id>/finalize', methods=['POST'])
+def finalize_upload(upload_id):
+    """Hashes the received file (checked against JSON {"sha256"} when given) and stores it for /convert (upload_id field)."""
+    data = request.get_json(silent=True) or {}
+    status = shared_upload_store().finalize(upload_id, data.get('sha256'))
+    app.logger.info(f"Chunked upload '{status['filename']}' finalized ({status['size']} bytes).")
+    return jsonify(status)
+
+@app.route('/convert-batch', methods=['POST'])
+def convert_batch():
+    """Converts several uploaded files (and/or .zip archives of them) in one request.
+    Responds with a zip of the generated XML files plus report.json, streamed while the conversions run."""
+    work_dir = tempfile.mkdtemp(prefix='batch_')
+    try:
+        uploads = [f for f in request.files.getlist('files') if f and f.filename]
+        if not uploads:
+            flash('No files selected for batch conversion', 'error')
+            app.logger.warning('Batch conversion attempt with no files.')
+            shutil.rmtree(work_dir, ignore_errors=True)
+            return redirect(url_for('index'))
+
+        accepted_extensions = tuple(sorted({ext for exts in BATCH_INPUT_EXTENSIONS.values() for ext in exts})) + ('.zip',)
+        input_paths, manifest_text, rejected = [], None, []
+        for upload in uploads:
+            if not upload.filename.lower().endswith(accepted_extensions):
+                rejected.append(upload.filename)
+                continue
+            filepath = unique_input_path(work_dir, upload.filename)
+            upload.save(filepath)
+            if filepath.lower().endswith('.zip'):
+                extracted, archive_manifest = extract_archive(filepath, work_dir)
+                os.remove(filepath)
+                input_paths += extracted
+                manifest_text = manifest_text or archive_manifest
+            else:
+                input_paths.append(filepath)
+
+        # A manifest posted with the form takes precedence over one found inside an archive
+        manifest_upload = request.files.get('manifest')
+        if manifest_upload and manifest_upload.filename:
+            manifest_text = manifest_upload.read().decode('utf-8-sig')
+        elif request.form.get('manifest'):
+            manifest_text = request.form.get('manifest')
+        defaults, per_file = parse_manifest(manifest_text)
+
+        request_defaults = {key: request.form.get(key) for key in ('conversion_type', 'firm_name', 'year', 'qtr') if request.form.get(key)}
+        if request.form.get('aggregate_holdings') == 'on':
+            request_defaults['aggregate'] = True
+        jobs, skipped = build_jobs(input_paths, os.path.join(work_dir, 'output'), defaults, per_file, request_defaults,
+                                   record_history=WEB_RECORD_FILINGS)
+        skipped += [{"input": name, "status": "skipped", "errors": ["Unsupported file type."]} for name in rejected]
+        if not jobs:
+            flash('None of the uploaded files could be converted: ' + "; ".join(f"{s['input']}: {s['errors'][0]}" for s in skipped[:5]), 'error')
+            app.logger.warning(f"Batch conversion with no convertible files. Skipped: {skipped}")
+            shutil.rmtree(work_dir, ignore_errors=True)
+            return redirect(url_for('index'))
+    except Exception as e:
+        shutil.rmtree(work_dir, ignore_errors=True)
+        flash(f'Batch conversion error: {str(e)}', 'error')
+        app.logger.error(f"Error preparing batch conversion: {str(e)}", exc_info=True)
+        return redirect(url_for('index'))
+
+    app.logger.info(f"Starting batch conversion of {len(jobs)} file(s) ({len(skipped)} skipped) with up to {BATCH_MAX_WORKERS} worker(s).")
+
+    def generate():
+        try:
+            yield from iter_batch_zip(jobs, skipped, BATCH_MAX_WORKERS)
+            app.logger.info(f"Batch conversion of {len(jobs)} file(s) finished.")
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    response = Response(generate(), mimetype='application/zip',
+                        headers={'Content-Disposition': 'attachment; filename=converted_batch.zip'})
+    # Also covers responses that are closed before the generator is started
+    response.call_on_close(lambda: shutil.rmtree(work_dir, ignore_errors=True))
+    return response
+
+@app.route('/metrics')
+def metrics():
+    """Prometheus scrape endpoint. Under gunicorn the samples of all workers are merged (see gunicorn.conf.py)."""
+    body, content_type = render_metrics()
+    return Response(body, content_type=content_type)
+
+@app.route('/status')
+def status():
+    """Conversions queued and running in this worker's scheduler, per firm."""
+    return jsonify(shared_scheduler().status())
+
+@app.route('/progress/<progress_id>')
+def progress(progress_id):
+    """The current progress of the conversion the page submitted with this progress_id, as JSON. The page polls
+    it, so no worker thread waits for the conversion; asgi_app.py streams it as server-sent events instead."""
+    if not valid_progress_id(progress_id):
+        return Response('Unknown progress id', status=404)
+    response = jsonify(current_progress(progress_id))
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@app.route('/download/<token>/<filename>')
+def download_file(token, filename):
     try:
-        file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        if not os.path.exists(file_path):
+        file_path = request_file_path(token, filename, app.config['UPLOAD_FOLDER'])
+        if file_path is None or not os.path.exists(file_path):
             flash('File not found', 'error')
             app.logger.error(f"Download attempt for non-existent file: {filename}")
             return redirect(url_for('index'))
-        app.logger.info(f"'{filename}' downloaded successfully.")
-        return send_file(file_path, as_attachment=True)
+        # Text outputs go out gzip-compressed when the client accepts it; the compressed copy is cached next to the file
+        send_path, content_encoding = download_variant(file_path, request.headers.get('Accept-Encoding'))
+        app.logger.info(f"'{filename}' downloaded successfully{' (gzip)' if content_encoding else ''}.")
+        # Absolute, since send_file resolves relative paths against the app's root rather than the working directory.
+        # send_file answers If-None-Match / If-Modified-Since with 304 from the ETag and Last-Modified it sends.
+        response = send_file(os.path.abspath(send_path), as_attachment=True, download_name=filename,
+                             etag=file_etag(send_path), last_modified=os.path.getmtime(send_path))
+        if content_encoding:
+            response.headers['Content-Encoding'] = content_encoding
+        response.vary.add('Accept-Encoding')
+        return response
     except Exception as e:
         flash(f'Download error: {str(e)}', 'error')
         app.logger.error(f"Error during download of file '{filename}': {str(e)}", exc_info=True)
@@ -0,0 +1,292 @@
+import os
+import asyncio
+import shutil
+import logging
+from email.utils import formatdate
+from logging.handlers import RotatingFileHandler
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import UploadFile
+from starlette.exceptions import HTTPException
+from starlette.middleware import Middleware
+from starlette.middleware.sessions import SessionMiddleware
+from starlette.responses import FileResponse, JSONResponse, RedirectResponse, Response, StreamingResponse
+from starlette.routing import Mount, Route
+from starlette.staticfiles import StaticFiles
+from starlette.templating import Jinja2Templates
+from werkzeug.utils import secure_filename
+from conversion_metrics import render_metrics
+from conversion_scheduler import SchedulerBusy, shared_scheduler
+from conversion_progress import PROGRESS_POLL_SECONDS, valid_progress_id, progress_events
+from chunked_uploads import UploadError, shared_upload_store
+from web_conversion import (UPLOAD_FOLDER, MAX_CONTENT_LENGTH, UPLOAD_RETENTION_SECONDS, ConversionRequestError,
+                            allowed_extensions, cleanup_uploads, new_request_folder, request_file_path,
+                            submit_conversion, conversion_result_page, download_variant, file_etag, is_not_modified)
+
+# Async serving mode: the /, /convert, /uploads, /progress/<id>, /download/<token>/<filename>, /status and /metrics routes of
+# app.py on an event loop (Starlette on uvicorn). Reading uploads, sending downloads and streaming progress never
+# hold a worker, so one worker serves many slow clients at once; conversions run on the scheduler's process pool
+# and are awaited, not blocked on.
+#   uvicorn asgi_app:app --host 0.0.0.0 --port 8080
+#   gunicorn asgi_app:app -k uvicorn.workers.UvicornWorker
+# /convert-batch is only served by the Flask app. Several conversions run at once in one process here, so
+# uploads are not cleared on every request as app.py does; files older than UPLOAD_RETENTION_SECONDS are.
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+# Bytes copied at a time when saving an upload
+_UPLOAD_COPY_BYTES = 1024 * 1024
+
+logger = logging.getLogger('asgi_app')
+# --- Logging Configuration ---
+if not logger.handlers:
+    os.makedirs('logs', exist_ok=True)
+    file_handler = RotatingFileHandler('logs/app.log', maxBytes=10240, backupCount=10)
+    file_handler.setFormatter(logging.Formatter(
+        '%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]'))
+    file_handler.setLevel(logging.INFO)
+    logger.addHandler(file_handler)
+    logger.setLevel(logging.INFO)
+    logger.info('Application startup (async)')
+# --- End Logging Configuration ---
+
+templates = Jinja2Templates(directory=os.path.join(BASE_DIR, 'templates'))
+os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+
+# --- Flash messages (same session-based behaviour as Flask's flash/get_flashed_messages) ---
+def flash(request, message, category='message'):
+    request.session.setdefault('_flashes', []).append([category, message])
+
+def render_index(request, status_code=200, **page):
+    flashes = request.session.pop('_flashes', [])
+
+    def get_flashed_messages(with_categories=False):
+        return [tuple(f) for f in flashes] if with_categories else [message for _, message in flashes]
+
+    def url_for(endpoint, **values):
+        # The template only links static files: url_for('static', filename=...)
+        return request.app.url_path_for(endpoint, path=values['filename'])
+
+    # The page follows the conversion's progress as server-sent events, which hold no worker here
+    return templates.TemplateResponse(request, 'index.html',
+                                      {**page, 'get_flashed_messages': get_flashed_messages, 'url_for': url_for,
+                                       'progress_stream': True},
+                                      status_code=status_code)
+
+def redirect_to_index():
+    return RedirectResponse('/', status_code=302)
+
+# --- Routes ---
+async def index(request):
+    return render_index(request)
+
+def _save_upload(source, filepath):
+    with open(filepath, 'wb') as target:
+        shutil.copyfileobj(source, target, _UPLOAD_COPY_BYTES)
+
+async def convert(request):
+    try:
+        # Multipart parsing reads the body from the event loop; file parts are spooled to temporary files
+        form = await request.form()
+        # A file sent beforehand through /uploads is named by its upload id instead of being posted again
+        stored_upload = await run_in_threadpool(shared_upload_store().stored_upload, form.get('upload_id'),
+                                                form.get('upload_filename'))
+        if form.get('upload_id') and stored_upload is None:
+            flash(request, 'The uploaded file is no longer available. Please upload it again.', 'error')
+            logger.warning(f"Conversion of unknown stored upload '{form.get('upload_id')}'.")
+            return redirect_to_index()
+        file = stored_upload or form.get('file')
+        if stored_upload is None and not isinstance(file, UploadFile):
+            flash(request, 'No file uploaded', 'error')
+            logger.warning('File upload attempt with no file part.')
+            return redirect_to_index()
+        if not file.filename:
+            flash(request, 'No file selected', 'error')
+            logger.warning('File upload attempt with no file selected.')
+            return redirect_to_index()
+
+        conversion_type = form.get('conversion_type')
+        if not conversion_type:
+            flash(request, 'Conversion type not specified.', 'error')
+            logger.warning('Conversion attempt with no conversion type specified.')
+            return redirect_to_index()
+
+        allowed = allowed_extensions(conversion_type)
+        if not file.filename.lower().endswith(allowed):
+            flash(request, f"Invalid file type. Please upload a {', '.join(allowed)} file.", 'error')
+            logger.warning(f"Invalid file type uploaded: '{file.filename}'.")
+            return redirect_to_index()
+
+        await run_in_threadpool(cleanup_uploads, UPLOAD_FOLDER, UPLOAD_RETENTION_SECONDS)
+        original_filename_secure = secure_filename(file.filename)
+        # Each request gets a folder of its own; the result is downloaded by the folder's random token
+        download_token, request_folder = await run_in_threadpool(new_request_folder, UPLOAD_FOLDER)
+        filepath = os.path.join(request_folder, original_filename_secure)
+        if stored_upload is not None:
+            await run_in_threadpool(stored_upload.save, filepath)
+        else:
+            await run_in_threadpool(_save_upload, file.file, filepath)
+            await file.close()
+        logger.info(f"File '{original_filename_secure}' uploaded successfully.")
+
+        try:
+            task, output_xml_filename, profiled = await run_in_threadpool(
+                submit_conversion, conversion_type, filepath, form, logger, request_folder,
+                admin_token=request.headers.get('x-admin-token'), input_sha256=stored_upload.sha256 if stored_upload else None)
+            result = await asyncio.wrap_future(task)
+            messages, page = conversion_result_page(conversion_type, original_filename_secure, output_xml_filename,
+                                                    result, logger, profiled, request_folder, download_token)
+            for category, message in messages:
+                flash(request, message, category)
+            if page is None:
+                return redirect_to_index()
+            return render_index(request, **page)
+
+        except ConversionRequestError as e:
+            flash(request, str(e), 'error')
+            return redirect_to_index()
+
+        except SchedulerBusy as e:
+            # Too much work queued (or too little memory): ask the client to come back later
+            flash(request, str(e), 'warning')
+            logger.warning(f"Conversion of '{original_filename_secure}' rejected by the scheduler: {e}")
+            response = render_index(request, status_code=503)
+            response.headers['Retry-After'] = str(e.retry_after)
+            return response
+
+        except Exception as e:
+            flash(request, f'Conversion error for {conversion_type}: {str(e)}', 'error')
+            logger.error(f"Conversion error for {conversion_type} on file {original_filename_secure}: {str(e)}", exc_info=True)
+            return redirect_to_index()
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        flash(request, f'An unexpected error occurred: {str(e)}', 'error')
+        logger.error(f"An unexpected error occurred in /convert route: {str(e)}", exc_info=True)
+        return redirect_to_index()
+
+async def download_file(request):
+    filename = request.path_params['filename']
+    file_path = request_file_path(request.path_params['token'], filename, UPLOAD_FOLDER)
+    if file_path is None or not os.path.exists(file_path):
+        flash(request, 'File not found', 'error')
+        logger.error(f"Download attempt for non-existent file: {filename}")
+        return redirect_to_index()
+    # Text outputs go out gzip-compressed when the client accepts it; the compressed copy is cached next to the file
+    send_path, content_encoding = await run_in_threadpool(download_variant, file_path, request.headers.get('accept-encoding'))
+    stat = os.stat(send_path)
+    etag = file_etag(send_path)
+    headers = {'etag': f'"{etag}"', 'last-modified': formatdate(stat.st_mtime, usegmt=True), 'vary': 'Accept-Encoding'}
+    if is_not_modified(request.headers, etag, stat.st_mtime):
+        return Response(status_code=304, headers=headers)
+    if content_encoding:
+        headers['content-encoding'] = content_encoding
+    logger.info(f"'{filename}' downloaded successfully{' (gzip)' if content_encoding else ''}.")
+    # Sent in chunks as the client reads them; file reads happen in a worker thread
+    return FileResponse(send_path, filename=filename, headers=headers, stat_result=stat)
+
+# --- Resumable chunked uploads (chunked_uploads.py); file work runs in worker threads ---
+def upload_error(request, e):
+    return JSONResponse(e.as_dict(), status_code=e.status)
+
+async def _json_body(request):
+    try:
+        data = await request.json()
+    except ValueError:
+        return {}
+    return data if isinstance(data, dict) else {}
+
+async def initiate_upload(request):
+    """Starts an upload: JSON {"filename", "size"[, "sha256"]}; the status carries the upload id to continue with."""
+    data = await _json_body(request)
+    return JSONResponse(await run_in_threadpool(shared_upload_store().initiate, data.get('filename'), data.get('size'), data.get('sha256')))
+
+async def upload_chunk(request):
+    """GET: how much of the upload has arrived. PUT: the next chunk, at the Upload-Offset header's byte."""
+    upload_id = request.path_params['upload_id']
+    if request.method == 'GET':
+        return JSONResponse(await run_in_threadpool(shared_upload_store().status, upload_id))
+    data = await request.body()
+    return JSONResponse(await run_in_threadpool(shared_upload_store().append, upload_id, request.headers.get('upload-offset'), data))
+
+async def finalize_upload(request):
+    """Hashes the received file (checked against JSON {"sha256"} when given) and stores it for /convert (upload_id field)."""
+    data = await _json_body(request)
+    status = await run_in_threadpool(shared_upload_store().finalize, request.path_params['upload_id'], data.get('sha256'))
+    logger.info(f"Chunked upload '{status['filename']}' finalized ({status['size']} bytes).")
+    return JSONResponse(status)
+
+async def progress(request):
+    """Server-sent events with the progress of the conversion the page submitted with this progress_id."""
+    progress_id = request.path_params['progress_id']
+    if not valid_progress_id(progress_id):
+        return Response('Unknown progress id', status_code=404)
+
+    async def stream():
+        # Reading the small progress file between sleeps is cheap enough to do on the event loop
+        for chunk in progress_events(progress_id):
+            if chunk is None:
+                await asyncio.sleep(PROGRESS_POLL_SECONDS)
+            else:
+                yield chunk
+
+    return StreamingResponse(stream(), media_type='text/event-stream',
+                             headers={'cache-control': 'no-cache', 'x-accel-buffering': 'no'})
+
+async def status(request):
+    """Conversions queued and running in this worker's scheduler, per firm."""
+    return JSONResponse(shared_scheduler().status())
+
+async def metrics(request):
+    body, content_type = await run_in_threadpool(render_metrics)
+    return Response(body, headers={'Content-Type': content_type})
+
+class BodySizeLimit:
+    """ASGI middleware rejecting request bodies over max_bytes with 413 (Flask's MAX_CONTENT_LENGTH), whether the
+    size is announced in Content-Length or only found while reading a chunked body."""
+
+    def __init__(self, app, max_bytes):
+        self.app = app
+        self.max_bytes = max_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        for name, value in scope['headers']:
+            if name == b'content-length' and value.isdigit() and int(value) > self.max_bytes:
+                return await Response('Request Entity Too Large', status_code=413)(scope, receive, send)
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            received += len(message.get('body', b''))
+            if received > self.max_bytes:
+                raise HTTPException(status_code=413)
+            return message
+
+        return await self.app(scope, limited_receive, send)
+
+app = Starlette(
+    routes=[
+        Route('/', index),
+        Route('/convert', convert, methods=['POST']),
+        Route('/uploads', initiate_upload, methods=['POST']),
+        Route('/uploads/{upload_id}', upload_chunk, methods=['GET', 'PUT']),
+        Route('/uploads/{upload_id}/finalize', finalize_upload, methods=['POST']),
+        Route('/progress/{progress_id}', progress),
+        Route('/download/{token}/{filename}', download_file),
+        Route('/status', status),
+        Route('/metrics', metrics),
+        Mount('/static', StaticFiles(directory=os.path.join(BASE_DIR, 'static')), name='static'),
+    ],
+    exception_handlers={UploadError: upload_error},
+    middleware=[
+        Middleware(BodySizeLimit, max_bytes=MAX_CONTENT_LENGTH),
+        Middleware(SessionMiddleware, secret_key=os.environ.get('FLASK_SECRET_KEY', 'dev_secret_key_۱۲۳')),
+    ],
+)
+
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run(app, host='0.0.0.0', port=int(os.environ.get('PORT', 8080)))
@@ -0,0 +1,458 @@
+import os
+import re
+import json
+import time
+import shutil
+import zipfile
+import argparse
+import datetime
+import tempfile
+from datetime import timezone
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from werkzeug.utils import secure_filename
+from xlsx_to_corrected_edgar_xml import (read_holdings_stage, build_holdings_stage, serialize_holdings_stage,
+                                         validate_holdings_stage, holdings_summary)
+from finra_6151_converter import perform_6151_conversion
+from cusip_reference import DEFAULT_CUSIP_INDEX_PATH
+from holdings_input import SUPPORTED_HOLDINGS_EXTENSIONS
+from conversion_metrics import queue_changed, start_conversion, finish_conversion, record_error
+from xml_validation import issues_as_dicts
+from batch_pipeline import StagePipeline, pipeline_stage, bottleneck_stage, format_utilization
+
+# --- Batch limits (overridable through the environment) ---
+# Conversions are CPU bound (pandas + XML serialisation), so they run in worker processes rather than threads
+BATCH_MAX_WORKERS = int(os.environ.get('BATCH_MAX_WORKERS', str(min(4, os.cpu_count() or 1))))
+BATCH_MAX_FILES = int(os.environ.get('BATCH_MAX_FILES', '500'))
+# Run batches as a read -> build -> serialize -> validate pipeline (see batch_pipeline.py) rather than one whole
+# conversion per worker process
+BATCH_PIPELINE = os.environ.get('BATCH_PIPELINE', '1').lower() not in ('0', 'false', 'no')
+# Files allowed to wait between two pipeline stages; bounds how many parsed tables are in memory
+BATCH_PIPELINE_QUEUE_SIZE = int(os.environ.get('BATCH_PIPELINE_QUEUE_SIZE', '2'))
+# Guards against zip bombs: total uncompressed size allowed out of uploaded archives
+BATCH_MAX_EXTRACTED_BYTES = int(float(os.environ.get('BATCH_MAX_EXTRACTED_MB', '512')) * 1024 * 1024)
+MANIFEST_FILENAME = 'manifest.json'
+REPORT_FILENAME = 'report.json'
+# Output XML is copied into the zip in blocks of this size, so a large file never sits in memory
+_ZIP_COPY_BLOCK_BYTES = 1024 * 1024
+
+BATCH_INPUT_EXTENSIONS = {
+    '13F': SUPPORTED_HOLDINGS_EXTENSIONS,
+    '6151': ('.xlsx',),
+}
+
+# --- Manifest ---
+# A manifest sets per-file parameters; anything not given falls back to "defaults", then to the request defaults.
+# {
+#   "defaults": {"conversion_type": "6151", "firm_name": "Acme Securities"},
+#   "files": {
+#     "holdings_q2.xlsx": {"conversion_type": "13F", "aggregate": true, "client": "acme", "period": "2024Q2"},
+#     "routing_2024_q2.xlsx": {"year": 2024, "qtr": 2}
+#   }
+# }
+def parse_manifest(manifest_text):
+    """Parses manifest JSON into (defaults, per_file) dicts keyed by secure filename. Raises ValueError if malformed."""
+    if not manifest_text or not manifest_text.strip():
+        return {}, {}
+    try:
+        manifest = json.loads(manifest_text)
+    except json.JSONDecodeError as e:
+        raise ValueError(f"Manifest is not valid JSON: {e}")
+    if not isinstance(manifest, dict):
+        raise ValueError("Manifest must be a JSON object with optional 'defaults' and 'files' keys.")
+    defaults = manifest.get('defaults') or {}
+    files = manifest.get('files') or {}
+    if not isinstance(defaults, dict) or not isinstance(files, dict):
+        raise ValueError("Manifest 'defaults' and 'files' must both be JSON objects.")
+    per_file = {}
+    for name, params in files.items():
+        if not isinstance(params, dict):
+            raise ValueError(f"Manifest entry for '{name}' must be a JSON object.")
+        per_file[secure_filename(os.path.basename(name))] = params
+    return defaults, per_file
+
+def infer_year_and_quarter(filename):
+    """Reads the reporting year and quarter out of names like 281065_606_NMS_2024_Q2.xlsx (same rules as the upload form)."""
+    stem = os.path.splitext(filename)[0]
+    year_match = re.search(r'(20\d{2})', stem)
+    quarter_match = re.search(r'Q([1-4])', stem, re.IGNORECASE) or re.search(r'([1-4])Q', stem, re.IGNORECASE)
+    return (year_match.group(1) if year_match else None), (quarter_match.group(1) if quarter_match else None)
+
+def _as_bool(value):
+    if isinstance(value, str):
+        return value.strip().lower() in ('1', 'true', 'yes', 'on')
+    return bool(value)
+
+# --- Collecting inputs ---
+def unique_input_path(dest_dir, filename):
+    """Safe path for an incoming file in dest_dir; a repeated name gets a _2, _3... suffix instead of overwriting."""
+    filename = secure_filename(filename) or 'upload'
+    stem, extension = os.path.splitext(filename)
+    candidate, counter = filename, 2
+    while os.path.exists(os.path.join(dest_dir, candidate)):
+        candidate = f"{stem}_{counter}{extension}"
+        counter += 1
+    return os.path.join(dest_dir, candidate)
+
+def extract_archive(archive_path, dest_dir, max_bytes=BATCH_MAX_EXTRACTED_BYTES):
+    """Extracts an uploaded zip flat into dest_dir. Returns (extracted_paths, manifest_text or None).
+    Folder structure is dropped, hidden/macOS metadata entries are skipped and the total size is capped."""
+    extracted, manifest_text, total_bytes = [], None, 0
+    with zipfile.ZipFile(archive_path) as archive:
+        for info in archive.infolist():
+            if info.is_dir():
+                continue
+            name = os.path.basename(info.filename)
+            if not name or name.startswith('.') or '__MACOSX' in info.filename:
+                continue
+            total_bytes += info.file_size
+            if total_bytes > max_bytes:
+                raise ValueError(f"Archive '{os.path.basename(archive_path)}' expands to more than {max_bytes // (1024 * 1024)} MB.")
+            if name.lower() == MANIFEST_FILENAME:
+                manifest_text = archive.read(info).decode('utf-8-sig')
+                continue
+            target = unique_input_path(dest_dir, name)
+            with archive.open(info) as source, open(target, 'wb') as out:
+                shutil.copyfileobj(source, out, _ZIP_COPY_BLOCK_BYTES)
+            extracted.append(target)
+    return extracted, manifest_text
+
+def build_jobs(input_paths, output_root, defaults=None, per_file=None, request_defaults=None, record_history=True):
+    """Resolves every input file to a job dict. Files that cannot be converted become 'skipped' results instead.
+    With record_history False the conversions are not recorded in the filings history."""
+    defaults = {**(request_defaults or {}), **(defaults or {})}
+    per_file = per_file or {}
+    jobs, skipped = [], []
+    for position, input_path in enumerate(input_paths):
+        filename = os.path.basename(input_path)
+        params = {**defaults, **per_file.get(filename, {})}
+        conversion_type = str(params.get('conversion_type') or '13F').upper()
+        if conversion_type not in BATCH_INPUT_EXTENSIONS:
+            skipped.append({"position": position, "input": filename, "status": "skipped", "errors": [f"Unknown conversion type '{conversion_type}'."]})
+            continue
+        if not filename.lower().endswith(BATCH_INPUT_EXTENSIONS[conversion_type]):
+            skipped.append({"position": position, "input": filename, "status": "skipped",
+                            "errors": [f"{conversion_type} expects {', '.join(BATCH_INPUT_EXTENSIONS[conversion_type])} files."]})
+            continue
+
+        job = {"position": position, "input": filename, "input_path": input_path, "conversion_type": conversion_type,
+               "output_dir": os.path.join(output_root, f"{position:05d}"), "record_history": record_history}
+        if conversion_type == '13F':
+            job["aggregate"] = _as_bool(params.get('aggregate', False))
+            # Filings history keys; default to what the file name says (see filings_store.py)
+            job["client"] = params.get('client')
+            job["period"] = params.get('period')
+        else:
+            inferred_year, inferred_qtr = infer_year_and_quarter(filename)
+            job["firm_name"] = params.get('firm_name')
+            job["year"] = params.get('year') or inferred_year
+            job["qtr"] = params.get('qtr') or inferred_qtr
+            missing = [key for key in ('firm_name', 'year', 'qtr') if not job[key]]
+            if missing:
+                skipped.append({"position": position, "input": filename, "status": "skipped",
+                                "errors": [f"Missing 6151 parameter(s): {', '.join(missing)}. Set them in the manifest."]})
+                continue
+        jobs.append(job)
+
+    if len(jobs) > BATCH_MAX_FILES:
+        raise ValueError(f"Batch has {len(jobs)} files; the limit is {BATCH_MAX_FILES}.")
+    return jobs, skipped
+
+# --- Conversion stages ---
+# Each stage takes and returns a state dict {"job": ..., ...}. Stages run one after the other in
+# convert_batch_item; the batch pipeline (see batch_stages) runs read, build and serialize together in one worker
+# process (convert_batch_stages) and validation on separate workers, and reports the utilization of all four.
+# 6151 reports are a few hundred elements; their whole conversion, validation included, runs in the serialize stage.
+def read_batch_item(state):
+    job = state["job"]
+    if job["conversion_type"] == '13F':
+        state["df"] = read_holdings_stage(job["input_path"])
+    return state
+
+def build_batch_item(state):
+    job = state["job"]
+    if job["conversion_type"] == '13F':
+        cusip_index_path = DEFAULT_CUSIP_INDEX_PATH if os.path.exists(DEFAULT_CUSIP_INDEX_PATH) else None
+        state["prepared"] = build_holdings_stage(state.pop("df"), job["input_path"], job["aggregate"], cusip_index_path)
+    return state
+
+def serialize_batch_item(state):
+    job = state["job"]
+    os.makedirs(job["output_dir"], exist_ok=True)
+    if job["conversion_type"] == '13F':
+        output_path = os.path.join(job["output_dir"], os.path.splitext(job["input"])[0] + '.xml')
+        state["rows_written"], state["source_map"] = serialize_holdings_stage(
+            state["prepared"], output_path, validate=True, client=job["client"], period=job["period"],
+            record_history=job["record_history"])
+        state["prepared"]["df"] = None  # Not needed any more; keeps it from being sent back from a worker process
+        state["output_path"] = output_path
+    else:
+        state["output_path"], state["xml_valid"], state["errors"] = perform_6151_conversion(
+            job["input_path"], job["output_dir"], job["firm_name"], job["year"], job["qtr"], job["record_history"])
+    return state
+
+def validate_batch_item(state):
+    if state["job"]["conversion_type"] == '13F':
+        state["validation"] = validate_holdings_stage(state["output_path"], state.pop("source_map"))
+    return state
+
+BATCH_STAGE_FUNCTIONS = [("read", read_batch_item), ("build", build_batch_item),
+                         ("serialize", serialize_batch_item), ("validate", validate_batch_item)]
+
+# Stages of BATCH_STAGE_FUNCTIONS that the pipeline runs as its one "convert" stage
+_CONVERT_STAGES = ("read", "build", "serialize")
+
+def convert_batch_stages(state):
+    """Read, build and serialize one after the other in the same worker process, so the parsed table is never
+    sent between processes; the seconds each took go to state["stage_seconds"], which the pipeline adds up per
+    step for its utilization report. A failing step is reported in the state like a failing pipeline stage."""
+    stage_seconds = state.setdefault("stage_seconds", {})
+    for name, function in BATCH_STAGE_FUNCTIONS:
+        if name in _CONVERT_STAGES:
+            started = time.perf_counter()
+            try:
+                state = function(state)
+            except Exception as e:
+                state.update(error=f"{name} stage failed: {e}", error_type=type(e).__name__, failed_stage=name)
+                state.pop("df", None)  # Not sent back from the worker process
+                state.pop("prepared", None)
+                return state
+            finally:
+                stage_seconds[name] = round(time.perf_counter() - started, 3)
+    return state
+
+def batch_stages(max_workers=BATCH_MAX_WORKERS):
+    """Pipeline stages for a batch: reading, building and writing XML are CPU bound and run in max_workers
+    worker processes (the pipeline's one pool); validation runs in threads because lxml releases the GIL while it
+    parses and validates, so one file is validated while the next ones are converted."""
+    return [pipeline_stage("convert", convert_batch_stages, max_workers, processes=True, steps=_CONVERT_STAGES),
+            pipeline_stage("validate", validate_batch_item, max(1, max_workers // 2))]
+
+def batch_result(state, seconds):
+    """The report entry for a finished (or failed) job."""
+    job = state["job"]
+    result = {"input": job["input"], "conversion_type": job["conversion_type"], "output": None, "output_path": None,
+              "status": "failed", "xml_valid": None, "errors": []}
+    if "error" in state:
+        result["errors"].append(state["error"])
+    elif job["conversion_type"] == '13F':
+        summary = holdings_summary(state["prepared"], state["rows_written"], state["validation"])
+        status = "invalid" if summary["xml_valid"] is False else "converted"
+        result.update(output_path=state["output_path"], status=status, xml_valid=summary["xml_valid"], rows_read=summary["rows_read"],
+                      rows_written=summary["rows_written"], invalid_cusip_count=summary["invalid_cusip_count"],
+                      invalid_cusips=[list(item) for item in summary["invalid_cusips"][:20]],
+                      rule_violation_count=summary["rule_violation_count"], rule_counts=summary["rule_counts"],
+                      rule_violations=summary["rule_violations"][:100], coercion_stats=summary["coercion_stats"],
+                      validation_stats=summary["validation_stats"])
+        if summary["invalid_cusip_count"]:
+            result["errors"].append(f"{summary['invalid_cusip_count']} CUSIP(s) failed check-digit validation.")
+        if summary["rule_violation_count"]:
+            result["errors"].append(f"{summary['rule_violation_count']} data-quality rule violation(s).")
+        if summary["xml_valid"] is False:
+            result["errors"].extend(summary["validation_errors"])
+    else:
+        result.update(output_path=state["output_path"], xml_valid=bool(state["xml_valid"]), errors=list(state["errors"]))
+        if state["output_path"]:
+            result["status"] = "converted" if state["xml_valid"] else "invalid"
+    # Structured copy of the errors: XML line/column and, for schema errors, the sheet row and column they came from
+    result["error_details"] = issues_as_dicts(result["errors"][:100])
+    if "stage_seconds" in state:
+        result["stage_seconds"] = state["stage_seconds"]
+    result["seconds"] = round(seconds, 3)
+    return result
+
+def _start_job_metrics(job):
+    # 6151 conversions record their own metrics (perform_6151_conversion)
+    return start_conversion('13F', job["input_path"]) if job["conversion_type"] == '13F' else None
+
+def _finish_job_metrics(record, state):
+    if record is None:
+        return
+    if "error" in state:
+        record["outcome"] = "error"
+        record_error('13F', state.get("error_type", "Exception"))
+    else:
+        record["items"] = state["rows_written"]
+    finish_conversion('13F', record)
+
+# --- Worker ---
+def convert_batch_item(job):
+    """Runs one conversion, its stages one after the other, in a worker process (used when BATCH_PIPELINE is off).
+    Always returns a result dict; errors are reported, not raised."""
+    started = time.perf_counter()
+    state = {"job": job}
+    metrics_record = _start_job_metrics(job)
+    for name, function in BATCH_STAGE_FUNCTIONS:
+        try:
+            state = function(state)
+        except Exception as e:
+            state.update(error=str(e), error_type=type(e).__name__, failed_stage=name)
+            break
+    _finish_job_metrics(metrics_record, state)
+    return batch_result(state, time.perf_counter() - started)
+
+# --- Streaming zip output ---
+class _ZipChunkBuffer:
+    """Write-only sink for zipfile. zipfile treats it as unseekable and writes data descriptors, so each member
+    can be streamed out as soon as it is written instead of building the whole archive in memory."""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+def _unique_arcname(name, used_names):
+    stem, extension = os.path.splitext(name)
+    candidate, counter = name, 2
+    while candidate.lower() in used_names:
+        candidate = f"{stem}_{counter}{extension}"
+        counter += 1
+    used_names.add(candidate.lower())
+    return candidate
+
+def _iter_pooled_results(jobs, worker_count):
+    """(job, result) per job, each converted start to finish by one worker process."""
+    executor = ProcessPoolExecutor(max_workers=worker_count)
+    try:
+        futures = {executor.submit(convert_batch_item, job): job for job in jobs}
+        for future in as_completed(futures):
+            job = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:  # Worker process died (e.g. out of memory)
+                result = {"input": job["input"], "conversion_type": job["conversion_type"], "status": "failed",
+                          "output": None, "xml_valid": None, "errors": [f"Worker failed: {e}"]}
+            yield job, result
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+def _iter_pipelined_results(jobs, pipeline):
+    """(job, result) per job as it leaves the last stage of the pipeline."""
+    metrics_records = {}
+
+    def states():
+        for job in jobs:
+            metrics_records[job["position"]] = _start_job_metrics(job)
+            yield {"job": job, "started": time.perf_counter()}
+
+    finished_states = pipeline.run(states())
+    try:
+        for state in finished_states:
+            job = state["job"]
+            _finish_job_metrics(metrics_records.pop(job["position"]), state)
+            yield job, batch_result(state, time.perf_counter() - state["started"])
+    finally:
+        finished_states.close()
+        for record in metrics_records.values():  # Jobs still in the pipeline when the batch was abandoned
+            if record is not None:
+                record["outcome"] = "cancelled"
+                finish_conversion('13F', record)
+
+def iter_batch_zip(jobs, skipped=None, max_workers=BATCH_MAX_WORKERS, pipelined=BATCH_PIPELINE):
+    """Converts the jobs and yields a zip archive as byte chunks. With pipelined, files move through the
+    convert and validate stages of a StagePipeline, different files in different stages at once;
+    otherwise each file is converted whole by one of a bounded pool of worker processes. Each XML is added as
+    soon as its conversion finishes; report.json (results in input order plus totals, and per-stage utilization
+    for pipelined runs) is written last."""
+    started_at = datetime.datetime.now(timezone.utc)
+    buffer = _ZipChunkBuffer()
+    results = list(skipped or [])
+    used_names = {REPORT_FILENAME}
+    worker_count = max(1, min(max_workers, len(jobs) or 1))
+    pipeline = StagePipeline(batch_stages(worker_count), BATCH_PIPELINE_QUEUE_SIZE, process_workers=worker_count) if pipelined else None
+    finished_jobs = _iter_pipelined_results(jobs, pipeline) if pipeline else _iter_pooled_results(jobs, worker_count)
+    pending = len(jobs)
+    queue_changed('batch', pending)
+    try:
+        with zipfile.ZipFile(buffer, mode='w', compression=zipfile.ZIP_DEFLATED) as archive:
+            for job, result in finished_jobs:
+                pending -= 1
+                queue_changed('batch', -1)
+                result["position"] = job["position"]
+                output_path = result.pop("output_path", None)
+                if output_path and os.path.exists(output_path):
+                    result["output"] = _unique_arcname(os.path.basename(output_path), used_names)
+                    with open(output_path, 'rb') as source, archive.open(result["output"], 'w', force_zip64=True) as member:
+                        for block in iter(lambda: source.read(_ZIP_COPY_BLOCK_BYTES), b''):
+                            member.write(block)
+                            yield buffer.drain()
+                results.append(result)
+                chunk = buffer.drain()
+                if chunk:
+                    yield chunk
+
+            finished_at = datetime.datetime.now(timezone.utc)
+            results.sort(key=lambda r: r.get("position", float('inf')))
+            report = {
+                "started_at": started_at.strftime('%Y-%m-%dT%H:%M:%SZ'),
+                "finished_at": finished_at.strftime('%Y-%m-%dT%H:%M:%SZ'),
+                "elapsed_seconds": round((finished_at - started_at).total_seconds(), 3),
+                "workers": worker_count,
+                "totals": {status: sum(1 for r in results if r["status"] == status)
+                           for status in ("converted", "invalid", "failed", "skipped")},
+                "files": [{k: v for k, v in r.items() if k != "position"} for r in results],
+            }
+            if pipeline:
+                report["stages"] = pipeline.utilization()
+                report["bottleneck_stage"] = bottleneck_stage(report["stages"])
+            archive.writestr(REPORT_FILENAME, json.dumps(report, indent=2))
+        yield buffer.drain()
+    finally:
+        finished_jobs.close()  # Stops the workers when the client went away mid-batch
+        if pending:  # The remaining jobs were cancelled
+            queue_changed('batch', -pending)
+
+def write_batch_zip(jobs, output_zip, skipped=None, max_workers=BATCH_MAX_WORKERS, pipelined=BATCH_PIPELINE):
+    """Writes the batch archive to output_zip and returns the parsed report."""
+    with open(output_zip, 'wb') as out:
+        for chunk in iter_batch_zip(jobs, skipped, max_workers, pipelined):
+            out.write(chunk)
+    with zipfile.ZipFile(output_zip) as archive:
+        return json.loads(archive.read(REPORT_FILENAME))
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert many 13F / 6151 input files into one zip of XML files plus a JSON report.")
+    parser.add_argument("inputs", nargs="+", help="Input files (.xlsx/.csv/.parquet) and/or .zip archives of them.")
+    parser.add_argument("-o", "--output", default="batch_output.zip", help="Path of the zip to write.")
+    parser.add_argument("--manifest", help=f"JSON manifest with per-file parameters (a {MANIFEST_FILENAME} inside an archive is also used).")
+    parser.add_argument("--conversion-type", default="13F", choices=sorted(BATCH_INPUT_EXTENSIONS), help="Default conversion type.")
+    parser.add_argument("--workers", type=int, default=BATCH_MAX_WORKERS, help="Maximum number of parallel conversions.")
+    parser.add_argument("--no-pipeline", dest="pipelined", action="store_false", default=BATCH_PIPELINE,
+                        help="Convert each file whole in one worker process instead of running the staged pipeline.")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='batch_')
+    try:
+        input_paths, manifest_text = [], None
+        for path in args.inputs:
+            if path.lower().endswith('.zip'):
+                extracted, archive_manifest = extract_archive(path, work_dir)
+                input_paths += extracted
+                manifest_text = manifest_text or archive_manifest
+            else:
+                input_paths.append(os.path.abspath(path))
+        if args.manifest:
+            with open(args.manifest, encoding='utf-8-sig') as manifest_file:
+                manifest_text = manifest_file.read()
+        defaults, per_file = parse_manifest(manifest_text)
+        jobs, skipped = build_jobs(input_paths, os.path.join(work_dir, 'output'), defaults, per_file,
+                                   {"conversion_type": args.conversion_type})
+        print(f"Converting {len(jobs)} file(s) with up to {args.workers} worker(s); {len(skipped)} skipped.")
+        report = write_batch_zip(jobs, args.output, skipped, args.workers, args.pipelined)
+        print(f"Wrote {args.output}: {report['totals']} in {report['elapsed_seconds']}s")
+        if "stages" in report:
+            print(f"Stage utilization: {format_utilization(report['stages'])}; bottleneck: {report['bottleneck_stage']}")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
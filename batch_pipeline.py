@@ -0,0 +1,204 @@
+import time
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+# Staged pipeline for batch conversions. Each file goes through the same stages (for batch_conversion.py: convert,
+# then validate); every stage has its own workers and a bounded queue in front of it, so while one file is being
+# validated the next ones can be converted. A full queue blocks the stage feeding it (backpressure), which caps how
+# many parsed tables are held in memory at once.
+#
+# Stages are dicts built with pipeline_stage(). A stage function takes the item's state dict and returns it
+# (updated); stages marked processes=True run their function in the pipeline's one process pool, shared by all
+# process stages so a run never has more than process_workers worker processes, the others in threads of this
+# process. Stage functions of a process stage must be importable (module-level) functions.
+# A stage whose function runs several steps one after the other (convert: read -> build -> serialize) names them
+# in steps and reports each step's seconds in state["stage_seconds"] (and a failed step in state["failed_stage"]);
+# utilization() then lists the steps in the stage's place, so the report shows which step limits throughput.
+
+# Items waiting between two stages
+DEFAULT_QUEUE_SIZE = 2
+# How often blocked workers check whether the pipeline was stopped
+_POLL_SECONDS = 0.1
+_DONE = object()
+
+def pipeline_stage(name, function, workers=1, processes=False, steps=()):
+    return {"name": name, "function": function, "workers": max(1, int(workers)), "processes": processes, "steps": tuple(steps)}
+
+class _StageCounters:
+    """Time each stage's workers spend working, waiting for input (starved) and waiting for room in the next
+    queue (blocked by backpressure)."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.items = 0
+        self.failed = 0
+        self.busy = 0.0
+        self.starved = 0.0
+        self.blocked = 0.0
+
+    def add(self, **seconds):
+        with self.lock:
+            for key, value in seconds.items():
+                setattr(self, key, getattr(self, key) + value)
+
+class StagePipeline:
+    """Runs items through a list of stages. run(items) yields each item's final state as it leaves the last
+    stage (completion order, not input order). An exception in a stage is stored as state["error"] and the
+    item skips the remaining stages. utilization() reports, per stage, how busy its workers were.
+    process_workers sizes the shared process pool (default: the most workers of any process stage). An exception
+    raised by the items iterator, or one that ends a worker thread, is raised again by run() once the items
+    already in the pipeline are through."""
+
+    def __init__(self, stages, queue_size=DEFAULT_QUEUE_SIZE, process_workers=None):
+        self.stages = stages
+        self.queue_size = queue_size
+        self.process_workers = process_workers or max((stage["workers"] for stage in stages if stage["processes"]), default=0)
+        self.counters = {name: _StageCounters() for stage in stages for name in (stage["name"], *stage["steps"])}
+        self._stopped = threading.Event()
+        self._started = None
+        self._finished = None
+        self._error = None
+
+    def _put(self, target, item):
+        """Blocking put that gives up once the pipeline is stopped. Returns the seconds spent waiting."""
+        waited = time.perf_counter()
+        while not self._stopped.is_set():
+            try:
+                target.put(item, timeout=_POLL_SECONDS)
+                break
+            except queue.Full:
+                continue
+        return time.perf_counter() - waited
+
+    def _get(self, source):
+        """Blocking get; (item or None when stopped, seconds spent waiting)."""
+        waited = time.perf_counter()
+        while not self._stopped.is_set():
+            try:
+                return source.get(timeout=_POLL_SECONDS), time.perf_counter() - waited
+            except queue.Empty:
+                continue
+        return None, time.perf_counter() - waited
+
+    def _feed(self, items, target):
+        try:
+            for item in items:
+                self._put(target, item)
+                if self._stopped.is_set():
+                    return
+        except BaseException as e:
+            self._error = self._error or e
+        finally:
+            # Always sent, so the stages and run() finish even when the items iterator fails
+            self._put(target, _DONE)
+
+    def _work(self, stage, source, target, pool, remaining_workers):
+        counters = self.counters[stage["name"]]
+        try:
+            while True:
+                state, waited = self._get(source)
+                counters.add(starved=waited)
+                if state is None:
+                    return
+                if state is _DONE:
+                    self._put(source, _DONE)  # Lets the stage's other workers see it too
+                    return
+                if "error" not in state:
+                    started = time.perf_counter()
+                    try:
+                        state = pool.submit(stage["function"], state).result() if pool else stage["function"](state)
+                    except Exception as e:  # Includes a worker process dying (BrokenProcessPool)
+                        state["error"] = f"{stage['name']} stage failed: {e}"
+                        state["error_type"] = type(e).__name__
+                        state["failed_stage"] = stage["name"]
+                        counters.add(failed=1)
+                    counters.add(items=1, busy=time.perf_counter() - started)
+                    self._count_steps(stage, state)
+                counters.add(blocked=self._put(target, state))
+        except BaseException as e:
+            self._error = self._error or e
+        finally:
+            # The stage's last worker to stop passes _DONE on, however it stopped
+            with remaining_workers["lock"]:
+                remaining_workers["count"] -= 1
+                last_worker = remaining_workers["count"] == 0
+            if last_worker:
+                self._put(target, _DONE)
+
+    def _count_steps(self, stage, state):
+        step_seconds = state.get("stage_seconds", {})
+        for step in stage["steps"]:
+            if step in step_seconds:
+                self.counters[step].add(items=1, busy=step_seconds[step], failed=int(state.get("failed_stage") == step))
+
+    def run(self, items):
+        self._started = time.perf_counter()
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in range(len(self.stages) + 1)]
+        threads = [threading.Thread(target=self._feed, args=(items, queues[0]), daemon=True)]
+        pool = ProcessPoolExecutor(max_workers=self.process_workers) if self.process_workers else None
+        for position, stage in enumerate(self.stages):
+            remaining_workers = {"count": stage["workers"], "lock": threading.Lock()}
+            for _ in range(stage["workers"]):
+                threads.append(threading.Thread(target=self._work, daemon=True,
+                                                 args=(stage, queues[position], queues[position + 1],
+                                                       pool if stage["processes"] else None, remaining_workers)))
+        for thread in threads:
+            thread.start()
+        try:
+            while True:
+                state, _ = self._get(queues[-1])
+                if state is None or state is _DONE:
+                    break
+                yield state
+        finally:
+            # Also reached when the consumer stops early (e.g. a client abandons a streamed download)
+            self._stopped.set()
+            for thread in threads:
+                thread.join()
+            if pool:
+                pool.shutdown(wait=True, cancel_futures=True)
+            self._finished = time.perf_counter()
+        if self._error is not None:
+            raise self._error
+
+    def utilization(self):
+        """Per stage: workers, processes, items, failed, busy/starved/blocked seconds (summed over the stage's
+        workers) and utilization, the share of the stage's worker time spent working. The stage with the highest
+        utilization is the one limiting throughput; a stage with high "blocked" time is waiting on the next one.
+        A stage with steps is replaced by one entry per step: its busy seconds and utilization are the step's, its
+        workers, starved and blocked seconds those of the stage (the steps share its workers), and "stage" names
+        the stage."""
+        elapsed = ((self._finished or time.perf_counter()) - self._started) if self._started else 0.0
+        report = {}
+        for stage in self.stages:
+            counters = self.counters[stage["name"]]
+            capacity = elapsed * stage["workers"]
+            entry = {
+                "workers": stage["workers"], "processes": stage["processes"], "items": counters.items,
+                "failed": counters.failed, "busy_seconds": round(counters.busy, 3),
+                "starved_seconds": round(counters.starved, 3), "blocked_seconds": round(counters.blocked, 3),
+                "utilization": round(counters.busy / capacity, 3) if capacity else 0.0,
+            }
+            if not stage["steps"]:
+                report[stage["name"]] = entry
+            for step in stage["steps"]:
+                step_counters = self.counters[step]
+                report[step] = {**entry, "stage": stage["name"], "items": step_counters.items, "failed": step_counters.failed,
+                                "busy_seconds": round(step_counters.busy, 3),
+                                "utilization": round(step_counters.busy / capacity, 3) if capacity else 0.0}
+        return report
+
+def bottleneck_stage(utilization):
+    """Name of the busiest stage in a utilization() report."""
+    return max(utilization, key=lambda name: utilization[name]["utilization"]) if utilization else None
+
+def format_utilization(utilization):
+    """One-line form for logs, e.g. 'read 35% (2 processes, convert), ..., validate 20% (1 thread)'."""
+    parts = []
+    for name, stats in utilization.items():
+        kind = "process" if stats["processes"] else "thread"
+        plural = ("es" if stats["processes"] else "s") if stats["workers"] > 1 else ""
+        shared = f", {stats['stage']}" if "stage" in stats else ""
+        parts.append(f"{name} {stats['utilization']:.0%} ({stats['workers']} {kind}{plural}{shared})")
+    return ", ".join(parts)
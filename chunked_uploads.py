@@ -0,0 +1,338 @@
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import secrets
+import argparse
+import threading
+from holdings_input import SUPPORTED_HOLDINGS_EXTENSIONS
+from workbook_cache import file_content_hash
+
+try:
+    import fcntl
+except ImportError:  # No cross-process locking of partial uploads (Windows); a single server process is still safe
+    fcntl = None
+
+# Resumable chunked uploads, for workbooks too large or links too unreliable for a single /convert request.
+#   POST /uploads                    {"filename", "size"[, "sha256"]} -> upload status with the upload id and the
+#                                    offset to continue at
+#   PUT  /uploads/<id>               chunk bytes, Upload-Offset: <offset> header -> status; 409 with the server's
+#                                    offset when it does not match, so the client can continue from there
+#   GET  /uploads/<id>               status
+#   POST /uploads/<id>/finalize      [{"sha256"}] -> status; the server hashes the received file (and checks it
+#                                    against sha256 when given)
+#   POST /convert                    upload_id=<id> (and upload_filename) instead of the file part converts the
+#                                    finalized upload
+# Partial uploads are files under <UPLOAD_STORE_DIR>/partial, so an interrupted upload resumes after a reconnect,
+# a page reload or a server restart (the page keeps the upload id). Upload ids are random, and a finalized upload is
+# stored under its own id in complete/, so only the client that uploaded a file can convert it.
+# With UPLOAD_DEDUP=1 (single-tenant deployments) finalized uploads are stored by content hash instead: initiating
+# an upload with the hash of a stored file answers complete straight away (no transfer), anyone who knows a file's
+# SHA-256 can convert it, and web_conversion.py keeps conversion results under results/ by input hash and
+# parameters, so an identical conversion is not run twice.
+
+_BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+UPLOAD_STORE_DIR = os.environ.get('CHUNKED_UPLOAD_DIR', os.path.join(_BASE_DIR, 'cache', 'uploads'))
+# Chunk size suggested to clients; every chunk is one request, so it must stay under MAX_CONTENT_LENGTH
+UPLOAD_CHUNK_BYTES = int(float(os.environ.get('CHUNKED_UPLOAD_CHUNK_MB', '4')) * 1024 * 1024)
+UPLOAD_MAX_BYTES = int(float(os.environ.get('CHUNKED_UPLOAD_MAX_MB', '512')) * 1024 * 1024)
+# Partial uploads not continued for this long, and stored uploads and results not used for this long, are removed
+PARTIAL_RETENTION_SECONDS = int(float(os.environ.get('CHUNKED_UPLOAD_PARTIAL_HOURS', '24')) * 3600)
+STORE_RETENTION_SECONDS = int(float(os.environ.get('CHUNKED_UPLOAD_RETENTION_DAYS', '7')) * 86400)
+UPLOAD_DEDUP = os.environ.get('UPLOAD_DEDUP', '').lower() in ('1', 'true', 'yes')
+UPLOAD_EXTENSIONS = SUPPORTED_HOLDINGS_EXTENSIONS
+_UPLOAD_ID_PATTERN = re.compile(r'^[0-9a-f]{32}$')  # secrets.token_hex(16)
+_SHA256_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+
+class UploadError(ValueError):
+    """A chunked-upload request that cannot be served; status is the HTTP status to answer with and offset (when
+    set) the number of bytes the server holds."""
+
+    def __init__(self, message, status=400, offset=None):
+        super().__init__(message)
+        self.status = status
+        self.offset = offset
+
+    def as_dict(self):
+        return {"error": str(self), **({"offset": self.offset} if self.offset is not None else {})}
+
+def normalize_sha256(value):
+    """Lower-case hex SHA-256, or None when value is not one."""
+    value = str(value or '').strip().lower()
+    return value if _SHA256_PATTERN.match(value) else None
+
+def _read_json(path):
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def _write_json(path, data):
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+def link_or_copy(source, destination):
+    """Hard-links source to destination (copies across file systems), replacing destination."""
+    if os.path.exists(destination):
+        os.remove(destination)
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
+
+class StoredUpload:
+    """A finalized upload, in the shape the web apps expect from an uploaded file: filename and save(path)."""
+
+    def __init__(self, path, filename, sha256):
+        self.path = path
+        self.filename = filename
+        self.sha256 = sha256
+
+    def save(self, destination):
+        link_or_copy(self.path, destination)
+
+class UploadStore:
+    """Partial uploads, finalized uploads and conversion results by key, under one directory: partial/<id>.part +
+    <id>.json, complete/<id> + <id>.json (<sha256> + <sha256>.json with dedup), results/<key>/."""
+
+    def __init__(self, root=UPLOAD_STORE_DIR, chunk_bytes=UPLOAD_CHUNK_BYTES, max_bytes=UPLOAD_MAX_BYTES, dedup=UPLOAD_DEDUP):
+        self.root = root
+        self.chunk_bytes = chunk_bytes
+        self.max_bytes = max_bytes
+        self.dedup = dedup
+        self.partial_dir = os.path.join(root, 'partial')
+        self.complete_dir = os.path.join(root, 'complete')
+        self.results_dir = os.path.join(root, 'results')
+        for directory in (self.partial_dir, self.complete_dir, self.results_dir):
+            os.makedirs(directory, exist_ok=True)
+
+    # --- Paths and status ---
+    def _valid_id(self, upload_id):
+        """upload_id when it is a random upload id, or (with dedup only) a content hash; otherwise None."""
+        upload_id = str(upload_id or '').strip().lower()
+        if _UPLOAD_ID_PATTERN.match(upload_id) or (self.dedup and _SHA256_PATTERN.match(upload_id)):
+            return upload_id
+        return None
+
+    def _partial_paths(self, upload_id):
+        upload_id = self._valid_id(upload_id)
+        if upload_id is None:
+            raise UploadError("Unknown upload.", 404)
+        base = os.path.join(self.partial_dir, upload_id)
+        return base + '.part', base + '.json'
+
+    def _complete_paths(self, upload_id):
+        base = os.path.join(self.complete_dir, upload_id)
+        return base, base + '.json'
+
+    def _status(self, upload_id, meta, offset, complete):
+        return {"upload_id": upload_id, "filename": meta["filename"], "size": meta["size"], "offset": offset,
+                "complete": complete, "sha256": meta.get("sha256"), "chunk_size": self.chunk_bytes}
+
+    def stored_upload(self, upload_id, filename=None):
+        """The finalized upload with this id, or None. Content hashes are ids only with dedup, where filename
+        replaces the name the file was first uploaded under (an identical file another user uploaded is converted
+        under this user's name)."""
+        upload_id = self._valid_id(upload_id)
+        if upload_id is None:
+            return None
+        path, meta_path = self._complete_paths(upload_id)
+        meta = _read_json(meta_path)
+        if meta is None or not os.path.exists(path):
+            return None
+        os.utime(meta_path)  # Last used, for retention
+        return StoredUpload(path, os.path.basename(str(filename or meta["filename"]).replace('\\', '/')),
+                            meta.get("sha256") or upload_id)
+
+    def status(self, upload_id):
+        stored = self.stored_upload(upload_id)
+        if stored is not None:
+            size = os.path.getsize(stored.path)
+            return self._status(upload_id, {"filename": stored.filename, "size": size, "sha256": stored.sha256}, size, True)
+        part_path, meta_path = self._partial_paths(upload_id)
+        meta = _read_json(meta_path)
+        if meta is None:
+            raise UploadError("Unknown upload.", 404)
+        return self._status(upload_id, meta, os.path.getsize(part_path) if os.path.exists(part_path) else 0, False)
+
+    # --- Upload steps ---
+    def initiate(self, filename, size, sha256=None):
+        """Starts an upload under a new random id; the client continues an interrupted upload with that id.
+        sha256, when given, is checked at finalize. With dedup and sha256 the upload id is the hash instead, so the
+        same file resumes where it stopped (from any client), and a file already stored is complete at once."""
+        filename = os.path.basename(str(filename or '').replace('\\', '/')).strip()
+        if not filename.lower().endswith(UPLOAD_EXTENSIONS):
+            raise UploadError(f"Invalid file type. Please upload a {', '.join(UPLOAD_EXTENSIONS)} file.")
+        try:
+            size = int(size)
+        except (TypeError, ValueError):
+            raise UploadError("The upload size is missing or not a number.")
+        if size <= 0:
+            raise UploadError("The file is empty.")
+        if size > self.max_bytes:
+            raise UploadError(f"The file is larger than the {self.max_bytes // (1024 * 1024)} MB upload limit.", 413)
+        if sha256 is not None and not normalize_sha256(sha256):
+            raise UploadError("sha256 must be 64 hexadecimal characters.")
+        sha256 = normalize_sha256(sha256)
+        self.prune()
+
+        if sha256 and self.dedup:
+            stored = self.stored_upload(sha256)
+            if stored is not None and os.path.getsize(stored.path) == size:
+                print(f"Upload of '{filename}' skipped: identical content already stored ({sha256[:12]}).")
+                return {**self._status(sha256, {"filename": filename, "size": size, "sha256": sha256}, size, True),
+                        "deduplicated": True}
+        upload_id = sha256 if sha256 and self.dedup else secrets.token_hex(16)
+        part_path, meta_path = self._partial_paths(upload_id)
+        meta = _read_json(meta_path)
+        if meta is None or meta["size"] != size:
+            meta = {"filename": filename, "size": size, "sha256": sha256, "created": time.time()}
+            with open(part_path, 'wb'):
+                pass
+            _write_json(meta_path, meta)
+        return self._status(upload_id, meta, os.path.getsize(part_path), False)
+
+    def append(self, upload_id, offset, data):
+        """Writes one chunk at offset, which must be where the partial upload ends. Returns the status."""
+        part_path, meta_path = self._partial_paths(upload_id)
+        meta = _read_json(meta_path)
+        if meta is None or not os.path.exists(part_path):
+            raise UploadError("Unknown upload.", 404)
+        try:
+            offset = int(offset)
+        except (TypeError, ValueError):
+            raise UploadError("The Upload-Offset header is missing or not a number.")
+        with open(part_path, 'r+b') as part:
+            if fcntl is not None:
+                fcntl.flock(part, fcntl.LOCK_EX)  # Two clients continuing the same upload append one at a time
+            current = part.seek(0, os.SEEK_END)
+            if offset != current:
+                raise UploadError(f"The upload continues at byte {current}, not {offset}.", 409, current)
+            if current + len(data) > meta["size"]:
+                raise UploadError(f"The chunk goes past the announced size of {meta['size']} bytes.", 400, current)
+            part.write(data)
+            part.flush()
+            offset = part.tell()
+        os.utime(meta_path)
+        return self._status(upload_id, meta, offset, False)
+
+    def finalize(self, upload_id, sha256=None):
+        """Hashes the complete upload and moves it into the store, under its upload id (by content hash with
+        dedup). The expected sha256, from this call or initiate, must match; a mismatch discards the upload (it
+        has to start over). Returns the status, whose upload_id is what /convert takes."""
+        if sha256 is not None and not normalize_sha256(sha256):
+            raise UploadError("sha256 must be 64 hexadecimal characters.")
+        status = self.status(upload_id)
+        if status["complete"]:
+            return status
+        part_path, meta_path = self._partial_paths(upload_id)
+        meta = _read_json(meta_path)
+        if status["offset"] != meta["size"]:
+            raise UploadError(f"The upload is incomplete: {status['offset']} of {meta['size']} bytes received.", 409, status["offset"])
+        actual = file_content_hash(part_path)
+        expected = normalize_sha256(sha256) or meta.get("sha256")
+        if expected and actual != expected:
+            self.discard(upload_id)
+            raise UploadError(f"Content hash mismatch: the received file has SHA-256 {actual}. Upload it again.", 422)
+        stored_id = actual if self.dedup else self._valid_id(upload_id)
+        path, complete_meta_path = self._complete_paths(stored_id)
+        os.replace(part_path, path)
+        _write_json(complete_meta_path, {"filename": meta["filename"], "size": meta["size"], "sha256": actual, "stored": time.time()})
+        os.remove(meta_path)
+        print(f"Upload '{meta['filename']}' finalized: {meta['size']} bytes, SHA-256 {actual}.")
+        return self._status(stored_id, {**meta, "sha256": actual}, meta["size"], True)
+
+    def discard(self, upload_id):
+        for path in self._partial_paths(upload_id):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    # --- Conversion results ---
+    def load_result(self, key):
+        """(result, {name: path}) saved under key, or None."""
+        result_dir = os.path.join(self.results_dir, key)
+        saved = _read_json(os.path.join(result_dir, 'result.json'))
+        if saved is None:
+            return None
+        files = {name: os.path.join(result_dir, name) for name in saved["files"]}
+        if not all(os.path.exists(path) for path in files.values()):
+            return None
+        os.utime(os.path.join(result_dir, 'result.json'))
+        return saved["result"], files
+
+    def save_result(self, key, result, files):
+        """Saves a JSON-serializable result and copies of files ({name: path}) under key."""
+        result_dir = os.path.join(self.results_dir, key)
+        tmp_dir = f"{result_dir}.{os.getpid()}.{threading.get_ident()}.tmp"
+        os.makedirs(tmp_dir, exist_ok=True)
+        for name, path in files.items():
+            link_or_copy(path, os.path.join(tmp_dir, name))
+        _write_json(os.path.join(tmp_dir, 'result.json'), {"result": result, "files": sorted(files)})
+        shutil.rmtree(result_dir, ignore_errors=True)
+        try:
+            os.replace(tmp_dir, result_dir)
+        except OSError:
+            shutil.rmtree(tmp_dir, ignore_errors=True)  # Saved by another worker in the meantime
+
+    # --- Retention ---
+    def prune(self):
+        """Removes partial uploads idle for PARTIAL_RETENTION_SECONDS and stored uploads and results not used
+        for STORE_RETENTION_SECONDS."""
+        now = time.time()
+        for directory, retention in ((self.partial_dir, PARTIAL_RETENTION_SECONDS), (self.complete_dir, STORE_RETENTION_SECONDS)):
+            for entry in os.scandir(directory):
+                if not entry.name.endswith('.json'):
+                    continue
+                try:
+                    if entry.stat().st_mtime < now - retention:
+                        base = entry.path[:-len('.json')]
+                        for path in (entry.path, base, base + '.part'):
+                            if os.path.exists(path):
+                                os.remove(path)
+                except OSError:
+                    pass  # Removed by another process in the meantime
+        for entry in os.scandir(self.results_dir):
+            try:
+                if os.stat(os.path.join(entry.path, 'result.json')).st_mtime < now - STORE_RETENTION_SECONDS:
+                    shutil.rmtree(entry.path, ignore_errors=True)
+            except OSError:
+                pass
+
+_shared_store = None
+_shared_lock = threading.Lock()
+
+def shared_upload_store():
+    """The process-wide UploadStore used by the web apps, created on first use."""
+    global _shared_store
+    with _shared_lock:
+        if _shared_store is None:
+            _shared_store = UploadStore()
+        return _shared_store
+
+def main():
+    parser = argparse.ArgumentParser(description="Show or prune the chunked-upload store.")
+    parser.add_argument("--root", default=UPLOAD_STORE_DIR, help="Upload store directory.")
+    parser.add_argument("--prune", action="store_true", help="Remove expired partial uploads, stored uploads and results.")
+    args = parser.parse_args()
+
+    store = UploadStore(args.root)
+    if args.prune:
+        store.prune()
+    for label, directory in (("Partial uploads", store.partial_dir), ("Stored uploads", store.complete_dir)):
+        entries = [name for name in os.listdir(directory) if name.endswith('.json')]
+        print(f"{label}: {len(entries)}")
+        for name in sorted(entries):
+            meta = _read_json(os.path.join(directory, name)) or {}
+            print(f"  {name[:-len('.json')]}  {meta.get('filename')}  {meta.get('size')} bytes")
+    print(f"Saved conversion results: {len(os.listdir(store.results_dir))}")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
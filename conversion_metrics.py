@@ -0,0 +1,183 @@
+import os
+import time
+import functools
+from contextlib import contextmanager
+
+# prometheus_client's multiprocess mode must be configured before the library is imported: when
+# PROMETHEUS_MULTIPROC_DIR is set, every process (gunicorn workers, batch worker processes) writes its samples to
+# memory-mapped files in that directory and /metrics merges them. gunicorn.conf.py sets this up for production.
+if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+    os.makedirs(os.environ['PROMETHEUS_MULTIPROC_DIR'], exist_ok=True)
+
+try:
+    import prometheus_client
+    from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, multiprocess
+except ImportError:  # Metrics are optional; without prometheus_client every recorder below is a no-op
+    prometheus_client = None
+    Counter = Gauge = Histogram = None
+
+METRICS_ENABLED = prometheus_client is not None and os.environ.get('METRICS_DISABLED', '').lower() not in ('1', 'true', 'yes')
+
+# What "items" means for each conversion type when reporting throughput
+ITEM_UNITS = {'13F': 'rows', '6151': 'venues'}
+
+_STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+_SIZE_BUCKETS = tuple(2 ** power for power in range(10, 31, 2))  # 1 KB .. 1 GB
+_RATE_BUCKETS = (10, 50, 100, 500, 1000, 5000, 10000, 50000, 100000, 500000, 1000000)
+
+class _NullMetric:
+    """Stands in for a metric when prometheus_client is unavailable or metrics are disabled."""
+
+    def labels(self, *args, **kwargs):
+        return self
+
+    def observe(self, value):
+        pass
+
+    def inc(self, amount=1):
+        pass
+
+    def dec(self, amount=1):
+        pass
+
+def _metric(metric_class, name, documentation, labelnames, **kwargs):
+    if not METRICS_ENABLED:
+        return _NullMetric()
+    return metric_class(name, documentation, labelnames, **kwargs)
+
+# --- Metric definitions ---
+STAGE_SECONDS = _metric(Histogram, 'edgar_converter_stage_seconds',
+                        'Time spent in each conversion stage (read, build, serialize, validate).',
+                        ['conversion_type', 'stage'], buckets=_STAGE_BUCKETS)
+CONVERSION_SECONDS = _metric(Histogram, 'edgar_converter_conversion_seconds',
+                             'End-to-end conversion time.', ['conversion_type'], buckets=_STAGE_BUCKETS)
+INPUT_BYTES = _metric(Histogram, 'edgar_converter_input_bytes',
+                      'Size of converted input files.', ['conversion_type'], buckets=_SIZE_BUCKETS)
+ITEMS_PER_SECOND = _metric(Histogram, 'edgar_converter_items_per_second',
+                           'Rows (13F) or venues (6151) written per second of conversion time.',
+                           ['conversion_type', 'unit'], buckets=_RATE_BUCKETS)
+ITEMS_TOTAL = _metric(Counter, 'edgar_converter_items',
+                      'Rows (13F) or venues (6151) written.', ['conversion_type', 'unit'])
+CONVERSIONS_TOTAL = _metric(Counter, 'edgar_converter_conversions',
+                            'Finished conversions by outcome (success, invalid, error).', ['conversion_type', 'outcome'])
+ERRORS_TOTAL = _metric(Counter, 'edgar_converter_errors',
+                       'Conversion errors by exception type (schema_invalid for XML that failed XSD validation).',
+                       ['conversion_type', 'error_type'])
+CACHE_REQUESTS_TOTAL = _metric(Counter, 'edgar_converter_cache_requests',
+                               'Lookups in the parsed-workbook cache (hit, miss, disabled). '
+                               'Hit ratio: rate(hit) / rate(hit + miss).', ['cache', 'result'])
+SCHEDULER_REJECTIONS_TOTAL = _metric(Counter, 'edgar_converter_scheduler_rejections',
+                                     'Conversions turned away by the scheduler (queue_full, firm_limit, memory).', ['reason'])
+# livesum: the value is the sum over processes that are still running, which is what a queue depth should be
+IN_PROGRESS = _metric(Gauge, 'edgar_converter_conversions_in_progress',
+                      'Conversions currently running.', ['conversion_type'], multiprocess_mode='livesum')
+QUEUE_DEPTH = _metric(Gauge, 'edgar_converter_queue_depth',
+                      'Conversions submitted but not yet finished (batch) or not yet started (scheduler).', ['queue'], multiprocess_mode='livesum')
+
+# --- Recording helpers ---
+@contextmanager
+def stage_timer(conversion_type, stage):
+    """Times one stage of a conversion into edgar_converter_stage_seconds."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.labels(conversion_type, stage).observe(time.perf_counter() - started)
+
+def observe_stage(conversion_type, stage, seconds):
+    STAGE_SECONDS.labels(conversion_type, stage).observe(seconds)
+
+@contextmanager
+def track_conversion(conversion_type, input_path):
+    """Wraps a whole conversion: in-progress gauge, input size, total time and outcome.
+    The caller sets record["items"] (rows/venues written) and may set record["outcome"] (e.g. 'invalid').
+    An exception escaping the block is counted under its class name and re-raised."""
+    record = start_conversion(conversion_type, input_path)
+    try:
+        yield record
+    except Exception as e:
+        record["outcome"] = "error"
+        record_error(conversion_type, type(e).__name__)
+        raise
+    finally:
+        finish_conversion(conversion_type, record)
+
+def start_conversion(conversion_type, input_path):
+    """First half of track_conversion, for conversions whose stages run in different threads or processes
+    (batch_pipeline.py). Returns the record to update and pass to finish_conversion."""
+    try:
+        INPUT_BYTES.labels(conversion_type).observe(os.path.getsize(input_path))
+    except OSError:
+        pass
+    IN_PROGRESS.labels(conversion_type).inc()
+    return {"items": 0, "outcome": "success", "started": time.perf_counter()}
+
+def finish_conversion(conversion_type, record):
+    elapsed = time.perf_counter() - record["started"]
+    IN_PROGRESS.labels(conversion_type).dec()
+    CONVERSION_SECONDS.labels(conversion_type).observe(elapsed)
+    CONVERSIONS_TOTAL.labels(conversion_type, record["outcome"]).inc()
+    if record["outcome"] != "error" and record["items"]:
+        unit = ITEM_UNITS.get(conversion_type, 'items')
+        ITEMS_TOTAL.labels(conversion_type, unit).inc(record["items"])
+        if elapsed > 0:
+            ITEMS_PER_SECOND.labels(conversion_type, unit).observe(record["items"] / elapsed)
+
+def tracked_conversion(conversion_type, count_items):
+    """Decorator form of track_conversion for converter entry points whose first argument is the input path.
+    count_items(result) returns the number of rows/venues the call wrote."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(input_path, *args, **kwargs):
+            with track_conversion(conversion_type, input_path) as record:
+                result = func(input_path, *args, **kwargs)
+                record["items"] = count_items(result)
+                return result
+        return wrapper
+    return decorator
+
+def timed_iteration(iterable, totals, key):
+    """Yields from iterable, adding the time spent producing each item to totals[key].
+    Used to split streamed conversions, where reading and writing interleave, into stages."""
+    iterator = iter(iterable)
+    while True:
+        started = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            totals[key] += time.perf_counter() - started
+            return
+        totals[key] += time.perf_counter() - started
+        yield item
+
+def record_error(conversion_type, error_type):
+    ERRORS_TOTAL.labels(conversion_type, error_type).inc()
+
+def record_rejection(reason):
+    SCHEDULER_REJECTIONS_TOTAL.labels(reason).inc()
+
+def record_cache_lookup(cache, result):
+    CACHE_REQUESTS_TOTAL.labels(cache, result).inc()
+
+def queue_changed(queue, delta):
+    if delta >= 0:
+        QUEUE_DEPTH.labels(queue).inc(delta)
+    else:
+        QUEUE_DEPTH.labels(queue).dec(-delta)
+
+# --- Exposition ---
+def render_metrics():
+    """Returns (body, content_type) in the Prometheus text format, merged across processes in multiprocess mode."""
+    if prometheus_client is None:
+        return b"# prometheus_client is not installed; metrics are unavailable.\n", 'text/plain; charset=utf-8'
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = prometheus_client.REGISTRY
+    return prometheus_client.generate_latest(registry), prometheus_client.CONTENT_TYPE_LATEST
+
+def mark_process_dead(pid):
+    """Called from the gunicorn child_exit hook so live gauges of exited workers are dropped."""
+    if prometheus_client is not None and os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        multiprocess.mark_process_dead(pid)
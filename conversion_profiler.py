@@ -0,0 +1,146 @@
+import os
+import sys
+import hmac
+import pstats
+import cProfile
+import argparse
+import functools
+import threading
+import collections
+
+# Opt-in profiling of single conversions, for finding out why one client's workbook is slow without reproducing
+# it locally. A profiled run writes two files next to its output:
+#   <output>.prof            cProfile statistics (python -m pstats, snakeviz, or `python conversion_profiler.py`)
+#   <output>.collapsed.txt   stack samples in the collapsed format flamegraph.pl / speedscope read ("a;b;c 42")
+# Profiling is turned on per call (profile=True, --profile on the converter command lines), for every conversion
+# (CONVERSION_PROFILE=1), or from the web form with profile=1 when the request carries PROFILE_ADMIN_TOKEN.
+
+CONVERSION_PROFILE = os.environ.get('CONVERSION_PROFILE', '').lower() in ('1', 'true', 'yes')
+# Web requests may ask for a profile only with this token (X-Admin-Token header or admin_token form field);
+# unset = web requests cannot turn profiling on
+PROFILE_ADMIN_TOKEN = os.environ.get('PROFILE_ADMIN_TOKEN', '')
+# Time between stack samples for the collapsed-stack file
+PROFILE_SAMPLE_INTERVAL_SECONDS = float(os.environ.get('PROFILE_SAMPLE_INTERVAL_MS', '5')) / 1000
+PSTATS_SUFFIX = '.prof'
+COLLAPSED_SUFFIX = '.collapsed.txt'
+
+def profile_paths(output_path):
+    """(pstats file, collapsed-stack file) written for a profiled conversion with this output file."""
+    base = os.path.splitext(output_path)[0]
+    return base + PSTATS_SUFFIX, base + COLLAPSED_SUFFIX
+
+def profiling_allowed(requested, admin_token=None):
+    """Whether a web request gets a profile: always with CONVERSION_PROFILE, otherwise only when it asks for one
+    and presents the admin token."""
+    if CONVERSION_PROFILE:
+        return True
+    return bool(requested and PROFILE_ADMIN_TOKEN and admin_token
+                and hmac.compare_digest(str(admin_token), PROFILE_ADMIN_TOKEN))
+
+def _frame_label(code):
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+class _StackSampler(threading.Thread):
+    """Samples one thread's call stack every interval, counting identical stacks."""
+
+    def __init__(self, thread_id, interval):
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self._stop_sampling = threading.Event()
+
+    def run(self):
+        while not self._stop_sampling.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            labels = []
+            while frame is not None:
+                labels.append(_frame_label(frame.f_code))
+                frame = frame.f_back
+            if labels:
+                self.stacks[";".join(reversed(labels))] += 1
+
+    def stop(self):
+        self._stop_sampling.set()
+        self.join()
+
+class ConversionProfile:
+    """Context manager profiling the calling thread with cProfile and a stack sampler; save(output_path) writes
+    both files. Nested profiles are no-ops, so a profiled converter may call another profiled one."""
+
+    _active = threading.local()
+
+    def __init__(self, sample_interval=PROFILE_SAMPLE_INTERVAL_SECONDS):
+        self.sample_interval = sample_interval
+        self.profiler = None
+        self.sampler = None
+
+    def __enter__(self):
+        if getattr(self._active, 'profile', None) is not None:
+            return self
+        self._active.profile = self
+        self.sampler = _StackSampler(threading.get_ident(), self.sample_interval)
+        self.sampler.start()
+        self.profiler = cProfile.Profile()
+        self.profiler.enable()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.profiler is None:
+            return False
+        self.profiler.disable()
+        self.sampler.stop()
+        self._active.profile = None
+        return False
+
+    def save(self, output_path):
+        """Writes the pstats and collapsed-stack files next to output_path; returns their paths (None when this
+        was a nested no-op profile)."""
+        if self.profiler is None:
+            return None
+        pstats_path, collapsed_path = profile_paths(output_path)
+        os.makedirs(os.path.dirname(pstats_path) or '.', exist_ok=True)
+        self.profiler.dump_stats(pstats_path)
+        with open(collapsed_path, 'w') as collapsed:
+            for stack, count in self.sampler.stacks.most_common():
+                collapsed.write(f"{stack} {count}\n")
+        print(f"Profile saved: '{pstats_path}' (pstats), '{collapsed_path}' (collapsed stacks, {sum(self.sampler.stacks.values())} samples)")
+        return pstats_path, collapsed_path
+
+def profiled_conversion(output_path_of):
+    """Decorator for converter entry points: adds a profile keyword (default CONVERSION_PROFILE) that runs the
+    call under ConversionProfile. output_path_of(args, kwargs, result) names the file the profile is saved next
+    to; result is None when the conversion raised (the profile is still saved, then the exception propagates)."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, profile=None, **kwargs):
+            if not (CONVERSION_PROFILE if profile is None else profile):
+                return func(*args, **kwargs)
+            conversion_profile, result = ConversionProfile(), None
+            try:
+                with conversion_profile:
+                    result = func(*args, **kwargs)
+            finally:
+                conversion_profile.save(output_path_of(args, kwargs, result))
+            return result
+        return wrapper
+    return decorator
+
+def output_argument(name, position):
+    """output_path_of for converters that take the output path as an argument."""
+    return lambda args, kwargs, result: kwargs[name] if name in kwargs else args[position]
+
+def print_profile(pstats_path, sort='cumulative', limit=30):
+    stats = pstats.Stats(pstats_path)
+    stats.strip_dirs().sort_stats(sort).print_stats(limit)
+
+def main():
+    parser = argparse.ArgumentParser(description="Show the slowest functions of a saved conversion profile.")
+    parser.add_argument("pstats_path", help=f"A {PSTATS_SUFFIX} file written by a profiled conversion.")
+    parser.add_argument("--sort", default="cumulative", help="pstats sort key (cumulative, tottime, calls, ...).")
+    parser.add_argument("--limit", type=int, default=30, help="Functions to show.")
+    args = parser.parse_args()
+    print_profile(args.pstats_path, args.sort, args.limit)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,213 @@
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import threading
+from contextlib import contextmanager
+
+# Progress of running conversions, shown by the page while /convert is still waiting for the result.
+# Converters report how far they are (rows read, rows emitted, 6151 sections parsed, validation started and
+# finished) with report_progress() / count_progress(). Inside a conversion run with a progress id these go to
+# <PROGRESS_FOLDER>/<id>.json, written at most once every PROGRESS_INTERVAL_SECONDS (stage changes straight away).
+# asgi_app.py's /progress/<id> streams that file's changes as server-sent events; app.py's answers with the current
+# state as JSON (current_progress), which the page polls every PROGRESS_CLIENT_POLL_MS, so no thread of a threaded
+# worker is held by an open stream.
+# Without a progress id (command line, batch runs) both calls return immediately.
+# Progress goes through a file because conversions run in the scheduler's worker processes, and under gunicorn
+# the event stream may be served by a different web worker than the /convert request.
+
+_BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+PROGRESS_FOLDER = os.environ.get('CONVERSION_PROGRESS_DIR', os.path.join(_BASE_DIR, 'cache', 'progress'))
+# Shortest time between two writes of a conversion's progress file
+PROGRESS_INTERVAL_SECONDS = float(os.environ.get('CONVERSION_PROGRESS_INTERVAL_MS', '500')) / 1000
+# How often event streams look for changes, and how long one stream stays open at most
+PROGRESS_POLL_SECONDS = max(0.1, PROGRESS_INTERVAL_SECONDS / 2)
+PROGRESS_STREAM_MAX_SECONDS = int(os.environ.get('CONVERSION_PROGRESS_STREAM_MAX_SECONDS', '900'))
+# How often the page asks app.py's JSON endpoint for the progress
+PROGRESS_CLIENT_POLL_MS = int(os.environ.get('CONVERSION_PROGRESS_CLIENT_POLL_MS', '1000'))
+# Comment lines sent this often keep proxies from closing a quiet stream
+PROGRESS_KEEPALIVE_SECONDS = 15
+# Progress files older than this are removed when a new conversion starts
+PROGRESS_RETENTION_SECONDS = 3600
+PROGRESS_ID_PATTERN = re.compile(r'^[A-Za-z0-9_-]{8,64}$')
+# Stages after which a conversion reports nothing more
+FINAL_STAGES = ('finished', 'failed')
+
+def valid_progress_id(progress_id):
+    """progress_id when it is usable as a file name (letters, digits, _ and -), otherwise None."""
+    return progress_id if progress_id and PROGRESS_ID_PATTERN.match(str(progress_id)) else None
+
+def progress_file(progress_id, folder=None):
+    return os.path.join(folder or PROGRESS_FOLDER, f"{progress_id}.json")
+
+def _write_state(path, state):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as progress:
+        json.dump(state, progress, separators=(',', ':'))
+    os.replace(tmp_path, path)
+
+def read_progress(progress_id, folder=None):
+    """The last written progress of a conversion, or None when it has not reported yet."""
+    try:
+        with open(progress_file(progress_id, folder), encoding='utf-8') as progress:
+            return json.load(progress)
+    except (OSError, ValueError):
+        return None
+
+def current_progress(progress_id, folder=None):
+    """The last written progress, or {"progress_id", "stage": None} while the conversion has not reported yet
+    (the upload is still in progress or the conversion has not been accepted)."""
+    return read_progress(progress_id, folder) or {"progress_id": progress_id, "stage": None}
+
+def prune_progress(folder=None, older_than_seconds=PROGRESS_RETENTION_SECONDS):
+    folder = folder or PROGRESS_FOLDER
+    if not os.path.isdir(folder):
+        return
+    cutoff = time.time() - older_than_seconds
+    for entry in os.scandir(folder):
+        try:
+            if entry.is_file() and entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+        except OSError:
+            pass  # Removed by another process in the meantime
+
+class ProgressReporter:
+    """Stage and counts of one conversion, written to its progress file. Counts are written at most once every
+    interval; a stage change (and close) writes straight away, taking along the counts held back until then."""
+
+    def __init__(self, progress_id, interval=PROGRESS_INTERVAL_SECONDS, folder=None):
+        self.path = progress_file(progress_id, folder)
+        self.interval = interval
+        self.started = time.time()
+        # Continue the sequence of an earlier writer (the web worker that queued the conversion)
+        previous = read_progress(progress_id, folder) or {}
+        self.state = {"progress_id": progress_id, "stage": None, "sequence": previous.get("sequence", 0)}
+        self._last_written = 0.0
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+    def update(self, stage=None, increments=None, **values):
+        """Sets the stage and values, adds increments to counts; writes the file when due."""
+        with self._lock:
+            force = stage is not None and stage != self.state["stage"]
+            if stage is not None:
+                self.state["stage"] = stage
+            self.state.update(values)
+            for name, amount in (increments or {}).items():
+                self.state[name] = self.state.get(name, 0) + amount
+            now = time.monotonic()
+            if force or now - self._last_written >= self.interval:
+                self._write(now)
+
+    def _write(self, now):
+        self._last_written = now
+        self.state["sequence"] += 1
+        self.state["elapsed"] = round(time.time() - self.started, 2)
+        try:
+            _write_state(self.path, self.state)
+        except OSError as e:
+            print(f"Warning: could not write conversion progress to '{self.path}': {e}")
+
+_active = threading.local()
+
+def active_reporter():
+    return getattr(_active, 'reporter', None)
+
+def report_progress(stage=None, **values):
+    """Sets the running conversion's stage and/or values (rows_read=..., valid=...). No-op outside a tracked
+    conversion."""
+    reporter = getattr(_active, 'reporter', None)
+    if reporter is not None:
+        reporter.update(stage, **values)
+
+def count_progress(stage=None, **increments):
+    """Adds to the running conversion's counts (rows_emitted=len(chunk), sections_parsed=1, ...)."""
+    reporter = getattr(_active, 'reporter', None)
+    if reporter is not None:
+        reporter.update(stage, increments)
+
+def start_progress(progress_id, stage='queued', folder=None):
+    """Writes the first progress of a conversion that has been accepted but not started (removing old progress
+    files). Returns the reporter, or None for an unusable progress_id."""
+    if not valid_progress_id(progress_id):
+        return None
+    prune_progress(folder)
+    reporter = ProgressReporter(progress_id, folder=folder)
+    reporter.update(stage)
+    return reporter
+
+def fail_progress(progress_id, error, folder=None):
+    """Marks a conversion that will not run (rejected by the scheduler) as failed."""
+    if valid_progress_id(progress_id):
+        ProgressReporter(progress_id, folder=folder).update('failed', error=str(error))
+
+def finish_progress(progress_id, folder=None, **values):
+    """Marks a conversion that needed no run (its result was already saved) as finished."""
+    if valid_progress_id(progress_id):
+        ProgressReporter(progress_id, folder=folder).update('finished', **values)
+
+@contextmanager
+def tracked_progress(progress_id, folder=None):
+    """Makes report_progress()/count_progress() in this thread write to progress_id's file for the duration of
+    the block, ending with the finished or failed stage. A None or unusable progress_id tracks nothing."""
+    if not valid_progress_id(progress_id) or active_reporter() is not None:
+        yield None
+        return
+    reporter = ProgressReporter(progress_id, folder=folder)
+    _active.reporter = reporter
+    try:
+        reporter.update('started')
+        yield reporter
+    except Exception as e:
+        reporter.update('failed', error=str(e))
+        raise
+    else:
+        reporter.update('finished')
+    finally:
+        _active.reporter = None
+
+# --- Server-sent events ---
+def _event(state):
+    return f"id: {state.get('sequence', 0)}\nevent: progress\ndata: {json.dumps(state, separators=(',', ':'))}\n\n"
+
+def progress_events(progress_id, folder=None, max_seconds=PROGRESS_STREAM_MAX_SECONDS):
+    """Server-sent-events text for each new progress of a conversion, ending after its final stage (or after
+    max_seconds). Yields None whenever the caller should wait PROGRESS_POLL_SECONDS before asking again, so the
+    same generator serves a sync worker (time.sleep) and the event loop (asyncio.sleep)."""
+    deadline = time.monotonic() + max_seconds
+    last_sent = time.monotonic()
+    last_state = None
+    # Reconnect quickly if the connection drops; the page closes the stream itself after the final stage
+    yield "retry: 2000\n\n"
+    while time.monotonic() < deadline:
+        # None while the upload is still in progress or the conversion has not been accepted yet
+        state = read_progress(progress_id, folder)
+        if state is not None and state != last_state:
+            last_state = state
+            last_sent = time.monotonic()
+            yield _event(state)
+            if state.get("stage") in FINAL_STAGES:
+                return
+        if time.monotonic() - last_sent >= PROGRESS_KEEPALIVE_SECONDS:
+            last_sent = time.monotonic()
+            yield ": keep-alive\n\n"
+        yield None
+
+def main():
+    parser = argparse.ArgumentParser(description="Follow the progress of a conversion started with a progress id.")
+    parser.add_argument("progress_id")
+    parser.add_argument("--folder", default=PROGRESS_FOLDER, help="Progress file directory.")
+    args = parser.parse_args()
+    if not valid_progress_id(args.progress_id):
+        parser.error("progress ids are 8-64 letters, digits, '_' or '-'.")
+    for chunk in progress_events(args.progress_id, args.folder):
+        if chunk is None:
+            time.sleep(PROGRESS_POLL_SECONDS)
+        elif chunk.startswith("event:") or chunk.startswith("id:"):
+            print(chunk.split("data: ", 1)[1].strip())
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,352 @@
+import os
+import math
+import time
+import heapq
+import datetime
+import argparse
+import itertools
+import threading
+import calendar
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor
+from xlsx_to_corrected_edgar_xml import create_perfect_edgar_xml, stream_perfect_edgar_xml
+from finra_6151_converter import perform_6151_conversion
+from filings_store import infer_filing_period, infer_client, normalize_period
+from conversion_metrics import queue_changed, record_rejection
+from conversion_progress import tracked_progress
+
+# Scheduling layer in front of the conversion worker processes. During filing windows urgent filings should not
+# wait behind bulk backfills, so instead of first-in first-out:
+#   - every firm has its own priority queue, ordered by urgency relative to today: filings whose deadline is still
+#     open come first, earliest deadline first; backfills of past quarters (deadline already passed) and files
+#     without a known period follow in submission order, so a backfill never holds up a current-quarter filing;
+#   - the next task is the most urgent one among the firms still under their fair share of the workers
+#     (workers / firms with work, at least 1), so a 200-file backfill from one firm leaves room for the others
+#     while an idle pool still runs whatever is queued;
+#   - new work is rejected with SchedulerBusy (and a retry-after estimate) once the queue or memory limits are hit.
+# Each process has its own scheduler, so priority and fair share only work when the requests of all users reach the
+# same process: gunicorn.conf.py runs the Flask app as one worker process with many threads, and asgi_app.py awaits
+# conversions on its event loop. With several web worker processes the limits apply per process.
+
+SCHEDULER_MAX_WORKERS = int(os.environ.get('SCHEDULER_MAX_WORKERS', str(min(4, os.cpu_count() or 1))))
+# Tasks allowed to wait (running ones not included) before submissions are rejected
+SCHEDULER_MAX_QUEUE_DEPTH = int(os.environ.get('SCHEDULER_MAX_QUEUE_DEPTH', '200'))
+# Tasks one firm may have waiting; 0 = only the overall limit applies
+SCHEDULER_MAX_QUEUED_PER_FIRM = int(os.environ.get('SCHEDULER_MAX_QUEUED_PER_FIRM', '0'))
+# Submissions are rejected while the machine has less memory available than this
+SCHEDULER_MIN_FREE_MEMORY_BYTES = int(float(os.environ.get('SCHEDULER_MIN_FREE_MEMORY_MB', '256')) * 1024 * 1024)
+# Used for retry-after estimates until real task durations have been measured
+_DEFAULT_TASK_SECONDS = 10.0
+_MAX_RETRY_AFTER_SECONDS = 300
+# Priority of tasks without a known filing period, and of backfills whose deadline has passed: after every open
+# deadline, in submission order
+_NO_DEADLINE = datetime.date.max
+
+# --- Filing deadlines ---
+# 13F: 45 days after the end of the calendar quarter (Form 13F, Rule 13f-1).
+# 6151: the order routing report is published within one month after the end of the quarter (FINRA Rule 6151).
+def _quarter_end(year, quarter):
+    month = 3 * int(quarter)
+    return datetime.date(int(year), month, calendar.monthrange(int(year), month)[1])
+
+def filing_deadline(conversion_type, year, quarter):
+    quarter_end = _quarter_end(year, quarter)
+    if conversion_type == '13F':
+        return quarter_end + datetime.timedelta(days=45)
+    next_month = quarter_end + datetime.timedelta(days=1)
+    return next_month.replace(day=calendar.monthrange(next_month.year, next_month.month)[1])
+
+def task_priority(deadline, today):
+    """Queue key of a deadline: the deadline while it is still open, otherwise _NO_DEADLINE (backfill)."""
+    return deadline if deadline >= today else _NO_DEADLINE
+
+def task_deadline(conversion_type, kwargs):
+    """Deadline of a task from its parameters: 6151 year/qtr, or the period in a 13F file name."""
+    if conversion_type == '6151' and kwargs.get('year') and kwargs.get('qtr'):
+        return filing_deadline('6151', kwargs['year'], kwargs['qtr'])
+    period = kwargs.get('period') or infer_filing_period(kwargs.get('input_xlsx') or kwargs.get('excel_filepath') or '')
+    if period:
+        period = normalize_period(period)
+        return filing_deadline(conversion_type, period[:4], period[-1])
+    return _NO_DEADLINE
+
+# --- Task types ---
+def run_conversion_task(conversion_type, kwargs):
+    """Runs in a worker process. 13F: create_perfect_edgar_xml, or stream_perfect_edgar_xml with stream=True;
+    6151: perform_6151_conversion. Returns what the converter returns. With a progress_id the converter's
+    progress is published for the page's event stream (conversion_progress.py)."""
+    kwargs = dict(kwargs)
+    with tracked_progress(kwargs.pop('progress_id', None)):
+        if conversion_type == '13F':
+            converter = stream_perfect_edgar_xml if kwargs.pop('stream', False) else create_perfect_edgar_xml
+            # The input path goes first and positionally (the converters are wrapped by tracked_conversion)
+            return converter(kwargs.pop('input_xlsx'), **kwargs)
+        if conversion_type == '6151':
+            return perform_6151_conversion(kwargs.pop('excel_filepath'), **kwargs)
+        raise ValueError(f"Unknown conversion type '{conversion_type}'.")
+
+def dry_run_task(conversion_type, kwargs):
+    """Stand-in for run_conversion_task (main --dry-run): takes a moment and converts nothing, so the order in
+    which queued files run can be checked without the files."""
+    time.sleep(0.2)
+    return {"rows_written": 0}
+
+class SchedulerBusy(Exception):
+    """Raised by ConversionScheduler.submit when the task is not accepted; retry_after is in seconds."""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+# Memory limit and usage of this process's control group: cgroup v2, then v1
+_CGROUP_MEMORY_FILES = [('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory.current'),
+                        ('/sys/fs/cgroup/memory/memory.limit_in_bytes', '/sys/fs/cgroup/memory/memory.usage_in_bytes')]
+# cgroup v1 reports "no limit" as a number close to 2**63
+_CGROUP_NO_LIMIT_BYTES = 1 << 60
+
+def _read_number(path):
+    with open(path) as number_file:
+        text = number_file.read().strip()
+    return None if text == 'max' else int(text)
+
+def cgroup_available_memory_bytes():
+    """Memory left under the container's cgroup limit, or None without a limit (or where it cannot be read)."""
+    for limit_path, usage_path in _CGROUP_MEMORY_FILES:
+        try:
+            limit = _read_number(limit_path)
+            if limit is None or limit >= _CGROUP_NO_LIMIT_BYTES:
+                return None
+            return max(0, limit - _read_number(usage_path))
+        except (OSError, ValueError, TypeError):
+            continue
+    return None
+
+def available_memory_bytes():
+    """Memory available to this process: the smaller of what is left under its cgroup limit (a container sees
+    the host's memory in /proc/meminfo) and MemAvailable from /proc/meminfo. None where neither can be read."""
+    available = []
+    try:
+        with open('/proc/meminfo') as meminfo:
+            for line in meminfo:
+                if line.startswith('MemAvailable:'):
+                    available.append(int(line.split()[1]) * 1024)
+                    break
+    except (OSError, ValueError, IndexError):
+        pass
+    cgroup_available = cgroup_available_memory_bytes()
+    if cgroup_available is not None:
+        available.append(cgroup_available)
+    return min(available) if available else None
+
+class ConversionScheduler:
+    """Deadline-ordered, per-firm fair-share scheduler over a process pool. submit() returns a Future of the
+    converter's return value; status() describes the queues. today returns the date open deadlines are judged by."""
+
+    def __init__(self, max_workers=SCHEDULER_MAX_WORKERS, max_queue_depth=SCHEDULER_MAX_QUEUE_DEPTH,
+                 max_queued_per_firm=SCHEDULER_MAX_QUEUED_PER_FIRM, min_free_memory_bytes=SCHEDULER_MIN_FREE_MEMORY_BYTES,
+                 task_function=run_conversion_task, today=datetime.date.today):
+        self.max_workers = max(1, int(max_workers))
+        self.max_queue_depth = max_queue_depth
+        self.max_queued_per_firm = max_queued_per_firm
+        self.min_free_memory_bytes = min_free_memory_bytes
+        self.task_function = task_function
+        self.today = today
+        self._queues = {}   # firm -> heap of (task_priority, sequence, task)
+        self._running = {}  # firm -> running task count
+        self._queued = 0
+        self._sequence = itertools.count()
+        self._average_seconds = _DEFAULT_TASK_SECONDS
+        self._condition = threading.Condition()
+        self._closed = False
+        # Worker processes come from a fork server rather than being forked from the web worker in the middle of a
+        # request: a forked child would inherit the client's socket and keep the connection open after the response
+        self._executor = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=multiprocessing.get_context('forkserver'))
+        self._dispatcher = threading.Thread(target=self._dispatch, daemon=True)
+        self._dispatcher.start()
+
+    # --- Submitting ---
+    def submit(self, conversion_type, firm=None, deadline=None, **kwargs):
+        """Queues a conversion. firm defaults to the 6151 firm name or the client in the 13F file name; deadline
+        (a date) defaults to the filing deadline of the task's period. Raises SchedulerBusy when rejected."""
+        if conversion_type not in ('13F', '6151'):
+            raise ValueError(f"Unknown conversion type '{conversion_type}'.")
+        firm = str(firm or kwargs.get('firm_name') or infer_client(kwargs.get('input_xlsx') or '') or 'default').strip().lower()
+        deadline = deadline or task_deadline(conversion_type, kwargs)
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("The scheduler has been shut down.")
+            self._admit(firm)
+            task = {"task_id": next(self._sequence), "conversion_type": conversion_type, "firm": firm,
+                    "deadline": deadline, "kwargs": kwargs, "submitted": time.monotonic(), "future": Future()}
+            heapq.heappush(self._queues.setdefault(firm, []), (task_priority(deadline, self.today()), task["task_id"], task))
+            self._queued += 1
+            queue_changed('scheduler', 1)
+            self._condition.notify_all()
+        return task["future"]
+
+    def _admit(self, firm):
+        """Raises SchedulerBusy if a new task for firm may not be queued now. Called with the lock held."""
+        if self._queued >= self.max_queue_depth:
+            self._reject('queue_full', f"{self._queued} conversions are already waiting.")
+        firm_queued = len(self._queues.get(firm, ()))
+        if self.max_queued_per_firm and firm_queued >= self.max_queued_per_firm:
+            self._reject('firm_limit', f"'{firm}' already has {firm_queued} conversions waiting.", firm_queued)
+        free_memory = available_memory_bytes()
+        if self.min_free_memory_bytes and free_memory is not None and free_memory < self.min_free_memory_bytes:
+            self._reject('memory', f"Only {free_memory // (1024 * 1024)} MB of memory is available.")
+
+    def _reject(self, reason, message, backlog=None):
+        retry_after = self.retry_after(backlog)
+        record_rejection(reason)
+        raise SchedulerBusy(f"Conversion queue is busy: {message} Retry in {retry_after} s.", retry_after)
+
+    def retry_after(self, backlog=None):
+        """Seconds until roughly `backlog` tasks (default: everything queued or running) have been worked off."""
+        if backlog is None:
+            backlog = self._queued + sum(self._running.values())
+        seconds = math.ceil(max(1, backlog) / self.max_workers * self._average_seconds)
+        return max(1, min(_MAX_RETRY_AFTER_SECONDS, seconds))
+
+    # --- Dispatching ---
+    def _expire_deadlines(self):
+        """Moves tasks whose deadline passed while they waited into the backfill tier. Called with the lock held."""
+        today = self.today()
+        for queue in self._queues.values():
+            while queue and queue[0][0] < today:
+                _, sequence, task = heapq.heappop(queue)
+                heapq.heappush(queue, (_NO_DEADLINE, sequence, task))
+
+    def _next_task(self):
+        """Pops the task to run next, or returns None. Called with the lock held."""
+        if sum(self._running.values()) >= self.max_workers:
+            return None
+        self._expire_deadlines()
+        active_firms = {firm for firm, queue in self._queues.items() if queue} | {firm for firm, count in self._running.items() if count}
+        fair_share = max(1, math.ceil(self.max_workers / max(1, len(active_firms))))
+        candidates = [(queue[0][0], self._running.get(firm, 0), queue[0][1], firm)
+                      for firm, queue in self._queues.items() if queue and self._running.get(firm, 0) < fair_share]
+        if not candidates:
+            return None
+        firm = min(candidates)[3]
+        _, _, task = heapq.heappop(self._queues[firm])
+        self._queued -= 1
+        queue_changed('scheduler', -1)
+        self._running[firm] = self._running.get(firm, 0) + 1
+        return task
+
+    def _dispatch(self):
+        while True:
+            with self._condition:
+                task = self._next_task()
+                while task is None and not self._closed:
+                    self._condition.wait()
+                    task = self._next_task()
+                if task is None:
+                    return
+            if not task["future"].set_running_or_notify_cancel():  # Cancelled while it was waiting
+                self._task_done(task, None)
+                continue
+            task["started"] = time.monotonic()
+            try:
+                worker_future = self._executor.submit(self.task_function, task["conversion_type"], task["kwargs"])
+            except Exception as e:  # Pool already shut down or broken
+                task["future"].set_exception(e)
+                self._task_done(task, None)
+                continue
+            worker_future.add_done_callback(lambda done, task=task: self._task_done(task, done))
+
+    def _task_done(self, task, worker_future):
+        if worker_future is not None:
+            try:
+                task["future"].set_result(worker_future.result())
+            except Exception as e:
+                task["future"].set_exception(e)
+        with self._condition:
+            if worker_future is not None:
+                # Moving average of task durations for retry-after estimates
+                self._average_seconds = 0.8 * self._average_seconds + 0.2 * (time.monotonic() - task["started"])
+            self._running[task["firm"]] -= 1
+            self._condition.notify_all()
+
+    # --- Introspection and shutdown ---
+    def status(self):
+        """Queued and running tasks per firm, with each firm's next open deadline (None when only backfills or
+        undated files are waiting)."""
+        with self._condition:
+            self._expire_deadlines()
+            firms = {}
+            for firm in set(self._queues) | set(self._running):
+                queue = self._queues.get(firm, [])
+                if queue or self._running.get(firm):
+                    next_deadline = queue[0][0] if queue else None
+                    firms[firm] = {"queued": len(queue), "running": self._running.get(firm, 0),
+                                   "next_deadline": None if next_deadline in (None, _NO_DEADLINE) else next_deadline.isoformat()}
+            return {"workers": self.max_workers, "queued": self._queued, "running": sum(self._running.values()),
+                    "retry_after": self.retry_after(), "firms": firms}
+
+    def shutdown(self, wait=True, cancel_queued=False):
+        """Stops accepting work. Queued tasks still run unless cancel_queued is set."""
+        with self._condition:
+            if cancel_queued:
+                for queue in self._queues.values():
+                    while queue:
+                        heapq.heappop(queue)[2]["future"].cancel()
+                        self._queued -= 1
+                        queue_changed('scheduler', -1)
+            self._closed = True
+            self._condition.notify_all()
+        if wait:
+            self._dispatcher.join()
+        self._executor.shutdown(wait=wait)
+
+_shared_scheduler = None
+_shared_lock = threading.Lock()
+
+def shared_scheduler():
+    """The process-wide scheduler used by the web app, created on first use."""
+    global _shared_scheduler
+    with _shared_lock:
+        if _shared_scheduler is None:
+            _shared_scheduler = ConversionScheduler()
+        return _shared_scheduler
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert 13F holdings files through the deadline-aware scheduler and report the order they ran in.")
+    parser.add_argument("input_paths", nargs="+", help="13F holdings files (.xlsx, .csv or .parquet).")
+    parser.add_argument("-o", "--output-dir", default="Output", help="Where to write the XML files.")
+    parser.add_argument("--firm", help="Firm for every file (default: the client in each file name).")
+    parser.add_argument("--workers", type=int, default=SCHEDULER_MAX_WORKERS)
+    parser.add_argument("--dry-run", action="store_true",
+                        help="Only show the run order: no conversion, and the files need not exist (e.g. 'acme 13F 1Q21.xlsx' 'acme 13F 3Q26.xlsx').")
+    args = parser.parse_args()
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    scheduler = ConversionScheduler(max_workers=args.workers, task_function=dry_run_task if args.dry_run else run_conversion_task)
+    today = scheduler.today()
+    futures = {}
+    try:
+        for input_path in args.input_paths:
+            output_xml = os.path.join(args.output_dir, os.path.splitext(os.path.basename(input_path))[0] + '.xml')
+            try:
+                futures[input_path] = scheduler.submit('13F', firm=args.firm, input_xlsx=input_path, output_xml=output_xml)
+                deadline = task_deadline('13F', {"input_xlsx": input_path})
+                tier = "undated" if deadline == _NO_DEADLINE else "open" if task_priority(deadline, today) == deadline else "backfill"
+                print(f"Queued {os.path.basename(input_path)} ({tier}{'' if deadline == _NO_DEADLINE else f', due {deadline.isoformat()}'})")
+            except SchedulerBusy as e:
+                print(f"Rejected {input_path}: {e}")
+        print(f"Scheduler status: {scheduler.status()}")
+        finished = []
+        for input_path, future in futures.items():
+            future.add_done_callback(lambda done, path=input_path: finished.append(path))
+        for input_path, future in futures.items():
+            try:
+                summary = future.result()
+                print(f"{input_path}: {summary['rows_written']} holdings")
+            except Exception as e:
+                print(f"{input_path}: failed: {e}")
+        print("Completion order: " + ", ".join(os.path.basename(path) for path in finished))
+    finally:
+        scheduler.shutdown()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,219 @@
+import os
+import re
+import sqlite3
+import argparse
+import datetime
+from datetime import timezone
+import numpy as np
+import pandas as pd
+
+_BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+# Default location of the local index built from the SEC Official List of Section 13(f) Securities.
+# Build it with: python cusip_reference.py build <13flist file>
+DEFAULT_CUSIP_INDEX_PATH = os.path.join(_BASE_DIR, 'reference', 'sec_13f_securities.sqlite')
+
+# --- CUSIP check digit (vectorized) ---
+# Character values per the CUSIP standard: 0-9 -> 0-9, A-Z -> 10-35, * -> 36, @ -> 37, # -> 38.
+# Anything else maps to -1 and makes the CUSIP invalid.
+_CUSIP_CHAR_VALUES = np.full(256, -1, dtype=np.int16)
+_CUSIP_CHAR_VALUES[ord('0'):ord('9') + 1] = np.arange(10)
+_CUSIP_CHAR_VALUES[ord('A'):ord('Z') + 1] = np.arange(10, 36)
+_CUSIP_CHAR_VALUES[ord('*')] = 36
+_CUSIP_CHAR_VALUES[ord('@')] = 37
+_CUSIP_CHAR_VALUES[ord('#')] = 38
+# Every second character (positions 2, 4, 6, 8) is doubled
+_CUSIP_WEIGHTS = np.array([1, 2, 1, 2, 1, 2, 1, 2], dtype=np.int16)
+
+def normalize_cusips(cusips) -> pd.Series:
+    """Returns the CUSIPs as stripped, upper-case strings (NaN stays NaN).
+    Numeric cells that Excel stored as floats (e.g. 235851102.0) lose their trailing '.0'.
+    """
+    series = pd.Series(cusips)
+    text = series.astype(str).str.strip().str.upper()
+    if pd.api.types.is_numeric_dtype(series):
+        text = text.str.replace(r'\.0$', '', regex=True)
+    return text.where(series.notna())
+
+def validate_cusips(cusips) -> np.ndarray:
+    """Checks the length, character set and check digit of every CUSIP in one NumPy pass.
+    Returns a boolean array aligned with the input.
+    """
+    text = normalize_cusips(cusips).fillna("")
+    text = text.where(text.str.len() == 9, "")
+    # Fixed-width byte strings give an (n, 9) uint8 matrix; non-ASCII characters become '?' (invalid)
+    raw = np.array(text.str.encode('ascii', errors='replace').tolist(), dtype='S9')
+    codes = np.frombuffer(raw.tobytes(), dtype=np.uint8).reshape(-1, 9) if len(raw) else np.zeros((0, 9), dtype=np.uint8)
+
+    values = _CUSIP_CHAR_VALUES[codes[:, :8]]
+    chars_ok = (values >= 0).all(axis=1)
+    weighted = values * _CUSIP_WEIGHTS
+    digit_sum = (weighted // 10 + weighted % 10).sum(axis=1)
+    expected_check = (10 - digit_sum % 10) % 10
+    actual_check = codes[:, 8].astype(np.int16) - ord('0')
+    return chars_ok & (actual_check == expected_check)
+
+# --- Parsing the SEC Official List of Section 13(f) Securities ---
+# The text/PDF-extracted list has lines like:
+#   000360 20 6     AAON INC                      COM PAR $0.004      ADDED
+#   00206R 10 2  *  AT&T INC                      COM
+# The asterisk marks securities with listed options; STATUS is ADDED, DELETED or blank.
+_LIST_LINE_PATTERN = re.compile(
+    r'^\s*(?P<cusip>[0-9A-Z*@#]{6}\s?[0-9A-Z*@#]{2}\s?[0-9])\s+(?P<options>\*\s+)?'
+    r'(?P<issuer_name>.+?)\s{2,}(?P<issuer_description>.+?)(?:\s{2,}(?P<status>ADDED|DELETED))?\s*$'
+)
+
+def parse_13f_list(list_filepath) -> pd.DataFrame:
+    """Parses a downloaded copy of the 13F List (.txt as extracted from the SEC PDF, or .csv).
+    Returns a DataFrame with columns cusip, has_options, issuer_name, issuer_description, status.
+    """
+    if list_filepath.lower().endswith('.csv'):
+        df = pd.read_csv(list_filepath, dtype=str)
+        df.columns = [re.sub(r'[^a-z]+', '_', col.lower()).strip('_') for col in df.columns]
+        df = df.rename(columns={'cusip_no': 'cusip', 'has_listed_option': 'has_options'})
+        for col in ['has_options', 'status']:
+            if col not in df.columns:
+                df[col] = ""
+        df['has_options'] = df['has_options'].fillna("").str.strip().isin(['*', 'Y', 'YES', 'TRUE', '1'])
+    else:
+        records = []
+        with open(list_filepath, encoding='utf-8', errors='replace') as list_file:
+            for line in list_file:
+                match = _LIST_LINE_PATTERN.match(line.rstrip('\n'))
+                if match:
+                    records.append(match.groupdict())
+        df = pd.DataFrame(records, columns=['cusip', 'options', 'issuer_name', 'issuer_description', 'status'])
+        df['has_options'] = df.pop('options').notna()
+
+    df['cusip'] = df['cusip'].astype(str).str.replace(' ', '', regex=False).str.upper()
+    df['status'] = df['status'].fillna("").str.strip().str.upper()
+    df['issuer_name'] = df['issuer_name'].fillna("").str.strip()
+    df['issuer_description'] = df['issuer_description'].fillna("").str.strip()
+    # Entries marked DELETED are no longer 13(f) securities; a later row for the same CUSIP wins
+    df = df[df['status'] != 'DELETED'].drop_duplicates('cusip', keep='last')
+    return df[['cusip', 'has_options', 'issuer_name', 'issuer_description', 'status']].reset_index(drop=True)
+
+def build_cusip_index(list_filepath, db_path=DEFAULT_CUSIP_INDEX_PATH):
+    """Builds (or rebuilds) the local SQLite index from a downloaded 13F List. Returns the entry count."""
+    securities = parse_13f_list(list_filepath)
+    os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+    tmp_path = db_path + '.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+    conn = sqlite3.connect(tmp_path)
+    try:
+        # WITHOUT ROWID stores rows in the primary-key B-tree itself, keeping the file compact
+        conn.execute("CREATE TABLE securities (cusip TEXT PRIMARY KEY, has_options INTEGER, "
+                     "issuer_name TEXT, issuer_description TEXT, status TEXT) WITHOUT ROWID")
+        conn.execute("CREATE TABLE metadata (key TEXT PRIMARY KEY, value TEXT)")
+        conn.executemany("INSERT INTO securities VALUES (?, ?, ?, ?, ?)",
+                         securities.astype({'has_options': int}).itertuples(index=False, name=None))
+        conn.executemany("INSERT INTO metadata VALUES (?, ?)", [
+            ('source_file', os.path.basename(list_filepath)),
+            ('built_at', datetime.datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')),
+            ('entries', str(len(securities))),
+        ])
+        conn.commit()
+    finally:
+        conn.close()
+    # Swap in the finished file so readers never see a half-built index
+    os.replace(tmp_path, db_path)
+    print(f"Built 13F CUSIP index with {len(securities)} securities: {db_path}")
+    return len(securities)
+
+class CusipIndex:
+    """Read-only handle on the local 13F List index."""
+
+    def __init__(self, db_path=DEFAULT_CUSIP_INDEX_PATH):
+        if not os.path.exists(db_path):
+            raise FileNotFoundError(f"13F CUSIP index not found at {db_path}. Build it with 'python cusip_reference.py build <13F list file>'.")
+        self.db_path = db_path
+        self.conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True, check_same_thread=False)
+
+    def close(self):
+        self.conn.close()
+
+    def lookup(self, cusips) -> pd.DataFrame:
+        """Bulk lookup. Returns a DataFrame indexed by CUSIP with issuer_name and issuer_description
+        for the CUSIPs that are on the list; CUSIPs not on the list are simply absent.
+        """
+        unique_cusips = normalize_cusips(cusips).dropna().unique()
+        # One temp-table join is far faster than a query per CUSIP (or huge IN (...) lists)
+        self.conn.execute("CREATE TEMP TABLE IF NOT EXISTS lookup_keys (cusip TEXT PRIMARY KEY) WITHOUT ROWID")
+        self.conn.execute("DELETE FROM lookup_keys")
+        self.conn.executemany("INSERT OR IGNORE INTO lookup_keys VALUES (?)", ((c,) for c in unique_cusips))
+        found = pd.read_sql_query(
+            "SELECT s.cusip, s.issuer_name, s.issuer_description FROM lookup_keys k "
+            "JOIN securities s ON s.cusip = k.cusip", self.conn)
+        self.conn.execute("DELETE FROM lookup_keys")
+        return found.set_index('cusip')
+
+def _is_blank(series) -> pd.Series:
+    return series.isna() | (series.astype(str).str.strip() == "")
+
+def enrich_holdings(df, resolved_cols, cusip_index=None, correct=False):
+    """Validates every holding's CUSIP and, when a CusipIndex is given, fills blank title of class and
+    issuer name from the 13F List (or overwrites them with the official values when correct=True).
+    Returns (df, report); report lists invalid CUSIPs with their Excel row numbers.
+    """
+    cusip_col = resolved_cols["cusip"]
+    cusips = normalize_cusips(df[cusip_col])
+    is_valid = validate_cusips(cusips)
+    # Excel row = DataFrame index + 2 (header row is row 1); streamed chunks carry their absolute index
+    invalid_rows = [(int(df.index[pos]) + 2, df[cusip_col].iloc[pos]) for pos in np.flatnonzero(~is_valid)]
+    report = {"invalid_cusips": invalid_rows, "not_on_list": 0, "titles_updated": 0, "issuers_updated": 0}
+
+    if cusip_index is None:
+        return df, report
+
+    df = df.copy()
+    official = cusip_index.lookup(cusips[is_valid])
+    on_list = cusips.isin(official.index).to_numpy()
+    report["not_on_list"] = int((is_valid & ~on_list).sum())
+
+    for field_key, official_col, report_key in [("title_of_class", "issuer_description", "titles_updated"),
+                                                ("name_of_issuer", "issuer_name", "issuers_updated")]:
+        col = resolved_cols.get(field_key)
+        if not col:
+            continue
+        official_values = cusips.map(official[official_col])
+        if correct:
+            to_update = on_list & (df[col].astype(str).str.strip() != official_values).to_numpy()
+        else:
+            to_update = on_list & _is_blank(df[col]).to_numpy()
+        if to_update.any():
+            df[col] = df[col].astype(object)
+            df.loc[to_update, col] = official_values[to_update]
+        report[report_key] = int(to_update.sum())
+
+    return df, report
+
+def main():
+    parser = argparse.ArgumentParser(description="Build or query the local SEC 13(f) securities CUSIP index.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build_parser = subparsers.add_parser("build", help="Build the index from a downloaded 13F List (.txt or .csv).")
+    build_parser.add_argument("list_path", help="Path to the downloaded 13F List.")
+    build_parser.add_argument("--db", default=DEFAULT_CUSIP_INDEX_PATH, help="Where to write the SQLite index.")
+    lookup_parser = subparsers.add_parser("lookup", help="Validate and look up one or more CUSIPs.")
+    lookup_parser.add_argument("cusips", nargs="+", help="CUSIPs to look up.")
+    lookup_parser.add_argument("--db", default=DEFAULT_CUSIP_INDEX_PATH, help="Path to the SQLite index.")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        build_cusip_index(args.list_path, args.db)
+    elif args.command == "lookup":
+        is_valid = validate_cusips(args.cusips)
+        index = CusipIndex(args.db)
+        try:
+            found = index.lookup(args.cusips)
+        finally:
+            index.close()
+        for cusip, valid in zip(normalize_cusips(args.cusips), is_valid):
+            if cusip in found.index:
+                entry = found.loc[cusip]
+                print(f"{cusip}: {entry['issuer_name']} | {entry['issuer_description']}")
+            else:
+                print(f"{cusip}: {'not on the 13F List' if valid else 'INVALID check digit or format'}")
+
+if __name__ == '__main__':
+    main()
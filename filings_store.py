@@ -0,0 +1,440 @@
+import os
+import re
+import sqlite3
+import argparse
+import datetime
+from datetime import timezone
+import numpy as np
+import pandas as pd
+from cusip_reference import normalize_cusips
+from report_formatting import to_numbers
+
+_BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+# Local history of every converted filing: 13F holdings (one row per position) and 6151 venue sets, keyed by
+# client and period, so a new quarter can be compared with the last one. FILINGS_STORE_PATH moves the database;
+# FILINGS_STORE_DISABLED=1 stops conversions from recording into it.
+FILINGS_STORE_PATH = os.environ.get('FILINGS_STORE_PATH', os.path.join(_BASE_DIR, 'history', 'filings.sqlite'))
+
+# A position whose value moved by at least this many percent (with unchanged shares) is listed as a value swing
+DEFAULT_VALUE_SWING_PCT = 10.0
+# A venue whose routing percentages moved by at least this many percentage points is listed as changed
+DEFAULT_VENUE_SWING_POINTS = 1.0
+
+# Concurrent batch workers record into the same file; writers wait for each other instead of failing
+_LOCK_TIMEOUT_SECONDS = 30
+
+# Mapping keys (COLUMN_MAPPINGS in xlsx_to_corrected_edgar_xml.py) of the columns kept per position
+_HOLDING_TEXT_FIELDS = {"name_of_issuer": "name_of_issuer", "title_of_class": "title_of_class"}
+_HOLDING_SUM_FIELDS = {"value": "value_col", "shares": "shares_amount_col"}
+# Venue percentage columns and the VenueData attributes they are stored from
+_VENUE_PCT_FIELDS = {"market_pct": "market_order_pct", "marketable_limit_pct": "marketable_limit_order_pct",
+                     "non_marketable_limit_pct": "non_marketable_limit_order_pct", "other_pct": "other_order_pct"}
+_VENUE_USD_FIELDS = ["net_pmt_paid_recv_market_orders_usd", "net_pmt_paid_recv_marketable_limit_orders_usd",
+                     "net_pmt_paid_recv_non_marketable_limit_orders_usd", "net_pmt_paid_recv_other_orders_usd"]
+
+_SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS filings (filing_id INTEGER PRIMARY KEY, client TEXT NOT NULL, kind TEXT NOT NULL, "
+    "period TEXT NOT NULL, source_file TEXT, recorded_at TEXT, row_count INTEGER, UNIQUE (client, kind, period))",
+    # One row per position: the EDGAR key is CUSIP + SH/PRN + put/call; rows that only differ in investment
+    # discretion or other managers are summed. WITHOUT ROWID keeps rows in the primary-key B-tree, so the diff
+    # joins below are index lookups.
+    "CREATE TABLE IF NOT EXISTS holdings (filing_id INTEGER NOT NULL, cusip TEXT NOT NULL, shares_type TEXT NOT NULL, "
+    "put_call TEXT NOT NULL, name_of_issuer TEXT, title_of_class TEXT, value REAL NOT NULL DEFAULT 0, "
+    "shares INTEGER NOT NULL DEFAULT 0, PRIMARY KEY (filing_id, cusip, shares_type, put_call)) WITHOUT ROWID",
+    # The same CUSIP across periods and clients (history command)
+    "CREATE INDEX IF NOT EXISTS holdings_by_cusip ON holdings (cusip, filing_id)",
+    # Percentages as written in the XML (0.24 = 24%); net_payment_usd sums the four order types' payments
+    "CREATE TABLE IF NOT EXISTS venues (filing_id INTEGER NOT NULL, category TEXT NOT NULL, venue TEXT NOT NULL, "
+    "market_pct REAL, marketable_limit_pct REAL, non_marketable_limit_pct REAL, other_pct REAL, net_payment_usd REAL, "
+    "PRIMARY KEY (filing_id, category, venue)) WITHOUT ROWID",
+]
+
+def store_enabled() -> bool:
+    return os.environ.get('FILINGS_STORE_DISABLED', '').lower() not in ('1', 'true', 'yes')
+
+# --- Clients and periods from file names ---
+# Periods are stored as "2024Q1". File names write them as "1Q '24", "3Q24", "q125" (generate_output_filename)
+# or with the year and quarter apart ("281065_606_NMS_2024_Q2").
+_PERIOD_PATTERNS = [
+    re.compile(r"(?<![0-9])([1-4])Q[\s_-]*'?(20\d{2}|\d{2})", re.IGNORECASE),
+    re.compile(r"Q([1-4])[\s_-]*'?(20\d{2}|\d{2})", re.IGNORECASE),
+]
+
+def _period_text(year, quarter):
+    year = int(year)
+    return f"{year + 2000 if year < 100 else year}Q{int(quarter)}"
+
+def _find_period(text):
+    """(period, matched span) for the first period written in text, or (None, None)."""
+    for pattern in _PERIOD_PATTERNS:
+        match = pattern.search(text)
+        if match:
+            return _period_text(match.group(2), match.group(1)), match.span()
+    year_match = re.search(r'(20\d{2})', text)
+    quarter_match = re.search(r'Q([1-4])', text, re.IGNORECASE) or re.search(r'([1-4])Q', text, re.IGNORECASE)
+    if year_match and quarter_match:
+        return _period_text(year_match.group(1), quarter_match.group(1)), year_match.span()
+    return None, None
+
+def normalize_period(period):
+    """'2024Q1', '2024-Q1', '1Q24', "Q1 '24" ... -> '2024Q1'. Raises ValueError for anything else."""
+    text = str(period).strip()
+    match = re.fullmatch(r'(20\d{2})[\s_-]*Q([1-4])', text, re.IGNORECASE)
+    if match:
+        return _period_text(match.group(1), match.group(2))
+    found, _ = _find_period(text)
+    if not found:
+        raise ValueError(f"Unrecognized period '{period}'; use e.g. 2024Q1.")
+    return found
+
+def infer_filing_period(filename):
+    """Reporting period ('2024Q1') written in a file name, or None."""
+    return _find_period(os.path.splitext(os.path.basename(filename))[0])[0]
+
+def infer_client(filename):
+    """Client key from a holdings file name: the name without its period, '13F' and punctuation, lower case
+    ("Zeno 13F 1Q '24.xlsx" -> "zeno")."""
+    stem = os.path.splitext(os.path.basename(filename))[0]
+    _, span = _find_period(stem)
+    if span:
+        stem = stem[:span[0]] + " " + stem[span[1]:]
+    stem = re.sub(r'13f', ' ', stem, flags=re.IGNORECASE)
+    return re.sub(r'[^a-z0-9]', '', stem.lower()) or None
+
+def _client_key(client):
+    return re.sub(r'\s+', ' ', str(client).strip()).lower()
+
+# --- Rows of a filing ---
+# Conversions build a filing's rows in memory and store them with one FilingsStore.record_filing call, so the
+# database is only locked for that one short write, never for the length of a (streaming) conversion.
+_POSITION_KEY = ["cusip", "shares_type", "put_call"]
+_POSITION_COLUMNS = (*_POSITION_KEY, "name_of_issuer", "title_of_class", "value", "shares")
+
+def holding_positions(frame, resolved_cols) -> pd.DataFrame:
+    """A prepared holdings frame (or one streamed chunk of it) combined per position: the first issuer name and
+    class, summed value and shares."""
+    def text_column(field_key):
+        col = resolved_cols.get(field_key)
+        if not col or col not in frame.columns:
+            return pd.Series("", index=frame.index)
+        return frame[col].fillna("").astype(str).str.strip()
+    def number_column(field_key):
+        col = resolved_cols.get(field_key)
+        if not col or col not in frame.columns:
+            return pd.Series(0.0, index=frame.index)
+        return pd.to_numeric(frame[col], errors="coerce").fillna(0).astype("float64")
+
+    positions = pd.DataFrame({
+        "cusip": normalize_cusips(frame[resolved_cols["cusip"]]).fillna(""),
+        "shares_type": text_column("shares_type_col").str.upper(),
+        "put_call": text_column("put_call").str.upper(),
+        **{name: text_column(field_key) for name, field_key in _HOLDING_TEXT_FIELDS.items()},
+        **{name: number_column(field_key) for name, field_key in _HOLDING_SUM_FIELDS.items()},
+    })
+    return combine_positions([positions])
+
+def combine_positions(frames) -> pd.DataFrame:
+    """Positions of several holding_positions() frames (chunks of one filing) combined into one frame."""
+    positions = pd.concat(frames, ignore_index=True) if len(frames) > 1 else frames[0]
+    positions = positions.groupby(_POSITION_KEY, sort=False, as_index=False).agg(
+        name_of_issuer=("name_of_issuer", "first"), title_of_class=("title_of_class", "first"),
+        value=("value", "sum"), shares=("shares", "sum"))
+    positions["shares"] = positions["shares"].round().astype("int64")
+    return positions
+
+def venue_rows(categories):
+    """(category, venue, four percentages, net payment) per venue of a parsed 6151 report's categories
+    (SecurityCategoryData). A venue listed twice in a category keeps its last row."""
+    rows = {}
+    for category in categories:
+        venues = category.venues
+        if not venues:
+            continue
+        pcts = to_numbers([[getattr(v, attribute) for attribute in _VENUE_PCT_FIELDS.values()] for v in venues])
+        usd = to_numbers([[getattr(v, attribute) for attribute in _VENUE_USD_FIELDS] for v in venues])
+        net_payment = np.where(np.isnan(usd).all(axis=1), np.nan, np.nansum(usd, axis=1))
+        for venue, venue_pcts, payment in zip(venues, pcts, net_payment):
+            key = (category.name, str(venue.venue_name).strip())
+            rows[key] = (*key, *[None if np.isnan(p) else float(p) for p in venue_pcts],
+                         None if np.isnan(payment) else float(payment))
+    return list(rows.values())
+
+class FilingsStore:
+    """Read/write handle on the filings history database (created on first use)."""
+
+    def __init__(self, db_path=FILINGS_STORE_PATH):
+        os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+        self.db_path = db_path
+        self.conn = sqlite3.connect(db_path, timeout=_LOCK_TIMEOUT_SECONDS, check_same_thread=False)
+        # WAL lets readers (diffs) run while a conversion is recording
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        for statement in _SCHEMA:
+            self.conn.execute(statement)
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    # --- Recording ---
+    def record_filing(self, client, kind, period, source_file=None, positions=None, venues=None):
+        """Stores a filing with its holding positions (a holding_positions() frame) or venue rows (venue_rows())
+        in one short write transaction. A filing already stored for the same client, kind and period is replaced,
+        so re-running a quarter's conversion keeps only the latest result. Returns (filing_id, row count)."""
+        client, period = _client_key(client), normalize_period(period)
+        recorded_at = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+        row_count = (0 if positions is None else len(positions)) + len(venues or [])
+        with self.conn:  # Commits, or rolls back on an error
+            existing = self.conn.execute("SELECT filing_id FROM filings WHERE client = ? AND kind = ? AND period = ?",
+                                         (client, kind, period)).fetchone()
+            if existing:
+                for table in ("holdings", "venues", "filings"):
+                    self.conn.execute(f"DELETE FROM {table} WHERE filing_id = ?", existing)
+            filing_id = self.conn.execute(
+                "INSERT INTO filings (client, kind, period, source_file, recorded_at, row_count) VALUES (?, ?, ?, ?, ?, ?)",
+                (client, kind, period, source_file, recorded_at, row_count)).lastrowid
+            if positions is not None and len(positions):
+                self.conn.executemany(
+                    "INSERT INTO holdings (filing_id, cusip, shares_type, put_call, name_of_issuer, title_of_class, value, shares) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    ((filing_id, *row) for row in positions[list(_POSITION_COLUMNS)].itertuples(index=False, name=None)))
+            if venues:
+                self.conn.executemany("INSERT INTO venues VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                      ((filing_id, *row) for row in venues))
+        return filing_id, row_count
+
+    # --- Reading ---
+    def filings(self, client=None, kind=None) -> pd.DataFrame:
+        """Stored filings, newest period first."""
+        clauses, params = [], []
+        if client:
+            clauses.append("client = ?")
+            params.append(_client_key(client))
+        if kind:
+            clauses.append("kind = ?")
+            params.append(kind)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        return pd.read_sql_query(f"SELECT client, kind, period, row_count, source_file, recorded_at FROM filings {where} "
+                                 "ORDER BY client, kind, period DESC", self.conn, params=params)
+
+    def filing_id(self, client, kind, period):
+        row = self.conn.execute("SELECT filing_id FROM filings WHERE client = ? AND kind = ? AND period = ?",
+                                (_client_key(client), kind, normalize_period(period))).fetchone()
+        if row is None:
+            raise KeyError(f"No {kind} filing stored for client '{client}' and period {normalize_period(period)}.")
+        return row[0]
+
+    def previous_period(self, client, kind, period):
+        """The latest stored period before `period` for the client, or None."""
+        row = self.conn.execute("SELECT MAX(period) FROM filings WHERE client = ? AND kind = ? AND period < ?",
+                                (_client_key(client), kind, normalize_period(period))).fetchone()
+        return row[0]
+
+    def diff_holdings(self, client, old_period, new_period, swing_pct=DEFAULT_VALUE_SWING_PCT):
+        """Positions that differ between two 13F filings of a client: new positions, exits, changed share
+        counts and value swings of at least swing_pct percent. Unchanged positions are filtered out in SQL, so
+        only the deltas are read. Returns (diff DataFrame sorted by size of the value change, counts dict)."""
+        old_id = self.filing_id(client, '13F', old_period)
+        new_id = self.filing_id(client, '13F', new_period)
+        swing = swing_pct / 100.0
+        # Both halves are primary-key lookups into the other filing (SQLite has no FULL OUTER JOIN before 3.39)
+        query = (
+            "SELECT n.cusip, n.shares_type, n.put_call, n.name_of_issuer, n.title_of_class, "
+            "o.value AS old_value, n.value AS new_value, o.shares AS old_shares, n.shares AS new_shares "
+            "FROM holdings n LEFT JOIN holdings o ON o.filing_id = :old AND o.cusip = n.cusip "
+            "AND o.shares_type = n.shares_type AND o.put_call = n.put_call "
+            "WHERE n.filing_id = :new AND (o.cusip IS NULL OR o.shares != n.shares "
+            "OR ABS(n.value - o.value) >= :swing * ABS(o.value) AND n.value != o.value) "
+            "UNION ALL "
+            "SELECT o.cusip, o.shares_type, o.put_call, o.name_of_issuer, o.title_of_class, "
+            "o.value, NULL, o.shares, NULL FROM holdings o WHERE o.filing_id = :old AND NOT EXISTS "
+            "(SELECT 1 FROM holdings n WHERE n.filing_id = :new AND n.cusip = o.cusip "
+            "AND n.shares_type = o.shares_type AND n.put_call = o.put_call)")
+        diff = pd.read_sql_query(query, self.conn, params={"old": old_id, "new": new_id, "swing": swing})
+
+        diff["status"] = np.select(
+            [diff["old_value"].isna(), diff["new_value"].isna(), diff["old_shares"] != diff["new_shares"]],
+            ["new", "exited", "shares_changed"], default="value_swing")
+        diff["value_change"] = diff["new_value"].fillna(0) - diff["old_value"].fillna(0)
+        diff["shares_change"] = diff["new_shares"].fillna(0) - diff["old_shares"].fillna(0)
+        old_value = diff["old_value"].where(diff["old_value"] != 0)
+        diff["value_change_pct"] = (diff["value_change"] / old_value.abs() * 100).round(2)
+        diff = diff.iloc[np.argsort(-diff["value_change"].abs().to_numpy(), kind="stable")].reset_index(drop=True)
+
+        counts = diff["status"].value_counts().reindex(["new", "exited", "shares_changed", "value_swing"], fill_value=0)
+        counts = {status: int(count) for status, count in counts.items()}
+        new_total = self.conn.execute("SELECT COUNT(*) FROM holdings WHERE filing_id = ?", (new_id,)).fetchone()[0]
+        counts["unchanged"] = new_total - counts["new"] - counts["shares_changed"] - counts["value_swing"]
+        return diff, counts
+
+    def diff_venues(self, client, old_period, new_period, swing_points=DEFAULT_VENUE_SWING_POINTS):
+        """Venues that differ between two 6151 reports of a firm: venues added or dropped per category and
+        venues whose routing percentages moved by at least swing_points (or whose net payment changed).
+        Returns (diff DataFrame, counts dict)."""
+        old_id = self.filing_id(client, '6151', old_period)
+        new_id = self.filing_id(client, '6151', new_period)
+        columns = list(_VENUE_PCT_FIELDS) + ["net_payment_usd"]
+        moved = " OR ".join(f"ABS(IFNULL(n.{c}, 0) - IFNULL(o.{c}, 0)) >= :swing" for c in _VENUE_PCT_FIELDS)
+        query = (
+            f"SELECT n.category, n.venue, CASE WHEN o.venue IS NULL THEN 'added' ELSE 'changed' END AS status, "
+            f"{', '.join(f'o.{c} AS old_{c}, n.{c} AS new_{c}' for c in columns)} FROM venues n "
+            "LEFT JOIN venues o ON o.filing_id = :old AND o.category = n.category AND o.venue = n.venue "
+            f"WHERE n.filing_id = :new AND (o.venue IS NULL OR {moved} "
+            "OR IFNULL(n.net_payment_usd, 0) != IFNULL(o.net_payment_usd, 0)) "
+            "UNION ALL "
+            f"SELECT o.category, o.venue, 'dropped', {', '.join(f'o.{c}, NULL' for c in columns)} FROM venues o "
+            "WHERE o.filing_id = :old AND NOT EXISTS (SELECT 1 FROM venues n WHERE n.filing_id = :new "
+            "AND n.category = o.category AND n.venue = o.venue)")
+        diff = pd.read_sql_query(query, self.conn, params={"old": old_id, "new": new_id, "swing": swing_points / 100.0})
+        counts = diff["status"].value_counts().reindex(["added", "dropped", "changed"], fill_value=0)
+        counts = {status: int(count) for status, count in counts.items()}
+        new_total = self.conn.execute("SELECT COUNT(*) FROM venues WHERE filing_id = ?", (new_id,)).fetchone()[0]
+        counts["unchanged"] = new_total - counts["added"] - counts["changed"]
+        return diff.sort_values(["category", "status", "venue"]).reset_index(drop=True), counts
+
+    def cusip_history(self, cusip, client=None) -> pd.DataFrame:
+        """Every stored position in one CUSIP, by client and period."""
+        client_clause = "AND f.client = ?" if client else ""
+        params = [normalize_cusips([cusip]).iloc[0]] + ([_client_key(client)] if client else [])
+        return pd.read_sql_query(
+            "SELECT f.client, f.period, h.shares_type, h.put_call, h.name_of_issuer, h.value, h.shares "
+            f"FROM holdings h JOIN filings f ON f.filing_id = h.filing_id WHERE h.cusip = ? {client_clause} "
+            "ORDER BY f.client, f.period", self.conn, params=params)
+
+# --- Recording from the converters ---
+# Recording is a side effect of a conversion: a failure is printed and the conversion carries on.
+# Positions are combined again once this many chunks are buffered, so a streamed filing's buffer stays small
+_COMBINE_EVERY_CHUNKS = 16
+
+class HoldingsRecording:
+    """Records one converted holdings table as the 13F filing of `client` for `period` (both default to what
+    the input file name says). Frames are added as they are converted, so the streaming converter records chunk
+    by chunk; their positions are kept in memory and written in one transaction by finish(). Does nothing when
+    enabled is False, recording is disabled or no period is known."""
+
+    def __init__(self, input_path, client=None, period=None, db_path=None, enabled=True):
+        self.input_path = input_path
+        self.client = client or infer_client(input_path)
+        self.period = period or infer_filing_period(input_path)
+        self.db_path = db_path or FILINGS_STORE_PATH
+        self.positions = None
+        if not enabled or not store_enabled():
+            return
+        if not self.client or not self.period:
+            print(f"Filings history: no client/period for '{os.path.basename(input_path)}' (name it like 'Client 13F 1Q24'); not recorded.")
+            return
+        try:
+            normalize_period(self.period)
+            self.positions = []
+        except ValueError as e:
+            self._give_up(e)
+
+    def _give_up(self, error):
+        print(f"Warning: Could not record '{self.input_path}' in the filings history: {error}")
+        self.positions = None
+
+    def add(self, frame, resolved_cols):
+        if self.positions is None or len(frame) == 0:
+            return
+        try:
+            self.positions.append(holding_positions(frame, resolved_cols))
+            if len(self.positions) >= _COMBINE_EVERY_CHUNKS:
+                self.positions = [combine_positions(self.positions)]
+        except (ValueError, KeyError) as e:
+            self._give_up(e)
+
+    def finish(self):
+        """Writes the filing. Returns its filing_id, or None when nothing was recorded."""
+        if self.positions is None:
+            return None
+        positions = combine_positions(self.positions) if self.positions else None
+        self.positions = None
+        store = None
+        try:
+            store = FilingsStore(self.db_path)
+            filing_id, count = store.record_filing(self.client, '13F', self.period, os.path.basename(self.input_path), positions)
+            print(f"Filings history: recorded {count} positions as {_client_key(self.client)} 13F {normalize_period(self.period)}.")
+            return filing_id
+        except (sqlite3.Error, OSError) as e:
+            self._give_up(e)
+            return None
+        finally:
+            if store:
+                store.close()
+
+def record_holdings_filing(frames, resolved_cols, input_path, client=None, period=None, db_path=None, enabled=True):
+    """Records a converted holdings table (an iterable of frames) in one go. Returns the filing_id or None."""
+    recording = HoldingsRecording(input_path, client, period, db_path, enabled)
+    for frame in frames:
+        recording.add(frame, resolved_cols)
+    return recording.finish()
+
+def record_venue_filing(report_data, input_path, db_path=None):
+    """Records the venues of a parsed 6151 report (NmsHeldOrderRoutingReportData) under its firm name and
+    quarter. Returns the filing_id or None."""
+    if not store_enabled():
+        return None
+    store = None
+    try:
+        period = _period_text(report_data.year, report_data.qtr)
+        venues = venue_rows(report_data.s_non_directed_categories + report_data.s_directed_categories)
+        store = FilingsStore(db_path or FILINGS_STORE_PATH)
+        filing_id, count = store.record_filing(report_data.firm_name, '6151', period, os.path.basename(input_path), venues=venues)
+        print(f"Filings history: recorded {count} venues as {_client_key(report_data.firm_name)} 6151 {period}.")
+        return filing_id
+    except (sqlite3.Error, OSError, ValueError) as e:
+        print(f"Warning: Could not record '{input_path}' in the filings history: {e}")
+        return None
+    finally:
+        if store:
+            store.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="List and compare filings recorded by the 13F and 6151 converters.")
+    parser.add_argument("--db", default=FILINGS_STORE_PATH, help="Path to the filings history database.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    list_parser = subparsers.add_parser("list", help="List stored filings.")
+    list_parser.add_argument("client", nargs="?", help="Only this client / firm.")
+    diff_parser = subparsers.add_parser("diff", help="Show what changed between two periods of a client.")
+    diff_parser.add_argument("client", help="Client key (13F) or firm name (6151), as shown by 'list'.")
+    diff_parser.add_argument("new_period", help="Period to review, e.g. 2024Q2.")
+    diff_parser.add_argument("old_period", nargs="?", help="Period to compare with (default: the previous stored one).")
+    diff_parser.add_argument("--kind", choices=["13F", "6151"], default="13F")
+    diff_parser.add_argument("--swing", type=float, help=f"Minimum value change in percent (13F, default {DEFAULT_VALUE_SWING_PCT}) "
+                                                         f"or routing change in points (6151, default {DEFAULT_VENUE_SWING_POINTS}).")
+    diff_parser.add_argument("--csv", help="Also write the full diff to this CSV file.")
+    diff_parser.add_argument("--limit", type=int, default=50, help="Rows to print (default 50).")
+    history_parser = subparsers.add_parser("history", help="Show a CUSIP's positions across periods.")
+    history_parser.add_argument("cusip")
+    history_parser.add_argument("--client", help="Only this client.")
+    args = parser.parse_args()
+
+    store = FilingsStore(args.db)
+    try:
+        if args.command == "list":
+            print(store.filings(args.client).to_string(index=False))
+        elif args.command == "history":
+            print(store.cusip_history(args.cusip, args.client).to_string(index=False))
+        elif args.command == "diff":
+            old_period = args.old_period or store.previous_period(args.client, args.kind, args.new_period)
+            if not old_period:
+                parser.error(f"No {args.kind} filing for '{args.client}' before {normalize_period(args.new_period)}.")
+            if args.kind == "13F":
+                swing = DEFAULT_VALUE_SWING_PCT if args.swing is None else args.swing
+                diff, counts = store.diff_holdings(args.client, old_period, args.new_period, swing)
+            else:
+                swing = DEFAULT_VENUE_SWING_POINTS if args.swing is None else args.swing
+                diff, counts = store.diff_venues(args.client, old_period, args.new_period, swing)
+            print(f"{args.kind} {args.client}: {normalize_period(old_period)} -> {normalize_period(args.new_period)}: "
+                  + ", ".join(f"{count} {status}" for status, count in counts.items()))
+            if len(diff):
+                print(diff.head(args.limit).to_string(index=False))
+            if args.csv:
+                diff.to_csv(args.csv, index=False)
+                print(f"Wrote {len(diff)} rows to {args.csv}")
+    except KeyError as e:
+        parser.error(e.args[0])
+    finally:
+        store.close()
+
+if __name__ == '__main__':
+    main()
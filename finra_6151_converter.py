@@ -5,8 +5,23 @@ from datetime import timezone # Added for timezone.utc
 import os
 import numpy as np
 import argparse
-from dataclasses import dataclass, field
+import time
+import sys
+import json
+import contextlib
+from dataclasses import dataclass, field, fields as dataclass_fields
 from typing import List, Optional
+from workbook_cache import read_excel_cached
+from conversion_metrics import track_conversion, observe_stage, record_error
+from xml_validation import (validate_xml_file, format_validation_stats, SourceMap, pretty_printed_lines,
+                            excel_column_letter, first_sheet_name, issues_as_dicts)
+from report_formatting import (NOT_MEANINGFUL, to_numbers, format_pct, format_decimal2, format_cph4,
+                               column_block)
+from filings_store import record_venue_filing
+from conversion_profiler import profiled_conversion
+from venue_reference import shared_venue_index, resolution_summary
+from conversion_progress import report_progress, count_progress
+from report_snapshot import SAVE_REPORT_SNAPSHOTS, snapshot_path, is_snapshot, attributes_record, write_snapshot, read_snapshot
 
 # Determine the absolute path to the directory where this script is located
 _BASE_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -14,55 +29,15 @@ _BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 # Assumes 'schemas' directory is at the same level as this script file.
 XSD_FILE_PATH = os.path.join(_BASE_DIR, 'schemas', 'oh-20191231.xsd')
 
-# --- NEW Helper functions for formatting based on XSD types ---
-def format_pct_or_nm(value) -> str:
-    """Formats a number to a string compliant with PctOrNmType.
-    (e.g., "25.50", "0.00", or "" if not meaningful).
-    Handles np.nan or empty strings from Excel.
-    """
-    if pd.isna(value) or str(value).strip() == "":
-        return ""
-    try:
-        num = float(value)
-        # Format to ensure at least two decimal places, e.g., 0 -> "0.00", 25.5 -> "25.50"
-        # The XSD PctType implies at least two decimal places: <xs:pattern value="[0-9]*\.[0-9]{2,}"/>
-        return f"{num:.2f}" # Standard rounding to 2 decimal places
-    except ValueError:
-        return "" # If conversion to float fails, treat as not meaningful
-
-def format_decimal2_or_nm(value) -> str:
-    """Formats a number to a string compliant with Decimal2OrNmType.
-    (e.g., "123.45", "-5.50", "0.00", or "" if not meaningful).
-    """
-    if pd.isna(value) or str(value).strip() == "":
-        return ""
-    try:
-        num = float(value)
-        return f"{num:.2f}" # Ensure two decimal places
-    except ValueError:
-        return ""
-
-def format_cph4_or_nm(value) -> str:
-    """Formats a number to a string compliant with CphType.
-    (e.g., "123.4567", "-5.1234", "0.0000", or "" if not meaningful).
-    """
-    if pd.isna(value) or str(value).strip() == "":
-        return ""
-    try:
-        num = float(value)
-        return f"{num:.4f}" # Ensure four decimal places
-    except ValueError:
-        return ""
-
 # --- NEW Data Classes Aligned with oh-20191231.xsd for nmsHeldOrderRoutingReport --- 
 
 @dataclass
 class VenueData: # Corresponds to OH_VENUE_DATA in XSD
     venue_name: str
-    market_order_pct: Optional[str] = None        # PctOrNmType, will be formatted by format_pct_or_nm
-    marketable_limit_order_pct: Optional[str] = None # PctOrNmType, will be formatted by format_pct_or_nm
-    non_marketable_limit_order_pct: Optional[str] = None # PctOrNmType, will be formatted by format_pct_or_nm
-    other_order_pct: Optional[str] = None         # PctOrNmType, will be formatted by format_pct_or_nm
+    market_order_pct: Optional[str] = None        # PctOrNmType, formatted by report_formatting.format_pct
+    marketable_limit_order_pct: Optional[str] = None # PctOrNmType, formatted by report_formatting.format_pct
+    non_marketable_limit_order_pct: Optional[str] = None # PctOrNmType, formatted by report_formatting.format_pct
+    other_order_pct: Optional[str] = None         # PctOrNmType, formatted by report_formatting.format_pct
     net_pmt_paid_recv_market_orders_usd: Optional[float] = None
     net_pmt_paid_recv_market_orders_cph: Optional[float] = None
     net_pmt_paid_recv_marketable_limit_orders_usd: Optional[float] = None
@@ -74,6 +49,7 @@ class VenueData: # Corresponds to OH_VENUE_DATA in XSD
     payment_disclosure_link: Optional[str] = None # xs:anyURI
     mic: Optional[str] = None                # MicType (optional)
     mpid: Optional[str] = None               # MpidType (optional)
+    source_row: Optional[int] = None         # Excel row (1-based) the venue was read from
 
 class CategorySummaryData: # Corresponds to the summary part of OH_CATEGORY_DATA
     def __init__(self,
@@ -85,6 +61,8 @@ class CategorySummaryData: # Corresponds to the summary part of OH_CATEGORY_DATA
         self.marketable_limit_order_pct = marketable_limit_order_pct
         self.non_marketable_limit_order_pct = non_marketable_limit_order_pct
         self.other_order_pct = other_order_pct
+        self.source_row = None        # Excel row (1-based) of the summary values
+        self.source_start_col = None  # Column index of the first summary value (market orders %)
 
 class SecurityCategoryData: # Corresponds to OH_CATEGORY_DATA
     # name is CategoryNameType (e.g., "NMS Stock")
@@ -121,6 +99,51 @@ def get_first_month_of_quarter(quarter_str: str) -> str:
     q_map = {"1": "1", "2": "4", "3": "7", "4": "10"}
     return q_map.get(str(quarter_str).strip(), "1") # Default to 1 if invalid
 
+# --- Venue payment fields, in the order the XSD lists their Usd/Cph elements ---
+VENUE_PAYMENT_ORDER_TYPES = ["Market", "MarketableLimit", "NonMarketableLimit", "Other"]
+VENUE_USD_FIELDS = ["net_pmt_paid_recv_market_orders_usd", "net_pmt_paid_recv_marketable_limit_orders_usd",
+                    "net_pmt_paid_recv_non_marketable_limit_orders_usd", "net_pmt_paid_recv_other_orders_usd"]
+VENUE_CPH_FIELDS = ["net_pmt_paid_recv_market_orders_cph", "net_pmt_paid_recv_marketable_limit_orders_cph",
+                    "net_pmt_paid_recv_non_marketable_limit_orders_cph", "net_pmt_paid_recv_other_orders_cph"]
+
+# --- <rVenue> child elements -> the VenueData attribute they are written from ---
+# (orderPct has no VenueData attribute; it is always written as NM)
+VENUE_XML_FIELDS = {
+    "name": "venue_name", "marketPct": "market_order_pct", "marketableLimitPct": "marketable_limit_order_pct",
+    "nonMarketableLimitPct": "non_marketable_limit_order_pct", "otherPct": "other_order_pct",
+    **{f"netPmtPaidRecv{order_type}OrdersUsd": field_name for order_type, field_name in zip(VENUE_PAYMENT_ORDER_TYPES, VENUE_USD_FIELDS)},
+    **{f"netPmtPaidRecv{order_type}OrdersCph": field_name for order_type, field_name in zip(VENUE_PAYMENT_ORDER_TYPES, VENUE_CPH_FIELDS)},
+    "materialAspects": "payment_disclosure_link", "mic": "mic", "mpid": "mpid",
+}
+
+# --- Parsed category names -> their <rMonthly> element (OrderRoutingType) ---
+CATEGORY_XSD_ELEMENTS = {
+    "NMS Stock": "rSP500",
+    "Other NMS Stock": "rOtherStocks", # Adjusted from "Other OTC Stock" to align with common XSD usage
+    "Option": "rOptions"
+}
+
+# --- Source columns of generated elements, used to point validation errors at Excel cells ---
+# Venue elements -> column index in the venue row (see the Excel Col comments in _parse_single_security_category)
+VENUE_SOURCE_COLUMNS = {
+    "name": 0, "mic": 0, "mpid": 0, "marketPct": 1, "marketableLimitPct": 2, "nonMarketableLimitPct": 3, "otherPct": 4,
+    "netPmtPaidRecvMarketOrdersUsd": 5, "netPmtPaidRecvMarketableLimitOrdersUsd": 6,
+    "netPmtPaidRecvNonMarketableLimitOrdersUsd": 7, "netPmtPaidRecvOtherOrdersUsd": 8,
+}
+# Category summary elements -> offset from the first summary value column
+SUMMARY_SOURCE_COLUMN_OFFSETS = {
+    "ndoPct": 0, "ndoMarketPct": 1, "ndoMarketableLimitPct": 1, "ndoNonmarketableLimitPct": 2, "ndoOtherPct": 3,
+}
+
+def _record_sources(element_sources, parent_el, source_row, column_indexes, column_offset=0):
+    """Remembers the Excel row (and column, where one exists) behind parent_el and each of its children."""
+    if source_row is None:
+        return
+    element_sources[parent_el] = (source_row, None)
+    for child in parent_el:
+        column_index = column_indexes.get(child.tag)
+        element_sources[child] = (source_row, excel_column_letter(column_index + column_offset) if column_index is not None else None)
+
 # --- Placeholder Excel Parsing Functions (Needs Robust Implementation) ---
 # These functions would populate instances of SecurityCategoryData from the Excel sheet.
 
@@ -172,27 +195,16 @@ def _parse_single_security_category(df, category_name_in_excel, category_xml_tag
                         print(f"DEBUG {category_name_in_excel}: NDO data using start_col_idx: {ndo_data_start_col_idx} (first cell was: '{first_cell_value_ndo}')")
 
                     num_cols_in_row = len(summary_values_row)
+                    category_data.summary.source_row = summary_data_actual_idx + 1
+                    category_data.summary.source_start_col = ndo_data_start_col_idx
 
-                    # Parse NDO percentages using the determined start index, with bounds checking
-                    if num_cols_in_row > ndo_data_start_col_idx:
-                        category_data.summary.market_order_pct = format_pct_or_nm(summary_values_row.iloc[ndo_data_start_col_idx])
-                    else:
-                        category_data.summary.market_order_pct = ""
-
-                    if num_cols_in_row > ndo_data_start_col_idx + 1:
-                        category_data.summary.marketable_limit_order_pct = format_pct_or_nm(summary_values_row.iloc[ndo_data_start_col_idx + 1])
-                    else:
-                        category_data.summary.marketable_limit_order_pct = ""
-
-                    if num_cols_in_row > ndo_data_start_col_idx + 2:
-                        category_data.summary.non_marketable_limit_order_pct = format_pct_or_nm(summary_values_row.iloc[ndo_data_start_col_idx + 2])
-                    else:
-                        category_data.summary.non_marketable_limit_order_pct = ""
-
-                    if num_cols_in_row > ndo_data_start_col_idx + 3:
-                        category_data.summary.other_order_pct = format_pct_or_nm(summary_values_row.iloc[ndo_data_start_col_idx + 3])
-                    else:
-                        category_data.summary.other_order_pct = ""
+                    # Parse the four NDO percentages in one call; cells past the end of the row are NM
+                    summary_cells = [summary_values_row.iloc[col_idx] if col_idx < num_cols_in_row else np.nan
+                                     for col_idx in range(ndo_data_start_col_idx, ndo_data_start_col_idx + 4)]
+                    (category_data.summary.market_order_pct,
+                     category_data.summary.marketable_limit_order_pct,
+                     category_data.summary.non_marketable_limit_order_pct,
+                     category_data.summary.other_order_pct) = format_pct(summary_cells)
 
                 except Exception as e:
                     print(f"Error parsing NDO summary data for {category_name_in_excel} at row index {summary_data_actual_idx}: {e}")
@@ -224,38 +236,14 @@ def _parse_single_security_category(df, category_name_in_excel, category_xml_tag
             venues_label_idx = venues_label_rows.index[0]
             venue_data_start_idx = venues_label_idx + 2 # Venues data starts 2 rows after 'Venues' label (Label -> Headers -> Data)
 
-        # Helper function to get and convert cell values for venues
-        def get_value_from_row(row_data, column_index, is_percentage_val=False, default_return_val=np.nan):
-            try:
-                cell_value_str = str(row_data.iloc[column_index]).strip()
-                if cell_value_str == "":
-                    # print(f"DEBUG get_value_from_row: Empty string for col {column_index}, treating as 0.0")
-                    return 0.0  # Treat genuinely empty strings (that Excel might format as 0) as 0.0
-                
-                numeric_value = pd.to_numeric(cell_value_str, errors='coerce')
-                
-                if pd.isna(numeric_value):
-                    # print(f"DEBUG get_value_from_row: Coercion to NaN for col {column_index}, val '{cell_value_str}'")
-                    return np.nan # Return NaN if coercion failed (e.g. for 'N/A')
-                
-                if is_percentage_val:
-                    return numeric_value / 100.0
-                return numeric_value
-            except IndexError:
-                # print(f"WARN: IndexError for col {column_index} in {category_name_in_excel} venues. Row: {row_data.iloc[0] if len(row_data)>0 else 'Unknown'}")
-                return default_return_val
-            except Exception as e:
-                # print(f"ERROR: Unexpected error in get_value_from_row (col {column_index}, val '{row_data.iloc[column_index] if column_index < len(row_data) else 'OOB'}'): {e}")
-                return default_return_val
-
-        # Parse venue data
+        # Find the venue rows first (column A only), then convert their cells as one block
+        venue_rows = []
         empty_row_counter = 0
         for idx in range(venue_data_start_idx, len(df)):
-            current_row_values = df.iloc[idx]
-            venue_name_raw = current_row_values.iloc[0]
+            venue_name_raw = df.iat[idx, 0]
 
             if pd.isna(venue_name_raw) or str(venue_name_raw).strip() == "":
-                if current_row_values.isna().all() or (str(df.iloc[idx,0]).strip() == "" and all(pd.isna(df.iloc[idx,j]) for j in range(1,df.shape[1]))):
+                if df.iloc[idx].isna().all() or (str(df.iloc[idx,0]).strip() == "" and all(pd.isna(df.iloc[idx,j]) for j in range(1,df.shape[1]))):
                     print(f"End of venue data for '{category_name_in_excel}' at index {idx} (empty or mostly empty row).")
                     break
                 # If first cell is empty but others might have data, treat as end of venues for this section
@@ -267,19 +255,36 @@ def _parse_single_security_category(df, category_name_in_excel, category_xml_tag
             if venue_name in ["S&P 500 Stocks", "Non-S&P 500 stocks", "Options", "2nd Quarter, 2024"] or venue_name.startswith("Outset does not have"):
                 print(f"End of venue data for '{category_name_in_excel}' at index {idx} (new section/footer found: '{venue_name}').")
                 break
-
+            venue_rows.append(idx)
+
+        # Columns A-I; a sheet narrower than that reads as NM for the missing columns
+        venue_block = df.iloc[venue_rows].reindex(columns=range(9))
+        venue_pcts = format_pct(venue_block.iloc[:, 1:5].to_numpy(), scale=100)  # Excel Cols B-E, entered as 26.4 for 0.264
+        venue_usd = to_numbers(venue_block.iloc[:, 5:9].to_numpy())  # Excel Cols F-I
+        venue_names = [str(name).strip() for name in venue_block.iloc[:, 0]]
+        # MIC/MPID from the local venue reference index (venue_reference.py); '' where the venue is not known
+        venue_index = shared_venue_index()
+        venue_matches = venue_index.resolve_many(venue_names)
+        if venue_names:
+            print(f"Resolved MIC/MPID for {resolution_summary(venue_matches)} in '{category_name_in_excel}'.")
+        for warning in venue_index.unresolved_warnings(venue_names, venue_matches):
+            print(f"Warning: {warning}")
+
+        for position, idx in enumerate(venue_rows):
+            venue_name = venue_names[position]
+            venue_match = venue_matches[position]
             venue_item = VenueData(
-                venue_name=get_value_from_row(current_row_values, 0),
-                market_order_pct=format_pct_or_nm(get_value_from_row(current_row_values, 1, is_percentage_val=True)), # Excel Col B
-                marketable_limit_order_pct=format_pct_or_nm(get_value_from_row(current_row_values, 2, is_percentage_val=True)), # Excel Col C
-                non_marketable_limit_order_pct=format_pct_or_nm(get_value_from_row(current_row_values, 3, is_percentage_val=True)), # Excel Col D
-                other_order_pct=format_pct_or_nm(get_value_from_row(current_row_values, 4, is_percentage_val=True)), # Excel Col E
+                venue_name=venue_name,
+                market_order_pct=venue_pcts[position, 0],
+                marketable_limit_order_pct=venue_pcts[position, 1],
+                non_marketable_limit_order_pct=venue_pcts[position, 2],
+                other_order_pct=venue_pcts[position, 3],
                 
-                # USD payment fields from Excel columns F, G, H, I
-                net_pmt_paid_recv_market_orders_usd=get_value_from_row(current_row_values, 5), # Excel Col F
-                net_pmt_paid_recv_marketable_limit_orders_usd=get_value_from_row(current_row_values, 6), # Excel Col G
-                net_pmt_paid_recv_non_marketable_limit_orders_usd=get_value_from_row(current_row_values, 7), # Excel Col H
-                net_pmt_paid_recv_other_orders_usd=get_value_from_row(current_row_values, 8), # Excel Col I
+                # USD payment fields from Excel columns F, G, H, I (NaN where blank or not a number)
+                net_pmt_paid_recv_market_orders_usd=venue_usd[position, 0],
+                net_pmt_paid_recv_marketable_limit_orders_usd=venue_usd[position, 1],
+                net_pmt_paid_recv_non_marketable_limit_orders_usd=venue_usd[position, 2],
+                net_pmt_paid_recv_other_orders_usd=venue_usd[position, 3],
                 
                 # CPH fields are not present per venue in Excel, so set to None
                 net_pmt_paid_recv_market_orders_cph=None,
@@ -288,11 +293,13 @@ def _parse_single_security_category(df, category_name_in_excel, category_xml_tag
                 net_pmt_paid_recv_other_orders_cph=None,
                 
                 payment_disclosure_link="Does not have a profit sharing arrangement with or receive rebates or payments for order flow from any of the above venues/market centers.",
-                mic="", # Placeholder, remains empty as per user guidance
-                mpid="" # Placeholder, remains empty as per user guidance
+                mic=venue_match.mic if venue_match else "",
+                mpid=venue_match.mpid if venue_match else "",
+                source_row=idx + 1 # DataFrame is read with header=None, so index 0 is Excel row 1
             )
             category_data.venues.append(venue_item)
             print(f"Added venue: {venue_name}")
+        count_progress(sections_parsed=1, venues_parsed=len(category_data.venues))
 
     except Exception as e:
         print(f"Error parsing category '{category_name_in_excel}': {e}")
@@ -304,8 +311,9 @@ def _parse_single_security_category(df, category_name_in_excel, category_xml_tag
 def parse_excel_data(excel_filepath, material_aspects_text, firm_name_param, report_year_param, report_qtr_param):
     """Parses the entire Excel file and returns a NmsHeldOrderRoutingReportData object."""
     print(f"Reading Excel file: {excel_filepath}")
+    report_progress('reading')
     try:
-        df = pd.read_excel(excel_filepath, header=None)  # Read without headers initially
+        df = read_excel_cached(excel_filepath, header=None)  # Read without headers initially; cached by content hash
     except FileNotFoundError:
         print(f"Error: Excel file not found at {excel_filepath}")
         return None
@@ -344,6 +352,7 @@ def parse_excel_data(excel_filepath, material_aspects_text, firm_name_param, rep
         "Options": "Option" # Or "Listed Options"
     }
 
+    report_progress('parsing', rows_read=len(df), sections_total=len(excel_to_xsd_category_map))
     for excel_section_name, xsd_category_name in excel_to_xsd_category_map.items():
         category_data = _parse_single_security_category(
             df, excel_section_name, xsd_category_name, common_material_aspects_text
@@ -359,60 +368,55 @@ def parse_excel_data(excel_filepath, material_aspects_text, firm_name_param, rep
     print("Finished parsing Excel data.")
     return quarterly_data_for_months
 
-# --- XSD Validation Function ---
-def validate_xml_against_xsd(xml_filepath, xsd_filepath):
-    """Validates an XML file against an XSD schema.
-
-    Args:
-        xml_filepath (str): The path to the XML file to validate.
-        xsd_filepath (str): The path to the XSD schema file.
-
-    Returns:
-        tuple: (bool, list) where bool is True if valid, False otherwise,
-               and list contains error messages if invalid, or is empty if valid.
-    """
-    if not os.path.exists(xml_filepath):
-        # print(f"Error: XML file not found at {xml_filepath}") # Keep for debugging if needed
-        return False, [f"XML file not found at {xml_filepath}"]
-    if not os.path.exists(xsd_filepath):
-        # print(f"Error: XSD schema file not found at {xsd_filepath}") # Keep for debugging if needed
-        return False, [f"XSD schema file not found at {xsd_filepath}"]
-
-    try:
-        xml_doc = etree.parse(xml_filepath)
-        xsd_doc = etree.parse(xsd_filepath)
-        xmlschema = etree.XMLSchema(xsd_doc)
-
-        is_valid = xmlschema.validate(xml_doc)
-
-        if is_valid:
-            # print(f"Validation successful: '{os.path.basename(xml_filepath)}' is valid against '{os.path.basename(xsd_filepath)}'.")
-            return True, []
-        else:
-            # print(f"Validation failed: '{os.path.basename(xml_filepath)}' is invalid against '{os.path.basename(xsd_filepath)}'.")
-            # print("Validation Errors:")
-            error_messages = []
-            for error in xmlschema.error_log:
-                # print(f"  - Line {error.line}, Column {error.column}: {error.message} (Domain: {error.domain_name}, Type: {error.type_name})")
-                error_messages.append(f"Line {error.line}, Col {error.column}: {error.message}")
-            return False, error_messages
-    except etree.XMLSyntaxError as e:
-        # print(f"XML Syntax Error: Could not parse XML file '{os.path.basename(xml_filepath)}'. Error: {e}")
-        return False, [f"XML Syntax Error: {e}"]
-    except Exception as e:
-        # print(f"An unexpected error occurred during validation: {e}")
-        return False, [f"Unexpected validation error: {e}"]
+# --- Report model snapshot (report_snapshot.py): re-render the XML without re-reading the workbook ---
+SUMMARY_SNAPSHOT_FIELDS = ["market_order_pct", "marketable_limit_order_pct", "non_marketable_limit_order_pct",
+                           "other_order_pct", "source_row", "source_start_col"]
+VENUE_SNAPSHOT_FIELDS = [f.name for f in dataclass_fields(VenueData)]
+
+def save_report_snapshot(report_data, snapshot_filepath, excel_filepath, material_aspects_text, source_sheet=None):
+    """Saves a parsed NmsHeldOrderRoutingReportData as JSON lines: a category record (with its summary) followed
+    by one record per venue, in report order."""
+    header = {"version": report_data.version, "firm_name": report_data.firm_name, "year": report_data.year,
+              "qtr": report_data.qtr, "material_aspects_text": material_aspects_text,
+              "source_file": os.path.basename(excel_filepath), "source_sheet": source_sheet}
+    records = []
+    for directed, categories in [(False, report_data.s_non_directed_categories), (True, report_data.s_directed_categories)]:
+        for category in categories:
+            records.append(attributes_record("category", category.summary, SUMMARY_SNAPSHOT_FIELDS,
+                                             name=category.name, directed=directed))
+            records.extend(attributes_record("venue", venue, VENUE_SNAPSHOT_FIELDS) for venue in category.venues)
+    return write_snapshot(snapshot_filepath, '6151', header, records)
+
+def load_report_snapshot(snapshot_filepath):
+    """(NmsHeldOrderRoutingReportData, header) from a saved report model."""
+    header, records = read_snapshot(snapshot_filepath, '6151')
+    report_data = NmsHeldOrderRoutingReportData(header["version"], header["firm_name"], header["year"], header["qtr"], [], [])
+    category = None
+    for record in records:
+        if record["record"] == "category":
+            summary = CategorySummaryData(*(record[name] for name in SUMMARY_SNAPSHOT_FIELDS[:4]))
+            summary.source_row, summary.source_start_col = record["source_row"], record["source_start_col"]
+            category = SecurityCategoryData(record["name"], summary, [])
+            (report_data.s_directed_categories if record["directed"] else report_data.s_non_directed_categories).append(category)
+        elif record["record"] == "venue":
+            category.venues.append(VenueData(**{name: record.get(name) for name in VENUE_SNAPSHOT_FIELDS}))
+    return report_data, header
 
 # --- Main XML Generation Function ---
 def create_finra_6151_xml(excel_filepath, output_xml_filepath, 
                             firm_name, # Used for the <firmName> element
                             reporting_year, reporting_quarter, 
-                            material_aspects_text): # Common material aspects text
+                            material_aspects_text, # Common material aspects text
+                            source_map=None, # SourceMap to fill with XML line -> Excel row/column
+                            snapshot_filepath=None, # Where to save the parsed report model (report_snapshot.py)
+                            record_history=True): # Record the venues in the filings history once the XML is valid
     """ 
     Main function to parse Excel, build XML structure, and write to file.
+    Returns the number of venues written (None if the Excel file could not be parsed).
     """
     
     # 1. Parse Excel Data into structured objects
+    stage_started = time.perf_counter()
     quarterly_report_month_data = parse_excel_data(
         excel_filepath, 
         material_aspects_text, 
@@ -420,9 +424,42 @@ def create_finra_6151_xml(excel_filepath, output_xml_filepath,
         reporting_year, 
         reporting_quarter
     )
+    observe_stage('6151', 'read', time.perf_counter() - stage_started)
     if quarterly_report_month_data is None:
         print("Halting XML generation due to Excel parsing error.")
         return
+    if snapshot_filepath:
+        save_report_snapshot(quarterly_report_month_data, snapshot_filepath, excel_filepath, material_aspects_text,
+                             source_map.sheet if source_map is not None else None)
+
+    venues_written = write_finra_6151_xml(quarterly_report_month_data, output_xml_filepath, source_map)
+
+    # 7. Validate the generated XML against the XSD
+    stage_started = time.perf_counter()
+    is_valid, errors, validation_stats = validate_xml_file(output_xml_filepath, XSD_FILE_PATH, source_map)
+    observe_stage('6151', 'validate', time.perf_counter() - stage_started)
+    if is_valid:
+        print("XML validation successful.")
+    else:
+        print("XML validation failed. Errors:")
+        for err in errors:
+            print(f"- {err}")
+    print(f"--- {format_validation_stats(validation_stats)} ---")
+    # Keep the venue set for quarter-over-quarter comparison (filings_store.py diff --kind 6151); an invalid
+    # report is not a filing, so it never replaces the stored one
+    if is_valid and record_history:
+        record_venue_filing(quarterly_report_month_data, excel_filepath)
+    elif record_history:
+        print("Filings history: the XML is not valid; not recorded.")
+    return venues_written
+
+def write_finra_6151_xml(quarterly_report_month_data, output_xml_filepath, source_map=None):
+    """Builds the XML of a parsed report (NmsHeldOrderRoutingReportData) and writes it to output_xml_filepath,
+    filling source_map with the Excel row/column behind each element. Returns the number of venues written."""
+    stage_started = time.perf_counter()
+    report_progress('writing')
+    venues_written = 0
+    element_sources = {} # element -> (Excel row, column letter) for mapping validation errors back
 
     # 2. Create the root XML element based on XSD (heldOrderRoutingPublicReport)
     root = etree.Element("heldOrderRoutingPublicReport")
@@ -443,14 +480,9 @@ def create_finra_6151_xml(excel_filepath, output_xml_filepath,
 
     # 5. Populate <rMonthly> with data from parsed categories (rSP500, rOtherStocks, rOptions)
     # These map to OrderRoutingType in XSD, which matches our CategorySummaryData structure.
-    category_to_xsd_element_map = {
-        "NMS Stock": "rSP500",
-        "Other NMS Stock": "rOtherStocks", # Adjusted from "Other OTC Stock" to align with common XSD usage
-        "Option": "rOptions"
-    }
-
+    # Category names map to OrderRoutingType elements (see CATEGORY_XSD_ELEMENTS)
     for security_category_data in quarterly_report_month_data.s_non_directed_categories:
-        xsd_element_name = category_to_xsd_element_map.get(security_category_data.name)
+        xsd_element_name = CATEGORY_XSD_ELEMENTS.get(security_category_data.name)
         if not xsd_element_name:
             print(f"Warning: Unknown category '{security_category_data.name}' found in parsed data. Skipping.")
             continue
@@ -465,22 +497,40 @@ def create_finra_6151_xml(excel_filepath, output_xml_filepath,
         _add_element(category_summary_el, "ndoMarketableLimitPct", summary_data.marketable_limit_order_pct)
         _add_element(category_summary_el, "ndoNonmarketableLimitPct", summary_data.non_marketable_limit_order_pct)
         _add_element(category_summary_el, "ndoOtherPct", summary_data.other_order_pct)
+        _record_sources(element_sources, category_summary_el, summary_data.source_row, SUMMARY_SOURCE_COLUMN_OFFSETS,
+                        summary_data.source_start_col or 0)
 
         # Add <rVenues> container within the category summary element
         rVenues_el = _add_element(category_summary_el, "rVenues")
 
-        for venue_data in security_category_data.venues:
+        # Format the payment columns of all venues in the category at once (one row per venue)
+        venues = security_category_data.venues
+        venue_usd = format_decimal2(column_block(venues, VENUE_USD_FIELDS))
+        venue_cph = format_cph4(column_block(venues, VENUE_CPH_FIELDS))
+        mics_written = set()
+
+        for position, venue_data in enumerate(venues):
+            venues_written += 1
             rVenue_el = _add_element(rVenues_el, "rVenue") # Each venue is an <rVenue>
             _add_element(rVenue_el, "name", venue_data.venue_name) # CORRECTED from venueName to name
+            # mic and mpid follow the name; the XSD allows each MIC only once per <rVenues>
+            if venue_data.mic and venue_data.mic not in mics_written:
+                mics_written.add(venue_data.mic)
+                _add_element(rVenue_el, "mic", venue_data.mic)
+            elif venue_data.mic:
+                print(f"Warning: MIC {venue_data.mic} of '{venue_data.venue_name}' already used by another venue in {xsd_element_name}; leaving it out.")
+            if venue_data.mpid:
+                _add_element(rVenue_el, "mpid", venue_data.mpid)
             # Add <orderPct> - Total % of orders in this category routed to this venue.
             # Placeholder: Use empty string for now. User needs to confirm source from Excel.
-            _add_element(rVenue_el, "orderPct", format_pct_or_nm("")) 
+            _add_element(rVenue_el, "orderPct", NOT_MEANINGFUL)
 
             # Add other venue-specific fields from VenueData, matching XSD elements for rVenue
-            _add_element(rVenue_el, "marketPct", format_pct_or_nm(venue_data.market_order_pct)) 
-            _add_element(rVenue_el, "marketableLimitPct", format_pct_or_nm(venue_data.marketable_limit_order_pct))
-            _add_element(rVenue_el, "nonMarketableLimitPct", format_pct_or_nm(venue_data.non_marketable_limit_order_pct))
-            _add_element(rVenue_el, "otherPct", format_pct_or_nm(venue_data.other_order_pct))
+            # (percentages were formatted when the venue block was parsed)
+            _add_element(rVenue_el, "marketPct", venue_data.market_order_pct)
+            _add_element(rVenue_el, "marketableLimitPct", venue_data.marketable_limit_order_pct)
+            _add_element(rVenue_el, "nonMarketableLimitPct", venue_data.non_marketable_limit_order_pct)
+            _add_element(rVenue_el, "otherPct", venue_data.other_order_pct)
             
             # The following elements (avgExecSize, avgNetExecRate, marketCenterFeeRate) do NOT belong in rVenue.
             # They belong in the parent rSecurityType element (e.g. rSP500).
@@ -489,21 +539,15 @@ def create_finra_6151_xml(excel_filepath, output_xml_filepath,
             # _add_element(rVenue_el, "marketCenterFeeRate", "") # REMOVED
 
             # Payment and material aspects elements DO belong in rVenue as per XSD
-            _add_element(rVenue_el, "netPmtPaidRecvMarketOrdersUsd", format_decimal2_or_nm(venue_data.net_pmt_paid_recv_market_orders_usd))
-            _add_element(rVenue_el, "netPmtPaidRecvMarketOrdersCph", format_cph4_or_nm(venue_data.net_pmt_paid_recv_market_orders_cph))
-            _add_element(rVenue_el, "netPmtPaidRecvMarketableLimitOrdersUsd", format_decimal2_or_nm(venue_data.net_pmt_paid_recv_marketable_limit_orders_usd))
-            _add_element(rVenue_el, "netPmtPaidRecvMarketableLimitOrdersCph", format_cph4_or_nm(venue_data.net_pmt_paid_recv_marketable_limit_orders_cph))
-            _add_element(rVenue_el, "netPmtPaidRecvNonMarketableLimitOrdersUsd", format_decimal2_or_nm(venue_data.net_pmt_paid_recv_non_marketable_limit_orders_usd))
-            _add_element(rVenue_el, "netPmtPaidRecvNonMarketableLimitOrdersCph", format_cph4_or_nm(venue_data.net_pmt_paid_recv_non_marketable_limit_orders_cph))
-            _add_element(rVenue_el, "netPmtPaidRecvOtherOrdersUsd", format_decimal2_or_nm(venue_data.net_pmt_paid_recv_other_orders_usd))
-            _add_element(rVenue_el, "netPmtPaidRecvOtherOrdersCph", format_cph4_or_nm(venue_data.net_pmt_paid_recv_other_orders_cph))
+            for order_type, usd_text, cph_text in zip(VENUE_PAYMENT_ORDER_TYPES, venue_usd[position], venue_cph[position]):
+                _add_element(rVenue_el, f"netPmtPaidRecv{order_type}OrdersUsd", usd_text)
+                _add_element(rVenue_el, f"netPmtPaidRecv{order_type}OrdersCph", cph_text)
             # Add materialAspects for this venue if present
             if venue_data.payment_disclosure_link: # Changed from material_aspects to payment_disclosure_link
                 _add_element(rVenue_el, "materialAspects", venue_data.payment_disclosure_link)
-            # Optional fields like mic, mpid, paymentDisclosureLink would be added here if available
-            # _add_element(rVenue_el, "mic", venue_data.mic) # If present
-            # _add_element(rVenue_el, "mpid", venue_data.mpid) # If present
+            # Optional paymentDisclosureLink would be added here if available
             # _add_element(rVenue_el, "paymentDisclosureLink", venue_data.payment_disclosure_link) # If present
+            _record_sources(element_sources, rVenue_el, venue_data.source_row, VENUE_SOURCE_COLUMNS)
 
     # Handle s_directed_categories similarly if they exist and are needed for this report type
     # For 606(a)(1), usually only non-directed are detailed this way.
@@ -533,25 +577,42 @@ def create_finra_6151_xml(excel_filepath, output_xml_filepath,
     #             if venue_data.material_aspects: # Add material aspects if they exist
     #                 _add_element(ven_el, "materialAspects", venue_data.material_aspects)
 
+    observe_stage('6151', 'build', time.perf_counter() - stage_started)
+
     # 6. Write the XML to file
+    stage_started = time.perf_counter()
     tree = etree.ElementTree(root)
     tree.write(output_xml_filepath, pretty_print=True, xml_declaration=True, encoding='UTF-8')
+    observe_stage('6151', 'serialize', time.perf_counter() - stage_started)
+    report_progress(venues_written=venues_written)
     print(f"Successfully generated XML: {output_xml_filepath}")
-
-    # 7. Validate the generated XML against the XSD
-    is_valid, errors = validate_xml_against_xsd(output_xml_filepath, XSD_FILE_PATH)
-    if is_valid:
-        print("XML validation successful.")
-    else:
-        print("XML validation failed. Errors:")
-        for err in errors:
-            print(f"- {err}")
+    if source_map is not None:
+        # pretty_print puts every start tag on its own line, so the line of each element is known without re-parsing
+        for element, line in pretty_printed_lines(root):
+            if element in element_sources:
+                source_map.add_line(line, *element_sources[element])
+    return venues_written
 
 # --- New Wrapper Function for Module Usage ---
-def perform_6151_conversion(excel_filepath, output_dir, firm_name, year, qtr):
+def output_xml_filename_for(firm_name, year, qtr):
+    """FirmName_606_NMS_YYYY_QQ.xml, with the first word of the firm name made alphanumeric."""
+    sanitized_firm_name = "".join(c if c.isalnum() else "_" for c in firm_name.split(" ")[0]) # First word, alphanumeric
+    return f"{sanitized_firm_name}_606_NMS_{year}_Q{qtr}.xml"
+
+def _profile_location(args, kwargs, result):
+    """Profiles go next to the generated XML, or next to the input in the output directory when none was written."""
+    if result and result[0]:
+        return result[0]
+    excel_filepath = kwargs.get('excel_filepath', args[0] if args else 'conversion')
+    output_dir = kwargs.get('output_dir', args[1] if len(args) > 1 else '.')
+    return os.path.join(output_dir, os.path.basename(excel_filepath))
+
+@profiled_conversion(_profile_location)
+def perform_6151_conversion(excel_filepath, output_dir, firm_name, year, qtr, record_history=True):
     """
     Callable function to perform the 6151 conversion.
     Manages file paths and calls the core XML creation logic.
+    A valid report is recorded in the filings history unless record_history is False.
     Returns a tuple: (path_to_xml_file, validation_status, validation_errors).
     validation_status is True if valid, False otherwise.
     validation_errors is a list of error messages if invalid, or an empty list if valid.
@@ -578,45 +639,100 @@ def perform_6151_conversion(excel_filepath, output_dir, firm_name, year, qtr):
     # Example: FirmName_606_NMS_YYYY_QQ.xml
     # For now, let's stick to a simpler derivation and ensure it uses the provided params
     # Ensure CIK (if available and part of firm_name) or a sanitized firm_name is used
-    sanitized_firm_name = "".join(c if c.isalnum() else "_" for c in firm_name.split(" ")[0]) # First word, alphanumeric
-    output_xml_filename = f"{sanitized_firm_name}_606_NMS_{year}_Q{qtr}.xml"
-    output_xml_filepath = os.path.join(output_dir, output_xml_filename)
+    output_xml_filepath = os.path.join(output_dir, output_xml_filename_for(firm_name, year, qtr))
 
     print(f"Output XML will be: {output_xml_filepath}")
 
-    try:
-        # Call the main XML creation function
-        create_finra_6151_xml(
-            excel_filepath=excel_filepath,
-            output_xml_filepath=output_xml_filepath,
-            firm_name=firm_name,
-            reporting_year=str(year),
-            reporting_quarter=str(qtr),
-            material_aspects_text=material_aspects_text
-        )
-        print(f"Successfully generated XML: {output_xml_filepath}")
-
-        # Validate the generated XML
-        print(f"Validating '{output_xml_filepath}' against XSD: '{XSD_FILE_PATH}'")
-        is_valid, errors = validate_xml_against_xsd(output_xml_filepath, XSD_FILE_PATH)
-
-        return output_xml_filepath, is_valid, errors
+    with track_conversion('6151', excel_filepath) as metrics_record:
+        try:
+            # Call the main XML creation function
+            source_map = SourceMap(first_sheet_name(excel_filepath))
+            venues_written = create_finra_6151_xml(
+                excel_filepath=excel_filepath,
+                output_xml_filepath=output_xml_filepath,
+                firm_name=firm_name,
+                reporting_year=str(year),
+                reporting_quarter=str(qtr),
+                material_aspects_text=material_aspects_text,
+                source_map=source_map,
+                snapshot_filepath=snapshot_path(output_xml_filepath) if SAVE_REPORT_SNAPSHOTS else None,
+                record_history=record_history
+            )
+            print(f"Successfully generated XML: {output_xml_filepath}")
+
+            # Validate the generated XML; errors point back at the Excel sheet/row/column they came from
+            print(f"Validating '{output_xml_filepath}' against XSD: '{XSD_FILE_PATH}'")
+            is_valid, errors, _ = validate_xml_file(output_xml_filepath, XSD_FILE_PATH, source_map)
+
+            metrics_record["items"] = venues_written or 0
+            if not is_valid:
+                metrics_record["outcome"] = "invalid"
+                record_error('6151', 'schema_invalid')
+            return output_xml_filepath, is_valid, errors
+
+        except Exception as e:
+            # Errors are returned rather than raised, so count them here
+            metrics_record["outcome"] = "error"
+            record_error('6151', type(e).__name__)
+            print(f"Error during 6151 conversion process: {e}")
+            # In case of an error during XML creation itself, we can't validate
+            return None, False, [f"Error during XML creation: {e}"]
+
+def render_6151_snapshot(snapshot_filepath, output_dir, firm_name=None, year=None, qtr=None,
+                         material_aspects_text=None, output_xml_filename=None):
+    """Render-only 6151 conversion: writes the XML of a saved report model (see save_report_snapshot) without
+    reading the workbook again. firm_name, year and qtr replace the saved ones when given; material_aspects_text
+    replaces every venue's materialAspects text. The file is named like perform_6151_conversion's output unless
+    output_xml_filename is given. Validation errors still point at the original workbook's rows. Not recorded
+    in the filings history. Returns (path_to_xml_file, validation_status, validation_errors)."""
+    report_data, header = load_report_snapshot(snapshot_filepath)
+    report_data.firm_name = str(firm_name) if firm_name else report_data.firm_name
+    report_data.year = str(year) if year else report_data.year
+    report_data.qtr = str(qtr) if qtr else report_data.qtr
+    if material_aspects_text is not None:
+        for category in report_data.s_non_directed_categories + report_data.s_directed_categories:
+            for venue in category.venues:
+                venue.payment_disclosure_link = material_aspects_text
 
-    except Exception as e:
-        print(f"Error during 6151 conversion process: {e}")
-        # In case of an error during XML creation itself, we can't validate
-        return None, False, [f"Error during XML creation: {e}"]
+    os.makedirs(output_dir, exist_ok=True)
+    output_xml_filepath = os.path.join(output_dir, output_xml_filename or
+                                       output_xml_filename_for(report_data.firm_name, report_data.year, report_data.qtr))
+    print(f"Rendering 6151 XML from '{snapshot_filepath}' (parsed from {header.get('source_file')}) to '{output_xml_filepath}'")
+    source_map = SourceMap(header.get("source_sheet"))
+    write_finra_6151_xml(report_data, output_xml_filepath, source_map)
+    is_valid, errors, validation_stats = validate_xml_file(output_xml_filepath, XSD_FILE_PATH, source_map)
+    print(f"--- {format_validation_stats(validation_stats)} ---")
+    return output_xml_filepath, is_valid, errors
 
 # --- Main execution --- 
 def main():
     parser = argparse.ArgumentParser(description="Convert FINRA Order Handling Excel to XML.")
-    parser.add_argument("excel_path", help="Path to the input Excel file.")
+    parser.add_argument("excel_path", help="Path to the input Excel file, or a saved report model (*.report.jsonl) to render again without re-reading the workbook.")
     parser.add_argument("output_dir", help="Directory to save the output XML file.")
     parser.add_argument("firm_name", help="Firm name (e.g., Example Firm).")
     parser.add_argument("year", help="Year (e.g., 2023).")
     parser.add_argument("qtr", help="Quarter (e.g., 1 for Q1).")
+    parser.add_argument("--json", action="store_true", help="Print the result (output path, validity and validation errors with their Excel sheet/row/column) as JSON.")
+    parser.add_argument("--profile", action="store_true", help="Profile the conversion; writes <output>.prof and <output>.collapsed.txt next to the XML.")
+    parser.add_argument("--material-aspects", help="With a saved report model: materialAspects text for every venue.")
     args = parser.parse_args()
 
+    if is_snapshot(args.excel_path):
+        with contextlib.redirect_stdout(sys.stderr) if args.json else contextlib.nullcontext():
+            output_xml_file, is_valid, errors = render_6151_snapshot(args.excel_path, args.output_dir, args.firm_name,
+                                                                     args.year, args.qtr, args.material_aspects)
+        if args.json:
+            print(json.dumps({"output_xml": output_xml_file, "valid": bool(is_valid), "errors": issues_as_dicts(errors)}, indent=2))
+        return
+
+    if args.json:
+        # Progress output goes to stderr so stdout is only the JSON result
+        with contextlib.redirect_stdout(sys.stderr):
+            output_xml_file, is_valid, errors = perform_6151_conversion(args.excel_path, args.output_dir, args.firm_name, args.year, args.qtr,
+                                                                        profile=args.profile or None)
+        print(json.dumps({"output_xml": output_xml_file, "valid": bool(is_valid), "errors": issues_as_dicts(errors)}, indent=2))
+        return
+
     print(f"Starting XML generation for Firm {args.firm_name}, Q{args.qtr} {args.year}.")
     print(f"Input Excel: {args.excel_path}")
     # Output path will be determined and printed within perform_6151_conversion or create_finra_6151_xml
@@ -629,7 +745,8 @@ def main():
             output_dir=args.output_dir,
             firm_name=args.firm_name, 
             year=args.year, # year and qtr are strings from argparse
-            qtr=args.qtr
+            qtr=args.qtr,
+            profile=args.profile or None
         )
         # The success message and validation output are handled within create_finra_6151_xml
     except Exception as e:
@@ -0,0 +1,24 @@
+import os
+import shutil
+
+# gunicorn loads this file automatically (Procfile: web: gunicorn app:app).
+# Metrics from every worker are shared through prometheus_client's multiprocess mode; the directory has to be
+# set before the workers import the app, and emptied at startup so counters from a previous run don't leak in.
+os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', os.path.join('/tmp', 'edgar_converter_metrics'))
+
+# One worker process serving requests on threads: conversions run on the scheduler's own process pool, so a web
+# worker mostly waits, and every request reaches the same scheduler, whose deadline order, fair share and queue
+# limits are per process (conversion_scheduler.py). An open /progress poll or slow upload only takes one thread.
+# --workers / --threads on the command line override these.
+workers = 1
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', '16'))
+
+def on_starting(server):
+    metrics_dir = os.environ['PROMETHEUS_MULTIPROC_DIR']
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+    os.makedirs(metrics_dir, exist_ok=True)
+
+def child_exit(server, worker):
+    from conversion_metrics import mark_process_dead
+    mark_process_dead(worker.pid)
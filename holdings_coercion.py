@@ -0,0 +1,99 @@
+import numpy as np
+import pandas as pd
+
+# Typed coercion for 13F holdings. COLUMN_MAPPINGS declares each field's type ("is_numeric"/"numeric_type"); the
+# plan compiled from it converts whole columns at once to nullable dtypes, so every chunk of a file comes out with
+# the same dtypes and the XML writer can serialize the typed arrays without converting cell by cell:
+#   integer -> Int64 (blank, unparseable and fractional cells become <NA>; holdings_rules.py reports every such
+#              non-blank cell as a row-level error, parsing it with number_of as well)
+#   float   -> float64 (blank and unparseable cells become NaN, or the field's "fill_value")
+#   text    -> object holding stripped str, None for blank cells; whole numbers lose Excel's trailing ".0"
+
+_DTYPES = {"integer": "Int64", "float": "float64", "text": "object"}
+
+def compile_coercion_plan(column_mappings):
+    """Returns {field_key: {"kind", "dtype", "fill_value"}} for a COLUMN_MAPPINGS dict."""
+    plan = {}
+    for field_key, mapping in column_mappings.items():
+        if not mapping.get("is_numeric"):
+            kind = "text"
+        else:
+            kind = "integer" if mapping.get("numeric_type") == int else "float"
+        plan[field_key] = {"kind": kind, "dtype": _DTYPES[kind], "fill_value": mapping.get("fill_value")}
+    return plan
+
+def _text_of(value):
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    text = str(value).strip()
+    return text or None
+
+def number_of(value):
+    """A cell as pd.to_numeric should see it: text cells may carry thousands separators or spaces ("1,200 ")."""
+    if isinstance(value, str):
+        return value.replace(",", "").strip() or None
+    return value
+
+def coerce_column(values, rule):
+    """Coerces one column according to its plan entry. Returns (typed Series, stats dict)."""
+    stats = {"dtype": rule["dtype"], "rows": len(values), "blank": 0, "invalid": 0,
+             "fractional": 0, "from_text": 0, "filled": 0}
+    if values.dtype == object or rule["kind"] == "text":
+        # Mixed cells are converted once per distinct value, then expanded back to the rows
+        codes, uniques = pd.factorize(values)
+        texts = [_text_of(value) for value in uniques]
+        blank = np.append(np.array([text is None for text in texts], dtype=bool), True)[codes]
+        if rule["kind"] == "text":
+            typed = pd.Series(np.array(texts + [None], dtype=object)[codes], index=values.index, dtype=object)
+        else:
+            parsed = pd.to_numeric(pd.Series([number_of(value) for value in uniques], dtype=object), errors="coerce")
+            parsed = parsed.to_numpy(dtype="float64")
+            from_text = np.array([isinstance(value, str) for value in uniques], dtype=bool) & ~np.isnan(parsed)
+            numbers = pd.Series(np.append(parsed, np.nan)[codes], index=values.index)
+            stats["from_text"] = int(np.append(from_text, False)[codes].sum())
+    else:
+        blank = values.isna().to_numpy()
+        numbers = values.astype("float64") if pd.api.types.is_bool_dtype(values) else values
+    stats["blank"] = int(blank.sum())
+
+    if rule["kind"] != "text":
+        stats["invalid"] = int((numbers.isna().to_numpy() & ~blank).sum())
+        if rule["kind"] == "integer":
+            if pd.api.types.is_float_dtype(numbers):
+                fractional = numbers.notna() & (numbers != numbers.round())
+                stats["fractional"] = int(fractional.sum())
+                numbers = numbers.mask(fractional)
+            typed = numbers.astype("Int64")
+        else:
+            typed = numbers.astype("float64")
+        if rule["fill_value"] is not None:
+            stats["filled"] = int(typed.isna().sum())
+            typed = typed.fillna(rule["fill_value"])
+    return typed, stats
+
+def coerce_holdings(df, resolved_cols, plan):
+    """Applies the plan to every resolved column of df (in place) and returns (df, stats), where stats maps each
+    Excel column name to its conversion statistics: dtype, rows, blank, invalid (non-blank cells that did not
+    convert), fractional (non-whole numbers in integer fields), from_text (numbers parsed from text cells) and
+    filled (cells set to the field's fill_value)."""
+    stats = {}
+    for field_key, col in resolved_cols.items():
+        if col in stats or col not in df.columns:  # A positional fallback can resolve two fields to one column
+            continue
+        df[col], stats[col] = coerce_column(df[col], plan[field_key])
+    return df, stats
+
+def merge_coercion_stats(total, stats):
+    """Adds a chunk's statistics into running totals (streamed conversions coerce chunk by chunk)."""
+    for col, column_stats in stats.items():
+        if col not in total:
+            total[col] = dict(column_stats)
+            continue
+        for key, value in column_stats.items():
+            if key != "dtype":
+                total[col][key] += value
+    return total
+
+def integer_texts(values):
+    """Int64/int64 column -> list of decimal strings, '' for <NA>."""
+    return values.astype("string").fillna("").tolist()
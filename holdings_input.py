@@ -0,0 +1,153 @@
+import os
+import csv
+import numpy as np
+import pandas as pd
+import openpyxl
+from openpyxl.cell.cell import TYPE_ERROR, TYPE_NUMERIC
+from pandas.io.parsers import TextParser
+from workbook_cache import read_excel_cached
+
+# Holdings can be supplied as an Excel workbook or as a CSV/Parquet export from the portfolio system.
+# CSV and Parquet are read with pyarrow and never go through openpyxl. pyarrow is imported when such a file is
+# read, so Excel-only installs (and the parsed-workbook cache's fallback) work without it.
+SUPPORTED_HOLDINGS_EXTENSIONS = ('.xlsx', '.csv', '.parquet')
+
+# Rows per chunk when streaming; peak memory scales with this, not with the file size
+DEFAULT_STREAM_CHUNK_SIZE = 20000
+
+def holdings_format(input_path):
+    """Returns 'xlsx', 'csv' or 'parquet' from the file extension, or raises ValueError."""
+    extension = os.path.splitext(input_path)[1].lower()
+    if extension not in SUPPORTED_HOLDINGS_EXTENSIONS:
+        raise ValueError(f"Unsupported holdings file type '{extension}'. Expected one of: {', '.join(SUPPORTED_HOLDINGS_EXTENSIONS)}.")
+    return extension.lstrip('.')
+
+def _arrow_modules():
+    """(pyarrow, pyarrow.csv, pyarrow.parquet), imported on first use."""
+    try:
+        import pyarrow as pa
+        import pyarrow.csv as pa_csv
+        import pyarrow.parquet as pq
+    except ImportError as e:
+        raise ImportError(f"Reading CSV or Parquet holdings needs pyarrow, which is not installed: {e}") from e
+    return pa, pa_csv, pq
+
+def read_holdings_table(input_path):
+    """Reads a whole holdings file into a DataFrame with header row 0, whatever its format."""
+    file_format = holdings_format(input_path)
+    if file_format == 'xlsx':
+        # Re-runs of the same workbook come from the parsed-workbook cache
+        return read_excel_cached(input_path, header=0)
+    _, pa_csv, pq = _arrow_modules()
+    if file_format == 'csv':
+        return _table_to_frame(pa_csv.read_csv(input_path, **_csv_options(input_path)))
+    # Memory-mapped, so the column buffers are read straight from the page cache
+    return _table_to_frame(pq.read_table(input_path, memory_map=True))
+
+def iter_holdings_chunks(input_path, chunk_size=DEFAULT_STREAM_CHUNK_SIZE):
+    """Yields a holdings file as DataFrames of at most chunk_size rows. Each chunk's index continues from
+    the previous one, so row positions match a full read_holdings_table(). A header row without data yields
+    one empty chunk with the columns; a file without a header row yields nothing."""
+    file_format = holdings_format(input_path)
+    if file_format == 'xlsx':
+        yield from _iter_workbook_chunks(input_path, chunk_size)
+        return
+
+    pa, pa_csv, pq = _arrow_modules()
+    if file_format == 'csv':
+        batches = pa_csv.open_csv(input_path, **_csv_options(input_path))
+        schema = batches.schema
+    else:
+        parquet_file = pq.ParquetFile(input_path, memory_map=True)
+        batches = parquet_file.iter_batches(batch_size=chunk_size)
+        schema = parquet_file.schema_arrow
+
+    offset = 0
+    for batch in batches:
+        # CSV batches are sized in bytes, so slice them to keep chunks within chunk_size rows
+        for start in range(0, batch.num_rows, chunk_size):
+            frame = _table_to_frame(pa.Table.from_batches([batch.slice(start, chunk_size)]))
+            frame.index = pd.RangeIndex(offset, offset + len(frame))
+            offset += len(frame)
+            yield frame
+    if offset == 0 and len(schema):
+        yield _table_to_frame(schema.empty_table())
+
+# --- CSV / Parquet helpers ---
+def _csv_options(input_path):
+    """Every column is read as text so CUSIPs and other codes keep their leading zeros; numeric fields are
+    coerced later against COLUMN_MAPPINGS. Column labels follow pandas (blank -> "Unnamed: N", duplicates -> "X.1")."""
+    with open(input_path, newline='', encoding='utf-8-sig') as csv_file:
+        header = next(csv.reader(csv_file), [])
+    columns = TextParser([header], header=0).read().columns.tolist() if header else []
+    pa, pa_csv, _ = _arrow_modules()
+    return {
+        "read_options": pa_csv.ReadOptions(column_names=columns, skip_rows=1),
+        "convert_options": pa_csv.ConvertOptions(column_types={col: pa.string() for col in columns}, strings_can_be_null=True),
+    }
+
+def _table_to_frame(table):
+    frame = table.to_pandas()
+    # Arrow nulls arrive as None in text columns; use NaN like read_excel does
+    for col in frame.columns:
+        if frame[col].dtype == object:
+            frame[col] = frame[col].where(frame[col].notna(), np.nan)
+    return frame
+
+# --- Excel streaming helpers ---
+def _iter_workbook_chunks(input_xlsx, chunk_size):
+    """Yield the first sheet of input_xlsx as DataFrames of at most chunk_size rows, streamed in openpyxl read-only mode.
+       Cells are converted and labelled exactly as pd.read_excel(header=0) would. Cells beyond the header width are ignored."""
+    workbook = openpyxl.load_workbook(input_xlsx, read_only=True, data_only=True)
+    try:
+        sheet = workbook.worksheets[0]
+        sheet.reset_dimensions()
+        rows = (_convert_row(row) for row in sheet.rows)
+        header = next(rows, None)
+        if header is None:
+            return
+        # Let pandas derive the labels so "Unnamed: N" and duplicate suffixes match read_excel
+        columns = TextParser([header], header=0).read().columns.tolist()
+
+        chunk, pending_empty_rows, offset = [], [], 0
+        for row in rows:
+            if not row:
+                # Trailing empty rows are dropped by read_excel, so only keep these if data follows
+                pending_empty_rows.append(row)
+                continue
+            chunk.extend(pending_empty_rows)
+            pending_empty_rows = []
+            chunk.append(row)
+            if len(chunk) >= chunk_size:
+                yield _chunk_frame(chunk, columns, offset)
+                offset += len(chunk)
+                chunk = []
+        if chunk or offset == 0:
+            # Without data rows this is one empty chunk that still carries the header's columns
+            yield _chunk_frame(chunk, columns, offset)
+    finally:
+        workbook.close()
+
+def _convert_row(cells):
+    """Converts one row of read-only cells the way pandas' openpyxl reader does, trimming trailing empty cells."""
+    row = []
+    for cell in cells:
+        if cell.value is None:
+            row.append("")
+        elif cell.data_type == TYPE_ERROR:
+            row.append(np.nan)
+        elif cell.data_type == TYPE_NUMERIC:
+            val = int(cell.value)
+            row.append(val if val == cell.value else float(cell.value))
+        else:
+            row.append(cell.value)
+    while row and row[-1] == "":
+        row.pop()
+    return row
+
+def _chunk_frame(chunk, columns, offset):
+    width = len(columns)
+    padded = [row[:width] + [""] * (width - len(row)) for row in chunk]
+    frame = TextParser(padded, header=None, names=columns).read()
+    frame.index = pd.RangeIndex(offset, offset + len(frame))
+    return frame
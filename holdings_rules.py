@@ -0,0 +1,233 @@
+import re
+import time
+import numpy as np
+import pandas as pd
+from holdings_coercion import number_of
+
+# Pre-flight data-quality rules for 13F holdings. Every rule is a vectorized check over whole columns of the
+# resolved DataFrame, so a full filing is checked in one pass before any XML is written, and every problem is
+# reported with its Excel row instead of surfacing one at a time at XSD validation or at EDGAR.
+
+# Violations listed individually in the report (the total and per-rule counts always cover all of them)
+MAX_REPORTED_RULE_VIOLATIONS = 1000
+
+# Allowed values, as in eis_13FDocument.xsd
+SHARES_TYPES = ("SH", "PRN")
+PUT_CALL_VALUES = ("Put", "Call")
+INVESTMENT_DISCRETIONS = ("SOLE", "DFND", "OTR")
+# ENTITY_NAME_TYPE_STRING pattern for the issuer name
+_ISSUER_NAME_PATTERN = r"[A-Za-z0-9\s!\\#$(),.:;`=@'\-{}|/&]+"
+_ISSUER_NAME_DISALLOWED = re.compile(r"[^A-Za-z0-9\s!\\#$(),.:;`=@'\-{}|/&]")
+# INTEGER_NONNEGATIVE_16 / INTEGER_TYPE_16_MIN_0: at most 16 digits
+_MAX_16_DIGITS = 9999999999999999
+
+# Mapping keys of the text fields every infoTable entry needs
+REQUIRED_TEXT_FIELDS = ["name_of_issuer", "title_of_class", "cusip", "shares_type_col", "investment_discretion_col"]
+# Mapping keys of the numeric fields that must hold a non-negative number
+AMOUNT_FIELDS = ["value_col", "shares_amount_col", "sole_voting_col", "shared_voting_col", "none_voting_col"]
+VOTING_FIELDS = ["sole_voting_col", "shared_voting_col", "none_voting_col"]
+
+class HoldingsColumns:
+    """Column views of a holdings DataFrame, converted once per column and shared by all rules.
+    Text checks run on each column's distinct values only (factorized), then map back to the rows, so
+    low-cardinality columns like Shares/Principal or Investment Discretion cost one hash pass."""
+
+    def __init__(self, df, resolved_cols):
+        self.df = df
+        self.resolved_cols = resolved_cols
+        self._texts = {}
+        self._numbers = {}
+        self._blank = {}
+
+    def has(self, field_key):
+        col = self.resolved_cols.get(field_key)
+        return col is not None and col in self.df.columns
+
+    def raw(self, field_key):
+        return self.df[self.resolved_cols[field_key]]
+
+    def _distinct_text(self, field_key):
+        """(codes, texts): row -> distinct value code (-1 for NaN) and each distinct value stripped as the XML
+        writer emits it."""
+        if field_key not in self._texts:
+            values = self.raw(field_key)
+            codes, uniques = pd.factorize(values)
+            texts = pd.Series(uniques, dtype=object).astype(str).str.strip()
+            if pd.api.types.is_float_dtype(values):  # 0.0 from a numeric column is written as "0"
+                texts = texts.str.replace(r"\.0$", "", regex=True)
+            self._texts[field_key] = (codes, texts)
+        return self._texts[field_key]
+
+    def matches(self, field_key, predicate):
+        """Rows whose non-blank text satisfies predicate, a vectorized function of a Series of distinct texts."""
+        codes, texts = self._distinct_text(field_key)
+        per_value = np.append(np.asarray(predicate(texts), dtype=bool) & (texts != "").to_numpy(), False)
+        return pd.Series(per_value[codes], index=self.df.index)
+
+    def blank(self, field_key):
+        if field_key not in self._blank:
+            values = self.raw(field_key)
+            if pd.api.types.is_numeric_dtype(values):
+                self._blank[field_key] = values.isna()
+            else:
+                codes, texts = self._distinct_text(field_key)
+                self._blank[field_key] = pd.Series(np.append((texts == "").to_numpy(), True)[codes], index=self.df.index)
+        return self._blank[field_key]
+
+    def number(self, field_key):
+        """Numeric values, parsed as holdings_coercion does (so "1,200.5" is a fractional number, not text);
+        blank and unparseable cells are NaN."""
+        if field_key not in self._numbers:
+            values = self.raw(field_key)
+            if values.dtype == object:
+                codes, uniques = pd.factorize(values)
+                parsed = pd.to_numeric(pd.Series([number_of(value) for value in uniques], dtype=object), errors="coerce")
+                numbers = pd.Series(np.append(parsed.to_numpy(dtype="float64"), np.nan)[codes], index=values.index)
+            else:
+                numbers = pd.to_numeric(values, errors="coerce")
+            self._numbers[field_key] = numbers
+        return self._numbers[field_key]
+
+    def blank_rows(self):
+        """Rows with nothing in any resolved column (e.g. trailing formatted rows of a worksheet)."""
+        blank = pd.Series(True, index=self.df.index)
+        for field_key in self.resolved_cols:
+            if self.has(field_key):
+                blank &= self.blank(field_key)
+        return blank
+
+def _rule(rule_id, field_key, message, check, severity="error", requires=None):
+    return {"rule": rule_id, "field": field_key, "severity": severity, "message": message, "check": check,
+            "requires": requires or ([field_key] if field_key else [])}
+
+def build_holdings_rules(column_mappings):
+    """The rule set for a COLUMN_MAPPINGS dict. Each rule is a dict with "rule", "field" (mapping key whose column
+    is reported, None for whole-row rules), "severity", "message", "requires" (mapping keys that must be resolved
+    for the rule to run) and "check", a function of HoldingsColumns returning a boolean Series that is True for
+    violating rows."""
+    rules = [_rule("blank_row", None, "Row is blank in every holdings column; it would be written as an empty holding.",
+                   lambda c: c.blank_rows())]
+
+    for field_key in REQUIRED_TEXT_FIELDS:
+        rules.append(_rule("required_blank", field_key, f"{column_mappings[field_key]['primary']} is blank.",
+                           lambda c, f=field_key: c.blank(f)))
+
+    for field_key in AMOUNT_FIELDS:
+        label = column_mappings[field_key]["primary"]
+        rules += [
+            _rule("not_numeric", field_key, f"{label} is not a number.",
+                  lambda c, f=field_key: c.number(f).isna() & ~c.blank(f)),
+            _rule("negative", field_key, f"{label} is negative.",
+                  lambda c, f=field_key: c.number(f) < 0),
+            _rule("too_many_digits", field_key, f"{label} has more than 16 digits.",
+                  lambda c, f=field_key: c.number(f).abs() > _MAX_16_DIGITS),
+        ]
+        # A blank value is written as 0; blank share or voting counts are written as-is and fail the schema
+        severity, effect = ("warning", " It is reported as 0.") if field_key == "value_col" else ("error", "")
+        rules.append(_rule("amount_blank", field_key, f"{label} is blank.{effect}",
+                           lambda c, f=field_key: c.blank(f), severity=severity))
+
+    # Share counts and voting authority must be whole numbers; the value is rounded to the dollar when written
+    for field_key, mapping in column_mappings.items():
+        if mapping.get("is_numeric") and mapping.get("numeric_type") == int:
+            rules.append(_rule("non_integer", field_key, f"{mapping['primary']} is not a whole number. It is written as an empty element.",
+                               lambda c, f=field_key: c.number(f).notna() & (c.number(f) != c.number(f).round())))
+
+    rules += [
+        _rule("shares_type", "shares_type_col", "Shares/Principal must be SH or PRN.",
+              lambda c: c.matches("shares_type_col", lambda t: ~t.isin(SHARES_TYPES))),
+        _rule("put_call", "put_call", "put/call must be Put, Call or blank.",
+              lambda c: c.matches("put_call", lambda t: ~t.isin(PUT_CALL_VALUES))),
+        _rule("investment_discretion", "investment_discretion_col", "Investment Discretion must be SOLE, DFND or OTR.",
+              lambda c: c.matches("investment_discretion_col", lambda t: ~t.isin(INVESTMENT_DISCRETIONS))),
+        _rule("cusip_format", "cusip", "CUSIP must be 9 letters or digits.",
+              lambda c: c.matches("cusip", lambda t: ~t.str.fullmatch(r"[A-Za-z0-9]{9}"))),
+        _rule("figi_format", "figi", "FIGI must be 12 letters or digits.",
+              lambda c: c.matches("figi", lambda t: ~t.str.fullmatch(r"[A-Za-z0-9]{12}"))),
+        _rule("issuer_name_length", "name_of_issuer", "Name of Issuer is longer than 150 characters.",
+              lambda c: c.matches("name_of_issuer", lambda t: t.str.len() > 150)),
+        _rule("issuer_name_characters", "name_of_issuer", "Name of Issuer contains characters EDGAR does not accept.",
+              lambda c: c.matches("name_of_issuer", _issuer_name_invalid)),
+        _rule("title_length", "title_of_class", "Title of Class is longer than 150 characters.",
+              lambda c: c.matches("title_of_class", lambda t: t.str.len() > 150)),
+        _rule("other_managers_length", "other_managers_col", "Other Managers is longer than 100 characters.",
+              lambda c: c.matches("other_managers_col", lambda t: t.str.len() > 100)),
+        _rule("voting_exceeds_shares", "shares_amount_col",
+              "Sole + Shared + None voting authority exceeds Shares or Principal Amount.", _voting_exceeds_shares,
+              requires=["shares_amount_col", "sole_voting_col"]),
+    ]
+    return rules
+
+def _issuer_name_invalid(names):
+    # Nearly every filing passes, so one scan over all names first; per-name matching only when something fails
+    if not _ISSUER_NAME_DISALLOWED.search("\n".join(names)):
+        return np.zeros(len(names), dtype=bool)
+    return ~names.str.fullmatch(_ISSUER_NAME_PATTERN)
+
+def _voting_exceeds_shares(columns):
+    voting_total = sum(columns.number(f).fillna(0) for f in VOTING_FIELDS if columns.has(f))
+    shares = columns.number("shares_amount_col")
+    return shares.notna() & (voting_total > shares)
+
+def check_holdings(df, resolved_cols, rules, max_reported=MAX_REPORTED_RULE_VIOLATIONS):
+    """Evaluates every rule over df (raw values, before numeric preparation) and returns a report dict:
+       rows_checked, violation_count, error_count (violations of error severity), counts (per rule), violations
+       (row-sorted dicts with row, rule, severity, column, value and message; at most max_reported) and seconds.
+       Excel row = DataFrame index + 2.
+       Blank rows are reported once as blank_row and skipped by the other rules."""
+    started = time.perf_counter()
+    columns = HoldingsColumns(df, resolved_cols)
+    blank_rows = columns.blank_rows().to_numpy()
+    excel_rows = np.asarray(df.index) + 2
+    counts = {}
+    found = []  # (positions, rule) per rule with violations
+    for rule in rules:
+        if not all(columns.has(field_key) for field_key in rule["requires"]):
+            continue
+        mask = rule["check"](columns).fillna(False).to_numpy(dtype=bool)
+        if rule["rule"] != "blank_row":
+            mask &= ~blank_rows
+        positions = np.flatnonzero(mask)
+        if len(positions):
+            counts[rule["rule"]] = counts.get(rule["rule"], 0) + len(positions)
+            found.append((positions, rule))
+
+    violation_count = sum(len(positions) for positions, _ in found)
+    # Counted over every violation, not only the reported ones, so a pass/fail decision sees all of them
+    error_count = sum(len(positions) for positions, rule in found if rule["severity"] == "error")
+    violations = []
+    if found:
+        # Order by row, then by rule order, and only build dicts for the violations that are reported
+        all_positions = np.concatenate([positions for positions, _ in found])
+        rule_numbers = np.concatenate([np.full(len(positions), n) for n, (positions, _) in enumerate(found)])
+        order = np.lexsort((rule_numbers, all_positions))[:max_reported]
+        for position, rule_number in zip(all_positions[order], rule_numbers[order]):
+            rule = found[rule_number][1]
+            column = resolved_cols.get(rule["field"]) if rule["field"] else None
+            value = df[column].iat[position] if column else None
+            violations.append({"row": int(excel_rows[position]), "rule": rule["rule"], "severity": rule["severity"],
+                               "column": column, "value": None if pd.isna(value) else str(value),
+                               "message": rule["message"]})
+    return {"rows_checked": len(df), "violation_count": violation_count, "error_count": error_count, "counts": counts,
+            "violations": violations, "seconds": time.perf_counter() - started}
+
+def new_rule_report():
+    return {"rows_checked": 0, "violation_count": 0, "error_count": 0, "counts": {}, "violations": [], "seconds": 0.0}
+
+def merge_rule_report(total, report, max_reported=MAX_REPORTED_RULE_VIOLATIONS):
+    """Folds a chunk's report into a running one (streamed conversions check chunk by chunk)."""
+    total["rows_checked"] += report["rows_checked"]
+    total["violation_count"] += report["violation_count"]
+    total["error_count"] += report["error_count"]
+    total["seconds"] += report["seconds"]
+    for rule_id, count in report["counts"].items():
+        total["counts"][rule_id] = total["counts"].get(rule_id, 0) + count
+    total["violations"].extend(report["violations"][:max(0, max_reported - len(total["violations"]))])
+    return total
+
+def format_violation(violation):
+    location = f"Excel row {violation['row']}"
+    if violation["column"]:
+        location += f", column '{violation['column']}'"
+    value = f" (value '{violation['value']}')" if violation["value"] is not None else ""
+    return f"{location}: {violation['message']}{value}"
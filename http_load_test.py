@@ -0,0 +1,371 @@
+import os
+import re
+import sys
+import glob
+import json
+import time
+import asyncio
+import argparse
+import datetime
+import platform
+import itertools
+import threading
+import subprocess
+import tempfile
+import shutil
+import numpy as np
+import pandas as pd
+from holdings_input import read_holdings_table
+from slow_client_load_test import PROJECT_ROOT, DEFAULT_UPLOAD_FILE, multipart_body, start_server, stop_server, percentile
+
+# HTTP load test for sizing a deployment. Starts the web app locally under gunicorn with the given number of workers
+# and threads (using the repository's gunicorn.conf.py), then runs each concurrency level for a fixed time:
+# every virtual user converts a workbook with POST /convert, downloads the result from the page's
+# /download/<token>/<file> link, and starts over with the next workbook. The workbooks are the repository's 13F and
+# 6151 samples plus synthetic 13F workbooks of the given row counts, generated from a sample. For each level
+# the report has p50/p95/p99 latency per endpoint, throughput, error rate and the server's memory (whole process
+# tree and the largest web worker with its conversion processes). It is saved as JSON; --compare shows two
+# saved runs (deployments or code versions) side by side.
+#   python http_load_test.py --workers 2 --threads 4 --concurrency 1 4 16 --duration 30
+#   python http_load_test.py --compare load_results/before.json load_results/after.json
+
+SAMPLE_13F_FILES = sorted(glob.glob(os.path.join(PROJECT_ROOT, 'Input', '*.xlsx')) +
+                          glob.glob(os.path.join(PROJECT_ROOT, 'Test Input files 13F', '*.xlsx')))
+SAMPLE_6151_FILES = sorted(glob.glob(os.path.join(PROJECT_ROOT, 'Test file Finra 6151', '*.xlsx')))
+# Synthetic workbooks are generated once and reused by later runs
+SYNTHETIC_DIR = os.path.join(PROJECT_ROOT, 'cache', 'load_test')
+DEFAULT_SYNTHETIC_ROWS = [5000, 50000]
+RESULTS_DIR = 'load_results'
+# Requests slower than this count as failed
+REQUEST_TIMEOUT_SECONDS = 300.0
+MEMORY_SAMPLE_INTERVAL_SECONDS = 0.25
+_DOWNLOAD_LINK = re.compile(rb'href="/download/([^"]+)"')
+_PERIOD_IN_NAME = re.compile(r'(20\d{2}).*?Q([1-4])', re.IGNORECASE)
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+# --- Workloads ---
+def sample_workloads(include_6151=True):
+    """The repository's sample workbooks as workloads: {"name", "path", "conversion_type", "fields"}."""
+    workloads = [{"name": os.path.basename(path), "path": path, "conversion_type": '13F',
+                  "fields": {'conversion_type': '13F'}} for path in SAMPLE_13F_FILES]
+    for path in SAMPLE_6151_FILES if include_6151 else []:
+        period = _PERIOD_IN_NAME.search(os.path.basename(path))
+        if period:
+            workloads.append({"name": os.path.basename(path), "path": path, "conversion_type": '6151',
+                              "fields": {'conversion_type': '6151', 'year': period.group(1), 'qtr': period.group(2)}})
+    return workloads
+
+def synthetic_workbook(rows, template_path=DEFAULT_UPLOAD_FILE, output_dir=SYNTHETIC_DIR, seed=13):
+    """A 13F workbook of the given number of rows: the template's holdings drawn at random (real CUSIPs) with
+    their amounts scaled, so the file converts and validates like a real one. Returns its path."""
+    path = os.path.join(output_dir, f"synthetic_13F_{rows}_rows.xlsx")
+    if os.path.exists(path):
+        return path
+    os.makedirs(output_dir, exist_ok=True)
+    template = read_holdings_table(template_path)
+    rng = np.random.default_rng(seed)
+    df = template.iloc[rng.integers(0, len(template), rows)].reset_index(drop=True)
+    scale = rng.integers(1, 10, rows)
+    for column in df.columns:
+        if pd.api.types.is_numeric_dtype(df[column]):
+            df[column] = df[column] * scale
+    print(f"Generating synthetic workbook with {rows} rows: {path}")
+    tmp_path = path + '.tmp.xlsx'
+    df.to_excel(tmp_path, index=False)
+    os.replace(tmp_path, path)
+    return path
+
+def synthetic_workloads(row_counts):
+    return [{"name": os.path.basename(path), "path": path, "conversion_type": '13F', "fields": {'conversion_type': '13F'}}
+            for path in (synthetic_workbook(rows) for rows in row_counts)]
+
+# --- Server ---
+def server_command(server, workers, threads, timeout=None):
+    """gunicorn command line for the Flask app (sync) or the ASGI app (async, uvicorn workers)."""
+    command = ['gunicorn', 'app:app' if server == 'sync' else 'asgi_app:app',
+               '--config', os.path.join(PROJECT_ROOT, 'gunicorn.conf.py'), '--bind', '127.0.0.1:{port}',
+               '--workers', str(workers)]
+    if server == 'sync':
+        command += ['--threads', str(threads)]
+    else:
+        command += ['--worker-class', 'uvicorn.workers.UvicornWorker']
+    if timeout:
+        command += ['--timeout', str(timeout)]
+    return command
+
+def _process_table():
+    """{pid: (parent pid, resident bytes)} of every process, from /proc. Empty where /proc is unavailable."""
+    table = {}
+    for entry in os.listdir('/proc') if os.path.isdir('/proc') else []:
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as stat:
+                parent = int(stat.read().rsplit(')', 1)[1].split()[1])
+            with open(f'/proc/{entry}/statm') as statm:
+                rss = int(statm.read().split()[1]) * _PAGE_SIZE
+        except (OSError, ValueError, IndexError):
+            continue  # Exited while being read
+        table[int(entry)] = (parent, rss)
+    return table
+
+def _descendants(pid, children):
+    found, pending = [pid], [pid]
+    while pending:
+        for child in children.get(pending.pop(), ()):
+            found.append(child)
+            pending.append(child)
+    return found
+
+class MemorySampler(threading.Thread):
+    """Samples the resident memory of a server's process tree. With workers_are_children (gunicorn), each child of
+    the root is a web worker whose own children (the scheduler's conversion processes) count towards it."""
+
+    def __init__(self, root_pid, workers_are_children=True, interval=MEMORY_SAMPLE_INTERVAL_SECONDS):
+        super().__init__(daemon=True)
+        self.root_pid = root_pid
+        self.workers_are_children = workers_are_children
+        self.interval = interval
+        self.totals, self.worker_peak, self.processes_peak = [], 0, 0
+        self._stop_sampling = threading.Event()
+
+    def sample(self):
+        table = _process_table()
+        if self.root_pid not in table:
+            return
+        children = {}
+        for pid, (parent, _) in table.items():
+            children.setdefault(parent, []).append(pid)
+        tree = _descendants(self.root_pid, children)
+        self.totals.append(sum(table[pid][1] for pid in tree))
+        self.processes_peak = max(self.processes_peak, len(tree))
+        workers = children.get(self.root_pid, []) if self.workers_are_children else [self.root_pid]
+        for worker in workers:
+            self.worker_peak = max(self.worker_peak, sum(table[pid][1] for pid in _descendants(worker, children)))
+
+    def run(self):
+        self.sample()
+        while not self._stop_sampling.wait(self.interval):
+            self.sample()
+
+    def stop(self):
+        self._stop_sampling.set()
+        self.join()
+        to_mb = lambda size: round(size / (1024 * 1024), 1)
+        return {"memory_total_peak_mb": to_mb(max(self.totals)) if self.totals else None,
+                "memory_total_mean_mb": to_mb(sum(self.totals) / len(self.totals)) if self.totals else None,
+                "worker_memory_peak_mb": to_mb(self.worker_peak) if self.worker_peak else None,
+                "processes_peak": self.processes_peak or None}
+
+# --- Clients ---
+async def http_request(port, method, path, body=b'', headers=None, timeout=REQUEST_TIMEOUT_SECONDS):
+    """One HTTP/1.1 request on its own connection. Returns (status, response body)."""
+    async def exchange():
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        try:
+            head = f'{method} {path} HTTP/1.1\r\nHost: 127.0.0.1\r\nConnection: close\r\nContent-Length: {len(body)}\r\n'
+            head += ''.join(f'{name}: {value}\r\n' for name, value in (headers or {}).items())
+            writer.write(head.encode() + b'\r\n' + body)
+            await writer.drain()
+            return await reader.read()
+        finally:
+            writer.close()
+    raw = await asyncio.wait_for(exchange(), timeout)
+    header_block, _, payload = raw.partition(b'\r\n\r\n')
+    status_line = header_block.split(b'\r\n', 1)[0].split()
+    return (int(status_line[1]) if len(status_line) > 1 else 0), payload
+
+async def _timed(samples, endpoint, workload, request):
+    """Awaits request (returning (status, body)), appends its sample and returns the body (None when it failed)."""
+    started = time.perf_counter()
+    try:
+        status, payload = await request
+    except (asyncio.TimeoutError, OSError) as e:
+        status, payload = type(e).__name__, None
+    sample = {"endpoint": endpoint, "workload": workload, "status": status, "seconds": time.perf_counter() - started}
+    samples.append(sample)
+    return sample, payload
+
+async def convert_and_download(port, workload, sequence, samples):
+    """One user iteration: upload the workbook to /convert, then download the file the result page links.
+    A conversion counts as failed unless the page is a 200 with a download link."""
+    fields = dict(workload["fields"])
+    if workload["conversion_type"] == '6151':
+        # The 6151 output is named after the firm's first word; keep concurrent conversions apart
+        fields['firm_name'] = f"Load{sequence} Test"
+    stem, extension = os.path.splitext(workload["name"])
+    body, content_type = multipart_body(workload["path"], fields, filename=f"{stem}-load{sequence}{extension}")
+    sample, page = await _timed(samples, 'convert', workload["name"],
+                                http_request(port, 'POST', '/convert', body, {'Content-Type': content_type}))
+    link = _DOWNLOAD_LINK.search(page or b'')
+    sample["ok"] = sample["status"] == 200 and link is not None
+    if not sample["ok"]:
+        return
+    sample, _ = await _timed(samples, 'download', workload["name"],
+                             http_request(port, 'GET', f'/download/{link.group(1).decode()}', headers={'Accept-Encoding': 'gzip'}))
+    sample["ok"] = sample["status"] == 200
+
+async def virtual_user(port, workloads, deadline, sequence, samples):
+    while time.monotonic() < deadline:
+        number = next(sequence)
+        await convert_and_download(port, workloads[number % len(workloads)], number, samples)
+
+async def run_level(port, concurrency, workloads, duration):
+    """concurrency users converting and downloading for duration seconds. Returns (samples, elapsed seconds);
+    iterations in flight at the deadline are finished and counted."""
+    samples, sequence = [], itertools.count()
+    deadline = time.monotonic() + duration
+    started = time.perf_counter()
+    await asyncio.gather(*(virtual_user(port, workloads, deadline, sequence, samples) for _ in range(concurrency)))
+    return samples, time.perf_counter() - started
+
+async def warm_up(port, workloads):
+    """Converts every workload once, so imports and caches in fresh worker processes are not measured."""
+    samples = []
+    for number, workload in enumerate(workloads):
+        await convert_and_download(port, workload, f"warmup{number}", samples)
+    return [sample for sample in samples if not sample["ok"]]
+
+# --- Reporting ---
+def _latency_summary(samples):
+    seconds = [sample["seconds"] for sample in samples if sample["ok"]]
+    to_ms = lambda value: None if value is None else round(value * 1000, 1)
+    return {"requests": len(samples), "errors": sum(1 for sample in samples if not sample["ok"]),
+            "p50_ms": to_ms(percentile(seconds, 0.5)), "p95_ms": to_ms(percentile(seconds, 0.95)),
+            "p99_ms": to_ms(percentile(seconds, 0.99)), "max_ms": to_ms(max(seconds) if seconds else None)}
+
+def summarize_level(concurrency, samples, elapsed, memory):
+    errors = sum(1 for sample in samples if not sample["ok"])
+    statuses = {}
+    for sample in samples:
+        statuses[str(sample["status"])] = statuses.get(str(sample["status"]), 0) + 1
+    conversions = sum(1 for sample in samples if sample["endpoint"] == 'convert' and sample["ok"])
+    return {"concurrency": concurrency, "elapsed_seconds": round(elapsed, 2), "requests": len(samples),
+            "errors": errors, "error_rate": round(errors / len(samples), 4) if samples else None,
+            "throughput_rps": round((len(samples) - errors) / elapsed, 2) if elapsed else None,
+            "conversions_per_second": round(conversions / elapsed, 3) if elapsed else None,
+            "statuses": statuses,
+            "endpoints": {endpoint: _latency_summary([s for s in samples if s["endpoint"] == endpoint])
+                          for endpoint in ('convert', 'download')},
+            **memory}
+
+def _format_level(level):
+    convert, download = level["endpoints"]["convert"], level["endpoints"]["download"]
+    return (f"x{level['concurrency']:<4} {level['requests']} requests in {level['elapsed_seconds']}s, "
+            f"{level['throughput_rps']} req/s, errors {level['error_rate']:.1%}; "
+            f"convert p50/p95/p99 {convert['p50_ms']}/{convert['p95_ms']}/{convert['p99_ms']} ms, "
+            f"download p50/p95/p99 {download['p50_ms']}/{download['p95_ms']}/{download['p99_ms']} ms; "
+            f"memory peak {level['memory_total_peak_mb']} MB (worker {level['worker_memory_peak_mb']} MB)")
+
+def _git_revision():
+    try:
+        revision = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=PROJECT_ROOT, capture_output=True,
+                                  text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=PROJECT_ROOT,
+                               capture_output=True, text=True, check=True).stdout.strip()
+        return revision + ('-dirty' if dirty else '')
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_http_load_test(concurrency_levels, duration=30.0, server='sync', workers=1, threads=1, timeout=None,
+                       synthetic_rows=DEFAULT_SYNTHETIC_ROWS, include_6151=True, warmup=True):
+    """Runs every concurrency level against one freshly started server. Returns the report (see main)."""
+    workloads = sample_workloads(include_6151) + synthetic_workloads(synthetic_rows)
+    if not workloads:
+        raise ValueError("No workbooks to upload.")
+    command = server_command(server, workers, threads, timeout)
+    report = {"started": datetime.datetime.now().isoformat(timespec='seconds'), "git_revision": _git_revision(),
+              "server": {"kind": server, "workers": workers, "threads": threads if server == 'sync' else None,
+                         "timeout": timeout, "command": ' '.join(command)},
+              "host": {"cpus": os.cpu_count(), "python": platform.python_version(), "platform": platform.platform()},
+              "duration_seconds": duration,
+              "workloads": [{"name": w["name"], "conversion_type": w["conversion_type"], "bytes": os.path.getsize(w["path"])}
+                            for w in workloads],
+              "levels": []}
+    work_dir = tempfile.mkdtemp(prefix=f'http_load_{server}_')
+    try:
+        os.makedirs(os.path.join(work_dir, 'uploads'))
+        # Keeps gunicorn.conf.py from clearing the metrics directory of a server already running on this machine, and
+        # gives each run an empty upload store without saved results, so every request converts
+        process, port = start_server(server, work_dir, command, {'PROMETHEUS_MULTIPROC_DIR': os.path.join(work_dir, 'metrics'),
+                                                                 'CHUNKED_UPLOAD_DIR': os.path.join(work_dir, 'upload_store'),
+                                                                 'UPLOAD_DEDUP': '0'})
+        try:
+            if warmup:
+                failed = asyncio.run(warm_up(port, workloads))
+                for sample in failed:
+                    print(f"Warning: warm-up {sample['endpoint']} of '{sample['workload']}' failed (status {sample['status']}).")
+            for concurrency in concurrency_levels:
+                sampler = MemorySampler(process.pid)
+                sampler.start()
+                try:
+                    samples, elapsed = asyncio.run(run_level(port, concurrency, workloads, duration))
+                finally:
+                    memory = sampler.stop()
+                level = summarize_level(concurrency, samples, elapsed, memory)
+                print(f"{server} w{workers}{f't{threads}' if server == 'sync' else ''} {_format_level(level)}")
+                report["levels"].append(level)
+        finally:
+            stop_server(process)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return report
+
+def save_report(report, path=None):
+    if path is None:
+        server = report["server"]
+        shape = f"w{server['workers']}" + (f"t{server['threads']}" if server['threads'] else '')
+        stamp = report["started"].replace(':', '').replace('-', '')
+        path = os.path.join(RESULTS_DIR, f"http_{server['kind']}_{shape}_{stamp}.json")
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results saved: {path}")
+    return path
+
+def compare_reports(paths):
+    """Prints convert p95, throughput, error rate and worker memory per concurrency level for saved reports."""
+    reports = []
+    for path in paths:
+        with open(path) as f:
+            reports.append(json.load(f))
+    for label, report in zip(paths, reports):
+        server = report["server"]
+        print(f"{os.path.basename(label)}: {server['command']} at {report.get('git_revision')}, {report['started']}")
+    levels = sorted({level["concurrency"] for report in reports for level in report["levels"]})
+    print(f"{'users':>5}  " + "  ".join(f"{os.path.basename(p)[:38]:>38}" for p in paths))
+    for concurrency in levels:
+        cells = []
+        for report in reports:
+            level = next((l for l in report["levels"] if l["concurrency"] == concurrency), None)
+            cells.append('-' if level is None else
+                         f"p95 {level['endpoints']['convert']['p95_ms']} ms {level['throughput_rps']} r/s "
+                         f"err {level['error_rate']:.0%} {level['worker_memory_peak_mb']} MB")
+        print(f"{concurrency:>5}  " + "  ".join(f"{cell:>38}" for cell in cells))
+
+def main():
+    parser = argparse.ArgumentParser(description="Load-test /convert and /download on a local gunicorn server and report latency percentiles, throughput, errors and memory.")
+    parser.add_argument("--server", choices=['sync', 'async'], default='sync', help="app.py (sync) or asgi_app.py under uvicorn workers (async).")
+    parser.add_argument("--workers", type=int, default=1, help="gunicorn worker processes.")
+    parser.add_argument("--threads", type=int, default=1, help="Threads per sync worker.")
+    parser.add_argument("--timeout", type=int, help="gunicorn worker timeout in seconds (default: gunicorn's).")
+    parser.add_argument("--concurrency", nargs="+", type=int, default=[1, 4, 16], help="Concurrent users per level.")
+    parser.add_argument("--duration", type=float, default=30.0, help="Seconds each level runs.")
+    parser.add_argument("--synthetic-rows", nargs="*", type=int, default=DEFAULT_SYNTHETIC_ROWS,
+                        help="Row counts of the synthetic 13F workbooks to add (none: samples only).")
+    parser.add_argument("--no-6151", action="store_true", help="Upload only 13F workbooks.")
+    parser.add_argument("--no-warmup", action="store_true", help="Measure from the first request.")
+    parser.add_argument("--json", help=f"Where to save the results (default: {RESULTS_DIR}/http_<server>_<shape>_<time>.json).")
+    parser.add_argument("--compare", nargs="+", metavar="RESULTS_JSON", help="Show saved results side by side instead of running.")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare_reports(args.compare)
+        return 0
+    report = run_http_load_test(args.concurrency, args.duration, args.server, args.workers, args.threads, args.timeout,
+                                args.synthetic_rows, not args.no_6151, not args.no_warmup)
+    save_report(report, args.json)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
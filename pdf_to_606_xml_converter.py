@@ -3,36 +3,20 @@ import datetime
 from datetime import timezone # Added for timezone.utc
 import os
 
-# --- Helper functions for formatting based on XSD types ---
-def format_pct(value):
-    """Formats a number to PctType (string, 0.00-100.00, 2 decimal places)."""
-    if value is None or value == "": # Simplified check for None or empty string
-        return ""  
-    try:
-        num = float(value)
-        return f"{num:.2f}"
-    except ValueError:
-        return "" 
-
-def format_cph(value):
-    """Formats a number to CphType (string, 4 decimal places)."""
-    if value is None or value == "":
-        return "" 
-    try:
-        num = float(value)
-        return f"{num:.4f}"
-    except ValueError:
-        return ""
+# PctType/CphType/USD formatting is shared with the FINRA 6151 converter (report_formatting.py)
+from report_formatting import format_pct, format_cph4, format_usd, column_block
+from conversion_profiler import profiled_conversion, output_argument
+from venue_reference import shared_venue_index, resolution_summary
+from report_snapshot import SAVE_REPORT_SNAPSHOTS, snapshot_path, attributes_record, write_snapshot, read_snapshot
 
-def format_usd(value):
-    """Formats a number to USD (xs:decimal, typically 2 decimal places for currency)."""
-    if value is None or value == "":
-        return "0.00" 
-    try:
-        num = float(value)
-        return f"{num:.2f}"
-    except ValueError:
-        return "0.00"
+# Attribute names, in the order the XSD lists their elements
+NDO_PCT_FIELDS = ["ndo_pct", "ndo_market_pct", "ndo_marketable_limit_pct", "ndo_non_marketable_limit_pct", "ndo_other_pct"]
+VENUE_PCT_FIELDS = ["order_pct", "market_pct", "marketable_limit_pct", "non_marketable_limit_pct", "other_orders_pct"]
+VENUE_USD_FIELDS = ["net_pmt_market_usd", "net_pmt_marketable_limit_usd", "net_pmt_non_marketable_limit_usd", "net_pmt_other_usd"]
+VENUE_CPH_FIELDS = ["net_pmt_market_cph", "net_pmt_marketable_limit_cph", "net_pmt_non_marketable_limit_cph", "net_pmt_other_cph"]
+NDO_PCT_TAGS = ["ndoPct", "ndoMarketPct", "ndoMarketableLimitPct", "ndoNonmarketableLimitPct", "ndoOtherPct"]
+VENUE_PCT_TAGS = ["orderPct", "marketPct", "marketableLimitPct", "nonMarketableLimitPct", "otherPct"]
+VENUE_PAYMENT_ORDER_TYPES = ["Market", "MarketableLimit", "NonMarketableLimit", "Other"]
 
 # --- Data Classes to Mirror XSD Structure --- 
 class VenueData:
@@ -41,9 +25,10 @@ class VenueData:
                  net_pmt_market_usd, net_pmt_market_cph, 
                  net_pmt_marketable_limit_usd, net_pmt_marketable_limit_cph,
                  net_pmt_non_marketable_limit_usd, net_pmt_non_marketable_limit_cph,
-                 net_pmt_other_usd, net_pmt_other_cph, mic=None, material_aspects=""):
+                 net_pmt_other_usd, net_pmt_other_cph, mic=None, material_aspects="", mpid=None):
         self.venue_name = venue_name
         self.mic = mic
+        self.mpid = mpid
         self.order_pct = order_pct 
         self.market_pct = market_pct
         self.marketable_limit_pct = marketable_limit_pct
@@ -139,6 +124,26 @@ def parse_pdf_data(pdf_filepath, reporting_year, reporting_quarter):
     print(f"STUB: parse_pdf_data returning {len(all_monthly_data)} MonthlyData objects with placeholder values.")
     return all_monthly_data
 
+# --- Venue MIC/MPID resolution ---
+def resolve_venue_codes(monthly_data_list):
+    """Fills the MIC and MPID of every venue that has none from the local venue reference index
+    (venue_reference.py). Returns the venues that were looked up with their matches."""
+    venues = [venue for month in monthly_data_list
+              for sec_cat_data in [month.sp500_data, month.other_stocks_data, month.options_data]
+              for venue in sec_cat_data.venues if venue.venue_name and not (venue.mic and venue.mpid)]
+    venue_index = shared_venue_index()
+    venue_names = [venue.venue_name for venue in venues]
+    matches = venue_index.resolve_many(venue_names)
+    for venue, match in zip(venues, matches):
+        if match is not None:
+            venue.mic = venue.mic or match.mic or None
+            venue.mpid = venue.mpid or match.mpid or None
+    if venues:
+        print(f"Resolved MIC/MPID for {resolution_summary(matches)}.")
+    for warning in venue_index.unresolved_warnings(venue_names, matches):
+        print(f"Warning: {warning}")
+    return list(zip(venues, matches))
+
 # --- XML Tree Building Function ---
 def build_r606_xml_tree(report_data_obj):
     """Builds the lxml.etree.ElementTree from an R606ReportData object."""
@@ -159,43 +164,102 @@ def build_r606_xml_tree(report_data_obj):
         for sec_cat_data in [month_report_item.sp500_data, month_report_item.other_stocks_data, month_report_item.options_data]:
             sec_cat_elem = _add_element(r_monthly_elem, sec_cat_data.category_xml_tag_name)
             
-            _add_element(sec_cat_elem, "ndoPct", format_pct(sec_cat_data.ndo_pct))
-            _add_element(sec_cat_elem, "ndoMarketPct", format_pct(sec_cat_data.ndo_market_pct))
-            _add_element(sec_cat_elem, "ndoMarketableLimitPct", format_pct(sec_cat_data.ndo_marketable_limit_pct))
-            _add_element(sec_cat_elem, "ndoNonmarketableLimitPct", format_pct(sec_cat_data.ndo_non_marketable_limit_pct))
-            _add_element(sec_cat_elem, "ndoOtherPct", format_pct(sec_cat_data.ndo_other_pct))
+            # Format the category's NDO row and all of its venues in one call per number type
+            ndo_pcts = format_pct(column_block([sec_cat_data], NDO_PCT_FIELDS))[0]
+            venue_pcts = format_pct(column_block(sec_cat_data.venues, VENUE_PCT_FIELDS))
+            venue_usd = format_usd(column_block(sec_cat_data.venues, VENUE_USD_FIELDS))
+            venue_cph = format_cph4(column_block(sec_cat_data.venues, VENUE_CPH_FIELDS))
+
+            for tag, text in zip(NDO_PCT_TAGS, ndo_pcts):
+                _add_element(sec_cat_elem, tag, text)
             
             r_venues_elem = _add_element(sec_cat_elem, "rVenues")
-            for venue in sec_cat_data.venues:
+            mics_written = set()
+            for position, venue in enumerate(sec_cat_data.venues):
                 r_venue_elem = _add_element(r_venues_elem, "rVenue")
                 
-                if venue.mic: 
-                    _add_element(r_venue_elem, "mic", venue.mic)
-                elif venue.venue_name:
+                # name and/or mic, then mpid; each MIC may appear only once per <rVenues>
+                mic = venue.mic if venue.mic not in mics_written else None
+                if venue.venue_name:
                     _add_element(r_venue_elem, "name", venue.venue_name)
-                else:
+                elif not mic:
                     _add_element(r_venue_elem, "name", "UNKNOWN_VENUE") 
+                if mic:
+                    mics_written.add(mic)
+                    _add_element(r_venue_elem, "mic", mic)
+                if venue.mpid:
+                    _add_element(r_venue_elem, "mpid", venue.mpid)
                 
-                _add_element(r_venue_elem, "orderPct", format_pct(venue.order_pct))
-                _add_element(r_venue_elem, "marketPct", format_pct(venue.market_pct))
-                _add_element(r_venue_elem, "marketableLimitPct", format_pct(venue.marketable_limit_pct))
-                _add_element(r_venue_elem, "nonMarketableLimitPct", format_pct(venue.non_marketable_limit_pct))
-                _add_element(r_venue_elem, "otherPct", format_pct(venue.other_orders_pct))
+                for tag, text in zip(VENUE_PCT_TAGS, venue_pcts[position]):
+                    _add_element(r_venue_elem, tag, text)
                 
-                _add_element(r_venue_elem, "netPmtPaidRecvMarketOrdersUsd", format_usd(venue.net_pmt_market_usd))
-                _add_element(r_venue_elem, "netPmtPaidRecvMarketOrdersCph", format_cph(venue.net_pmt_market_cph))
-                _add_element(r_venue_elem, "netPmtPaidRecvMarketableLimitOrdersUsd", format_usd(venue.net_pmt_marketable_limit_usd))
-                _add_element(r_venue_elem, "netPmtPaidRecvMarketableLimitOrdersCph", format_cph(venue.net_pmt_marketable_limit_cph))
-                _add_element(r_venue_elem, "netPmtPaidRecvNonMarketableLimitOrdersUsd", format_usd(venue.net_pmt_non_marketable_limit_usd))
-                _add_element(r_venue_elem, "netPmtPaidRecvNonMarketableLimitOrdersCph", format_cph(venue.net_pmt_non_marketable_limit_cph))
-                _add_element(r_venue_elem, "netPmtPaidRecvOtherOrdersUsd", format_usd(venue.net_pmt_other_usd))
-                _add_element(r_venue_elem, "netPmtPaidRecvOtherOrdersCph", format_cph(venue.net_pmt_other_cph))
+                for order_type, usd_text, cph_text in zip(VENUE_PAYMENT_ORDER_TYPES, venue_usd[position], venue_cph[position]):
+                    _add_element(r_venue_elem, f"netPmtPaidRecv{order_type}OrdersUsd", usd_text)
+                    _add_element(r_venue_elem, f"netPmtPaidRecv{order_type}OrdersCph", cph_text)
                 
                 _add_element(r_venue_elem, "materialAspects", venue.material_aspects) 
 
     return etree.ElementTree(root)
 
+# --- Report model snapshot (report_snapshot.py): re-render the XML without re-parsing the PDF ---
+VENUE_SNAPSHOT_FIELDS = ["venue_name", *VENUE_PCT_FIELDS,
+                         *[name for pair in zip(VENUE_USD_FIELDS, VENUE_CPH_FIELDS) for name in pair],
+                         "mic", "mpid", "material_aspects"]
+
+def save_report_snapshot(report_obj, snapshot_filepath, pdf_filepath):
+    """Saves an R606ReportData as JSON lines: per month a month record, then per category a category record
+    followed by its venue records."""
+    header = {"version": report_obj.version, "bd_name": report_obj.bd_name, "year": report_obj.year,
+              "qtr": report_obj.qtr, "timestamp": report_obj.timestamp, "source_file": os.path.basename(pdf_filepath)}
+    records = []
+    for month in report_obj.monthly_data_list:
+        records.append({"record": "month", "month_num_str": month.month_num_str})
+        for sec_cat_data in [month.sp500_data, month.other_stocks_data, month.options_data]:
+            records.append(attributes_record("category", sec_cat_data, ["category_xml_tag_name", *NDO_PCT_FIELDS]))
+            records.extend(attributes_record("venue", venue, VENUE_SNAPSHOT_FIELDS) for venue in sec_cat_data.venues)
+    return write_snapshot(snapshot_filepath, '606', header, records)
+
+def load_report_snapshot(snapshot_filepath):
+    """(R606ReportData, header) from a saved report model; the report keeps its original timestamp."""
+    header, records = read_snapshot(snapshot_filepath, '606')
+    report_obj = R606ReportData(header["bd_name"], header["year"], header["qtr"], header["version"])
+    report_obj.timestamp = header["timestamp"]
+    categories = {}
+    for record in records:
+        if record["record"] == "month":
+            month = MonthlyData(record["month_num_str"])
+            report_obj.monthly_data_list.append(month)
+            categories = {sec_cat_data.category_xml_tag_name: sec_cat_data
+                          for sec_cat_data in [month.sp500_data, month.other_stocks_data, month.options_data]}
+        elif record["record"] == "category":
+            sec_cat_data = categories[record["category_xml_tag_name"]]
+            for name in NDO_PCT_FIELDS:
+                setattr(sec_cat_data, name, record[name])
+        elif record["record"] == "venue":
+            sec_cat_data.venues.append(VenueData(**{name: record.get(name) for name in VENUE_SNAPSHOT_FIELDS}))
+    return report_obj, header
+
+def write_r606_xml(report_obj, output_xml_filepath):
+    xml_tree = build_r606_xml_tree(report_obj)
+    os.makedirs(os.path.dirname(output_xml_filepath) or '.', exist_ok=True)
+    xml_tree.write(output_xml_filepath, pretty_print=True, xml_declaration=True, encoding='UTF-8')
+    print(f"Successfully generated XML: {output_xml_filepath}")
+    return output_xml_filepath
+
+def render_606_snapshot(snapshot_filepath, output_xml_filepath, firm_crd=None, reporting_year=None,
+                        reporting_quarter=None, schema_version=None):
+    """Render-only 606 conversion: writes the XML of a saved report model without parsing the PDF again.
+    The given metadata replaces the saved values. Returns output_xml_filepath."""
+    report_obj, header = load_report_snapshot(snapshot_filepath)
+    report_obj.bd_name = str(firm_crd) if firm_crd else report_obj.bd_name
+    report_obj.year = str(reporting_year) if reporting_year else report_obj.year
+    report_obj.qtr = str(reporting_quarter) if reporting_quarter else report_obj.qtr
+    report_obj.version = schema_version or report_obj.version
+    print(f"Rendering 606 XML from '{snapshot_filepath}' (parsed from {header.get('source_file')})")
+    return write_r606_xml(report_obj, output_xml_filepath)
+
 # --- Main Orchestration Function ---
+@profiled_conversion(output_argument('output_xml_filepath', 1))
 def main_pdf_to_xml_conversion(pdf_filepath, output_xml_filepath, 
                                firm_crd, reporting_year, reporting_quarter, 
                                schema_version="1.0"):
@@ -214,15 +278,13 @@ def main_pdf_to_xml_conversion(pdf_filepath, output_xml_filepath,
             report_version=schema_version
         )
         report_obj.monthly_data_list = monthly_data_from_pdf
+        resolve_venue_codes(report_obj.monthly_data_list)
+        if SAVE_REPORT_SNAPSHOTS:
+            # Metadata can then be changed with render_606_snapshot without parsing the PDF again
+            save_report_snapshot(report_obj, snapshot_path(output_xml_filepath), pdf_filepath)
 
-        # 3. Build the XML tree
-        xml_tree = build_r606_xml_tree(report_obj)
-
-        # 4. Write XML to file
-        os.makedirs(os.path.dirname(output_xml_filepath), exist_ok=True)
-        xml_tree.write(output_xml_filepath, pretty_print=True, xml_declaration=True, encoding='UTF-8')
-        print(f"Successfully generated XML: {output_xml_filepath}")
-        return output_xml_filepath
+        # 3. Build the XML tree and write it to file
+        return write_r606_xml(report_obj, output_xml_filepath)
 
     except ValueError as ve:
         print(f"Configuration Error: {ve}")
@@ -0,0 +1,56 @@
+import numpy as np
+import pandas as pd
+
+# Number formatting shared by the FINRA 6151 and SEC 606 report converters. The schema's numeric types take a
+# fixed number of decimals, and the "...OrNm" variants an empty string for "not meaningful" (NM). These helpers
+# convert whole blocks of cells (a venue table, a summary row) at once, so every converter treats blanks, NaN
+# and unparseable text the same way:
+#   number or numeric text  -> fixed decimals ("25.50", "-5.1234")
+#   blank cell, NaN, None   -> NM ("")
+#   text that is not a number ("N/A") -> NM ("")
+
+NOT_MEANINGFUL = ""
+
+def to_numbers(values, scale=None):
+    """Cells of any shape (numbers, numeric text, blanks) -> float64 ndarray of the same shape, NaN where a cell
+    is blank or not a number. Text is stripped first. With scale, values are divided by it (100 for percent
+    columns entered as 26.4 meaning 0.264)."""
+    cells = np.asarray(values, dtype=object) if not isinstance(values, np.ndarray) else values
+    if cells.dtype.kind in "fiu":
+        numbers = cells.astype("float64")
+    else:
+        flat = pd.Series(cells.ravel(), dtype=object)
+        text = flat.astype(str).str.strip().where(flat.notna())
+        numbers = pd.to_numeric(text, errors="coerce").to_numpy(dtype="float64").reshape(cells.shape)
+    if scale:
+        numbers = numbers / scale
+    return numbers
+
+def format_fixed(numbers, decimals, missing=NOT_MEANINGFUL):
+    """float array -> object array of strings with exactly `decimals` decimals; NaN becomes `missing`."""
+    numbers = np.asarray(numbers, dtype="float64")
+    is_missing = np.isnan(numbers)
+    # reshape: np.char.mod flattens empty input (a category without venues)
+    text = np.char.mod(f"%.{decimals}f", np.where(is_missing, 0.0, numbers)).astype(object).reshape(numbers.shape)
+    text[is_missing] = missing
+    return text
+
+# PctOrNmType / Decimal2OrNmType / CphOrNmType
+def format_pct(values, scale=None):
+    return format_fixed(to_numbers(values, scale), 2)
+
+def format_decimal2(values):
+    return format_fixed(to_numbers(values), 2)
+
+def format_cph4(values):
+    return format_fixed(to_numbers(values), 4)
+
+def format_usd(values):
+    """xs:decimal dollar amounts where the element is required: a missing amount is written as 0.00."""
+    return format_fixed(to_numbers(values), 2, missing="0.00")
+
+def column_block(records, attributes):
+    """Collects attributes of a list of objects into a (len(records), len(attributes)) object array, so a whole
+    venue list can be formatted in one call."""
+    return np.array([[getattr(record, attribute) for attribute in attributes] for record in records],
+                    dtype=object).reshape(len(records), len(attributes))
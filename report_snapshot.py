@@ -0,0 +1,79 @@
+import os
+import sys
+import json
+import math
+import argparse
+import collections
+import numpy as np
+
+# Parsed 6151 / 606 report models saved next to each conversion's XML, so the XML can be rendered again with
+# different report metadata (firm name, period, material-aspects text, output name) without re-reading the
+# workbook or PDF. One JSON object per line:
+#   {"record": "report", "kind": "6151", "format": 1, ...report metadata...}   first line
+#   {"record": "category", ...} / {"record": "venue", ...} / ...               the converter's own records
+# finra_6151_converter.py and pdf_to_606_xml_converter.py turn their report objects into records and back.
+
+SNAPSHOT_SUFFIX = '.report.jsonl'
+SNAPSHOT_FORMAT = 1
+# Set REPORT_SNAPSHOTS=0 to stop saving report models next to converted reports
+SAVE_REPORT_SNAPSHOTS = os.environ.get('REPORT_SNAPSHOTS', '1').lower() not in ('0', 'false', 'no')
+
+def snapshot_path(output_xml_path):
+    """The snapshot file saved next to a generated XML file."""
+    return os.path.splitext(output_xml_path)[0] + SNAPSHOT_SUFFIX
+
+def is_snapshot(path):
+    return str(path).lower().endswith(SNAPSHOT_SUFFIX)
+
+def json_value(value):
+    """Plain JSON value for a model attribute: NumPy scalars become Python numbers, NaN becomes null (the
+    report formatters treat None and NaN alike)."""
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    return value
+
+def attributes_record(record_type, obj, attributes, **extra):
+    """{"record": record_type, **extra, attribute: value, ...} for the given attributes of obj."""
+    return {"record": record_type, **extra, **{name: json_value(getattr(obj, name)) for name in attributes}}
+
+def write_snapshot(path, kind, header, records):
+    """Writes the header and records as compact JSON lines, replacing path atomically. Returns path."""
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as snapshot:
+        for record in [{"record": "report", "kind": kind, "format": SNAPSHOT_FORMAT, **header}, *records]:
+            snapshot.write(json.dumps(record, separators=(',', ':'), ensure_ascii=False) + '\n')
+    os.replace(tmp_path, path)
+    print(f"Saved report model: {path}")
+    return path
+
+def read_snapshot(path, kind=None):
+    """(header, records) of a snapshot. Raises ValueError when it is not a snapshot (of the given kind)."""
+    with open(path, encoding='utf-8') as snapshot:
+        lines = [json.loads(line) for line in snapshot if line.strip()]
+    if not lines or lines[0].get("record") != "report":
+        raise ValueError(f"'{path}' is not a saved report model.")
+    header = lines[0]
+    if header.get("format") != SNAPSHOT_FORMAT:
+        raise ValueError(f"'{path}' has report model format {header.get('format')}; this version reads format {SNAPSHOT_FORMAT}.")
+    if kind is not None and header.get("kind") != kind:
+        raise ValueError(f"'{path}' holds a {header.get('kind')} report, not a {kind} report.")
+    return header, lines[1:]
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarize a saved 6151/606 report model.")
+    parser.add_argument("snapshot", help=f"A {SNAPSHOT_SUFFIX} file saved next to a converted report.")
+    args = parser.parse_args()
+
+    header, records = read_snapshot(args.snapshot)
+    for key, value in header.items():
+        if key not in ("record", "format"):
+            print(f"{key}: {value}")
+    for record_type, count in collections.Counter(record["record"] for record in records).items():
+        print(f"{record_type} records: {count}")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
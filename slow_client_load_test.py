@@ -0,0 +1,222 @@
+import os
+import sys
+import time
+import uuid
+import json
+import socket
+import shutil
+import asyncio
+import tempfile
+import argparse
+import subprocess
+
+# Slow-client load test for the two serving modes. N clients upload a workbook to /convert (or download an XML
+# file) slowly, the way users on poor connections do, while a probe requests the index page every
+# PROBE_INTERVAL_SECONDS. With the sync Flask app (gunicorn app:app) each slow transfer holds a worker, so the
+# probe waits; with the async app (uvicorn asgi_app:app) the probe should stay fast however many clients are
+# in flight. Every run starts its own single-worker server in a temporary directory.
+#   python slow_client_load_test.py --server sync async --clients 1 4 16
+
+PROJECT_ROOT = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_UPLOAD_FILE = os.path.join(PROJECT_ROOT, 'Input', 'Zeno3Q2413FPosition.xlsx')
+PROBE_INTERVAL_SECONDS = 0.1
+# Probe requests slower than this count as failed
+PROBE_TIMEOUT_SECONDS = 10.0
+# A worker is considered free for other clients while the probe's p95 latency stays under this
+DEFAULT_TARGET_MS = 250
+# Size of the XML file slow clients download in --mode download
+DOWNLOAD_FILE_BYTES = 8 * 1024 * 1024
+_DOWNLOAD_FILENAME = 'slow_download.xml'
+# Request folder (uploads/<token>/) the download file is placed in
+_DOWNLOAD_TOKEN = 'slow-client-load-test'
+
+SERVER_COMMANDS = {
+    'sync': ['gunicorn', 'app:app', '--workers', '1', '--bind', '127.0.0.1:{port}'],
+    'async': ['uvicorn', 'asgi_app:app', '--workers', '1', '--host', '127.0.0.1', '--port', '{port}', '--log-level', 'warning'],
+}
+
+# --- Server ---
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def start_server(kind, work_dir, command=None, env=None):
+    """Starts a single-worker server of the given kind with work_dir as its working directory (uploads, logs).
+    command replaces SERVER_COMMANDS[kind] ('{port}' is filled in) and env adds environment variables.
+    Returns (process, port) once it accepts connections."""
+    port = _free_port()
+    command = [part.format(port=port) for part in (command or SERVER_COMMANDS[kind])]
+    env = {**os.environ, 'PYTHONPATH': PROJECT_ROOT + os.pathsep + os.environ.get('PYTHONPATH', ''),
+           'FILINGS_STORE_DISABLED': '1', **(env or {})}
+    process = subprocess.Popen(command, cwd=work_dir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"'{' '.join(command)}' exited with status {process.returncode}.")
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.5).close()
+            return process, port
+        except OSError:
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError(f"'{' '.join(command)}' did not start listening on port {port}.")
+
+def stop_server(process):
+    process.terminate()
+    try:
+        process.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+# --- Clients ---
+def multipart_body(upload_path, fields, filename=None):
+    """(body, content type) of a form upload of upload_path (sent as filename, default its own name) with fields."""
+    boundary = uuid.uuid4().hex
+    parts = [f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode()
+             for name, value in fields.items()]
+    with open(upload_path, 'rb') as upload:
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{filename or os.path.basename(upload_path)}"\r\n'
+                     f'Content-Type: application/octet-stream\r\n\r\n'.encode() + upload.read() + b'\r\n')
+    parts.append(f'--{boundary}--\r\n'.encode())
+    return b''.join(parts), f'multipart/form-data; boundary={boundary}'
+
+async def _read_response(reader):
+    """Reads one HTTP/1.1 response (the servers close the connection after it). Returns the status code."""
+    status_line = await reader.readline()
+    await reader.read()
+    return int(status_line.split()[1]) if status_line else 0
+
+async def slow_upload(port, body, content_type, seconds, pieces=20):
+    """POSTs body to /convert in pieces spread over the given number of seconds. Returns the status code."""
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(f'POST /convert HTTP/1.1\r\nHost: 127.0.0.1\r\nContent-Type: {content_type}\r\n'
+                 f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode())
+    step = max(1, -(-len(body) // pieces))
+    for start in range(0, len(body), step):
+        writer.write(body[start:start + step])
+        await writer.drain()
+        await asyncio.sleep(seconds / pieces)
+    status = await _read_response(reader)
+    writer.close()
+    return status
+
+async def slow_download(port, seconds, pieces=20):
+    """GETs the download file, reading it in pieces spread over the given number of seconds."""
+    reader, writer = await asyncio.open_connection('127.0.0.1', port, limit=64 * 1024)
+    writer.write(f'GET /download/{_DOWNLOAD_TOKEN}/{_DOWNLOAD_FILENAME} HTTP/1.1\r\nHost: 127.0.0.1\r\nConnection: close\r\n\r\n'.encode())
+    await writer.drain()
+    status_line = await reader.readline()
+    step = DOWNLOAD_FILE_BYTES // pieces
+    while await reader.read(step):
+        await asyncio.sleep(seconds / pieces)
+    writer.close()
+    return int(status_line.split()[1]) if status_line else 0
+
+async def _probe_once(port, latencies, failures):
+    started = time.perf_counter()
+    try:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection('127.0.0.1', port), PROBE_TIMEOUT_SECONDS)
+        writer.write(b'GET / HTTP/1.1\r\nHost: 127.0.0.1\r\nConnection: close\r\n\r\n')
+        status = await asyncio.wait_for(_read_response(reader), PROBE_TIMEOUT_SECONDS)
+        writer.close()
+        if status == 200:
+            latencies.append(time.perf_counter() - started)
+        else:
+            failures.append(status)
+    except (asyncio.TimeoutError, OSError) as e:
+        failures.append(type(e).__name__)
+
+async def probe(port, latencies, failures, stop):
+    """Requests / every PROBE_INTERVAL_SECONDS until stop is set, recording latencies in seconds. Requests are
+    sent on schedule without waiting for earlier ones, so time a worker spends blocked shows in every sample."""
+    probes = []
+    while not stop.is_set():
+        probes.append(asyncio.create_task(_probe_once(port, latencies, failures)))
+        await asyncio.sleep(PROBE_INTERVAL_SECONDS)
+    await asyncio.gather(*probes)
+
+def percentile(values, share):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(share * (len(ordered) - 1))))]
+
+async def run_level(port, clients, mode, seconds, upload):
+    """One concurrency level: clients slow transfers at once, probing the index page meanwhile."""
+    latencies, failures, stop = [], [], asyncio.Event()
+    probe_task = asyncio.create_task(probe(port, latencies, failures, stop))
+    started = time.perf_counter()
+    if mode == 'upload':
+        transfers = [slow_upload(port, upload[0], upload[1], seconds) for _ in range(clients)]
+    else:
+        transfers = [slow_download(port, seconds) for _ in range(clients)]
+    statuses = await asyncio.gather(*transfers, return_exceptions=True)
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await probe_task
+    completed = statuses.count(200)
+    return {
+        "clients": clients, "completed": completed, "elapsed_seconds": round(elapsed, 2),
+        "probes": len(latencies) + len(failures), "probe_failures": len(failures),
+        "probe_p50_ms": None if not latencies else round(percentile(latencies, 0.5) * 1000, 1),
+        "probe_p95_ms": None if not latencies else round(percentile(latencies, 0.95) * 1000, 1),
+        "probe_max_ms": None if not latencies else round(max(latencies) * 1000, 1),
+    }
+
+def run_load_test(server_kinds, client_counts, mode='upload', seconds=5.0, upload_path=DEFAULT_UPLOAD_FILE,
+                  target_ms=DEFAULT_TARGET_MS):
+    """Runs every concurrency level against a fresh single-worker server of each kind. Returns
+    {kind: {"levels": [...], "max_clients_within_target": n}}, where n is the largest level whose slow
+    clients all completed while the probe's p95 stayed under target_ms."""
+    upload = multipart_body(upload_path, {'conversion_type': '13F'})
+    results = {}
+    for kind in server_kinds:
+        work_dir = tempfile.mkdtemp(prefix=f'load_{kind}_')
+        try:
+            os.makedirs(os.path.join(work_dir, 'uploads', _DOWNLOAD_TOKEN))
+            process, port = start_server(kind, work_dir)
+            try:
+                levels = []
+                for clients in client_counts:
+                    if mode == 'download':
+                        # Both apps clear or age out uploads; put the file back before every level
+                        os.makedirs(os.path.join(work_dir, 'uploads', _DOWNLOAD_TOKEN), exist_ok=True)
+                        with open(os.path.join(work_dir, 'uploads', _DOWNLOAD_TOKEN, _DOWNLOAD_FILENAME), 'wb') as download:
+                            download.write(b'<informationTable/>'.ljust(DOWNLOAD_FILE_BYTES, b' '))
+                    level = asyncio.run(run_level(port, clients, mode, seconds, upload))
+                    print(f"{kind:>5} {mode} x{clients:<4} completed {level['completed']}/{clients} in {level['elapsed_seconds']}s, "
+                          f"probe p50 {level['probe_p50_ms']} ms, p95 {level['probe_p95_ms']} ms, "
+                          f"max {level['probe_max_ms']} ms, {level['probe_failures']} failed")
+                    levels.append(level)
+            finally:
+                stop_server(process)
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+        within_target = [level["clients"] for level in levels
+                         if level["completed"] == level["clients"] and not level["probe_failures"]
+                         and level["probe_p95_ms"] is not None and level["probe_p95_ms"] <= target_ms]
+        results[kind] = {"levels": levels, "max_clients_within_target": max(within_target, default=0)}
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare how many slow clients one sync (gunicorn) and one async (uvicorn) worker can serve.")
+    parser.add_argument("--server", nargs="+", choices=sorted(SERVER_COMMANDS), default=['sync', 'async'])
+    parser.add_argument("--clients", nargs="+", type=int, default=[1, 4, 16, 64], help="Concurrency levels.")
+    parser.add_argument("--mode", choices=['upload', 'download'], default='upload', help="Slow uploads to /convert or slow downloads.")
+    parser.add_argument("--seconds", type=float, default=5.0, help="How long each slow transfer takes.")
+    parser.add_argument("--upload-file", default=DEFAULT_UPLOAD_FILE, help="Workbook the slow clients upload.")
+    parser.add_argument("--target-ms", type=float, default=DEFAULT_TARGET_MS, help="Probe p95 latency a worker must keep to count as serving the clients.")
+    parser.add_argument("--json", help="Also write the results to this JSON file.")
+    args = parser.parse_args()
+
+    results = run_load_test(args.server, args.clients, args.mode, args.seconds, args.upload_file, args.target_ms)
+    for kind, result in results.items():
+        print(f"{kind}: up to {result['max_clients_within_target']} concurrent slow client(s) per worker with probe p95 <= {args.target_ms:g} ms")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,237 @@
+import os
+import re
+import difflib
+import argparse
+import functools
+import collections
+import pandas as pd
+
+_BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+# Local copy of the ISO 10383 Market Identifier Code list (the CSV published at iso20022.org/market-identifier-codes).
+# Optional: without it venues resolve from the alias table only.
+DEFAULT_MIC_FILE_PATH = os.environ.get('VENUE_MIC_FILE', os.path.join(_BASE_DIR, 'reference', 'ISO10383_MIC.csv'))
+# User-maintained table of venue names as they appear in client sheets -> MIC and/or MPID
+DEFAULT_ALIAS_FILE_PATH = os.environ.get('VENUE_ALIAS_FILE', os.path.join(_BASE_DIR, 'reference', 'venue_aliases.csv'))
+# Only MIC entries of these countries are indexed (Rule 606 venues are US); empty = every country
+MIC_COUNTRIES = [c.strip().upper() for c in os.environ.get('VENUE_MIC_COUNTRIES', 'US').split(',') if c.strip()]
+# Minimum difflib similarity (0-1) of normalized names for a fuzzy candidate. Fuzzy candidates are only reported
+# as warnings (VenueIndex.suggest); a code goes into a filing only from an exact name or alias table match
+FUZZY_CUTOFF = float(os.environ.get('VENUE_FUZZY_CUTOFF', '0.88'))
+# Distinct venue names whose fuzzy result is remembered per index
+FUZZY_CACHE_SIZE = 4096
+# Reference names compared with difflib per fuzzy lookup
+FUZZY_CANDIDATES = 50
+
+MIC_PATTERN = re.compile(r'^[A-Z0-9]{4}$')     # MicType in oh-20191231.xsd
+MPID_PATTERN = re.compile(r'^[A-Z0-9]{4,5}$')  # MpidType in oh-20191231.xsd
+# MIC list entries that are no longer in use
+_INACTIVE_STATUSES = {'EXPIRED', 'DELETED'}
+
+VenueMatch = collections.namedtuple('VenueMatch', ['mic', 'mpid', 'venue', 'method'])
+VenueMatch.__doc__ = ("A resolved venue: MIC and MPID ('' when unknown), the reference name, and how it matched: exact (MIC "
+                      "list name or code), alias (alias table) or fuzzy (a suggestion from VenueIndex.suggest, never written).")
+
+# --- Name normalization ---
+# "Citadel Securities LLC", "CITADEL SEC" and "Citadel Securities, L.L.C." all normalize to "CITADEL SECURITIES"
+_ABBREVIATIONS = {
+    'SEC': 'SECURITIES', 'SECS': 'SECURITIES', 'MKT': 'MARKET', 'MKTS': 'MARKETS', 'EXCH': 'EXCHANGE',
+    'INTL': 'INTERNATIONAL', 'NATL': 'NATIONAL', 'GRP': 'GROUP', 'CAP': 'CAPITAL', 'AMER': 'AMERICAS',
+}
+_LEGAL_SUFFIXES = {'LLC', 'INC', 'INCORPORATED', 'CORP', 'CORPORATION', 'LTD', 'LIMITED', 'LP', 'LLP', 'CO',
+                   'COMPANY', 'PLC', 'THE'}
+
+def normalize_venue_name(name) -> str:
+    """Upper-cases the name, spells out '&' and common abbreviations, and drops punctuation and legal-form
+    words. Returns '' for blank names."""
+    if name is None or (isinstance(name, float) and pd.isna(name)):
+        return ''
+    text = str(name).upper().replace('&', ' AND ')
+    # L.L.C. -> LLC before punctuation becomes word breaks
+    text = re.sub(r'\b((?:[A-Z]\.){2,})', lambda m: m.group(1).replace('.', ''), text)
+    words = [_ABBREVIATIONS.get(word, word) for word in re.sub(r'[^A-Z0-9]+', ' ', text).split()]
+    return ' '.join(word for word in words if word not in _LEGAL_SUFFIXES)
+
+# --- Reference files ---
+def _normalized_columns(df):
+    df.columns = [re.sub(r'[^a-z]+', '_', col.lower()).strip('_') for col in df.columns]
+    return df
+
+def parse_mic_file(mic_filepath, countries=MIC_COUNTRIES) -> pd.DataFrame:
+    """Reads the ISO 10383 MIC list (current layout with OPRT/SGMT, or the pre-2022 layout with O/S).
+    Returns active entries as a DataFrame with columns mic, operating, names (list of names to index)."""
+    df = _normalized_columns(pd.read_csv(mic_filepath, dtype=str, keep_default_na=False, encoding_errors='replace'))
+    country_col = next((c for c in df.columns if c.startswith('iso_country_code')), None)
+    if countries and country_col:
+        df = df[df[country_col].str.strip().str.upper().isin(countries)]
+    if 'status' in df.columns:
+        df = df[~df['status'].str.strip().str.upper().isin(_INACTIVE_STATUSES)]
+    name_cols = [c for c in ('market_name_institution_description', 'name_institution_description',
+                             'legal_entity_name', 'acronym') if c in df.columns]
+    level_col = 'oprt_sgmt' if 'oprt_sgmt' in df.columns else 'o_s'
+    return pd.DataFrame({
+        'mic': df['mic'].str.strip().str.upper(),
+        'operating': df[level_col].str.strip().str.upper().isin(['OPRT', 'O']) if level_col in df.columns else True,
+        'names': df[name_cols].apply(lambda row: [n for n in row if n.strip()], axis=1) if name_cols else [[]] * len(df),
+    }).reset_index(drop=True)
+
+def parse_alias_file(alias_filepath) -> pd.DataFrame:
+    """Reads the alias table (columns alias, mic, mpid, venue; '#' starts a comment). Entries whose MIC or MPID
+    does not have the XSD's format are skipped with a warning."""
+    df = _normalized_columns(pd.read_csv(alias_filepath, dtype=str, keep_default_na=False, comment='#',
+                                         skipinitialspace=True))
+    for col in ['alias', 'mic', 'mpid', 'venue']:
+        if col not in df.columns:
+            df[col] = ''
+        df[col] = df[col].str.strip()
+    df['mic'] = df['mic'].str.upper()
+    df['mpid'] = df['mpid'].str.upper()
+    bad = (df['alias'] == '') | ((df['mic'] != '') & ~df['mic'].str.match(MIC_PATTERN)) | \
+          ((df['mpid'] != '') & ~df['mpid'].str.match(MPID_PATTERN))
+    for row in df[bad].itertuples():
+        print(f"Warning: Skipping venue alias '{row.alias}' in {alias_filepath} (needs a name, a 4-character MIC and/or a 4-5 character MPID).")
+    return df[~bad].reset_index(drop=True)
+
+class VenueIndex:
+    """In-memory index of normalized venue names -> (MIC, MPID). Alias table entries take precedence over MIC
+    list names. resolve() only accepts an exact normalized match; suggest() offers the closest name for a venue
+    without one, so it can be reviewed and added to the alias table."""
+
+    def __init__(self, mic_entries=None, aliases=None, fuzzy_cutoff=FUZZY_CUTOFF):
+        self.fuzzy_cutoff = fuzzy_cutoff
+        self.entries = {}   # normalized name -> VenueMatch (method filled in on lookup)
+        self.mics = set()
+        if mic_entries is not None:
+            # Operating MICs first, so a name shared by an exchange and its segments resolves to the exchange
+            for entry in mic_entries.sort_values('operating', ascending=False, kind='stable').itertuples():
+                self.mics.add(entry.mic)
+                for name in entry.names:
+                    self.entries.setdefault(normalize_venue_name(name), VenueMatch(entry.mic, '', name, 'exact'))
+        if aliases is not None:
+            for alias in aliases.itertuples():
+                keys = [normalize_venue_name(alias.alias), normalize_venue_name(alias.venue)]
+                # An alias that only adds an MPID keeps the MIC the MIC list has for the same venue
+                known = next((self.entries[k] for k in keys if k in self.entries), None)
+                entry = VenueMatch(alias.mic or (known.mic if known else ''), alias.mpid or (known.mpid if known else ''),
+                                   alias.venue or alias.alias, 'alias')
+                self.entries[keys[0]] = entry
+                self.entries.setdefault(keys[1], entry)
+                if entry.mic:
+                    self.mics.add(entry.mic)
+        self.entries.pop('', None)
+        # Fuzzy suggestions are drawn from the names sharing a word start with the query, not the whole index
+        self._by_word_start = collections.defaultdict(set)
+        for key in self.entries:
+            for word in key.split():
+                self._by_word_start[word[:3]].add(key)
+        self._fuzzy = functools.lru_cache(maxsize=FUZZY_CACHE_SIZE)(self._fuzzy_lookup)
+
+    @classmethod
+    def from_files(cls, mic_filepath=DEFAULT_MIC_FILE_PATH, alias_filepath=DEFAULT_ALIAS_FILE_PATH):
+        """Builds the index from whichever of the two files exist."""
+        mic_entries = parse_mic_file(mic_filepath) if mic_filepath and os.path.exists(mic_filepath) else None
+        aliases = parse_alias_file(alias_filepath) if alias_filepath and os.path.exists(alias_filepath) else None
+        return cls(mic_entries, aliases)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _fuzzy_lookup(self, key):
+        words = key.split()
+        # A name that is the start of exactly one reference venue ("SUSQUEHANNA" -> "SUSQUEHANNA INTERNATIONAL GROUP")
+        prefixed = {self.entries[k][:2]: k for k in self._by_word_start.get(words[0][:3], ()) if k.startswith(key + ' ')}
+        if len(prefixed) == 1:
+            return self.entries[next(iter(prefixed.values()))]._replace(method='fuzzy')
+        # Names sharing the most word starts with the query; common words like EXCHANGE alone do not qualify a name
+        shared = collections.Counter(k for word in words for k in self._by_word_start.get(word[:3], ()))
+        candidates = sorted(k for k, _ in shared.most_common(FUZZY_CANDIDATES))
+        close = difflib.get_close_matches(key, candidates, n=1, cutoff=self.fuzzy_cutoff)
+        return self.entries[close[0]]._replace(method='fuzzy') if close else None
+
+    def resolve(self, venue_name):
+        """VenueMatch for one venue name from an exact MIC list or alias table match, or None."""
+        key = normalize_venue_name(venue_name)
+        if not key:
+            return None
+        entry = self.entries.get(key)
+        if entry is not None:
+            return entry
+        # A sheet may list the MIC itself as the venue
+        if key in self.mics:
+            return VenueMatch(key, '', key, 'exact')
+        return None
+
+    def suggest(self, venue_name):
+        """The closest reference venue (method 'fuzzy') for a name resolve() does not know, or None. Only for
+        warnings: a fuzzy MIC/MPID is never written into a filing."""
+        key = normalize_venue_name(venue_name)
+        if not key or self.resolve(venue_name) is not None:
+            return None
+        return self._fuzzy(key)
+
+    def resolve_many(self, venue_names):
+        """VenueMatch (or None) per name. Each distinct name is resolved once, so thousands of venue rows cost
+        no more than their distinct names."""
+        resolved = {}
+        return [resolved[name] if name in resolved else resolved.setdefault(name, self.resolve(name))
+                for name in venue_names]
+
+    def unresolved_warnings(self, venue_names, matches):
+        """A warning per distinct unresolved name that has a fuzzy candidate, naming the candidate so it can be
+        checked and added to the alias table."""
+        warnings = []
+        for name in dict.fromkeys(name for name, match in zip(venue_names, matches) if match is None):
+            candidate = self.suggest(name)
+            if candidate is not None:
+                warnings.append(f"Venue '{name}' has no exact or alias match, so its MIC/MPID is left empty. Closest "
+                                f"reference venue: '{candidate.venue}' (MIC {candidate.mic or '-'}, MPID {candidate.mpid or '-'}); "
+                                f"add it to the alias table ({DEFAULT_ALIAS_FILE_PATH}) if it is the same venue.")
+        return warnings
+
+# --- Process-wide index, reloaded when either file changes ---
+_shared = {'signature': None, 'index': None}
+
+def _file_signature(path):
+    try:
+        return path, os.stat(path).st_mtime_ns
+    except OSError:
+        return path, None
+
+def shared_venue_index(mic_filepath=DEFAULT_MIC_FILE_PATH, alias_filepath=DEFAULT_ALIAS_FILE_PATH):
+    """The VenueIndex for the given files, built once per process and rebuilt after either file is edited.
+    A file that cannot be read is reported and left out rather than failing the conversion."""
+    signature = (_file_signature(mic_filepath), _file_signature(alias_filepath))
+    if _shared['signature'] != signature:
+        try:
+            index = VenueIndex.from_files(mic_filepath, alias_filepath)
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Warning: Could not load the venue reference files ({mic_filepath}, {alias_filepath}): {e}")
+            index = VenueIndex()
+        print(f"Venue index: {len(index)} names (MIC file: {'yes' if signature[0][1] else 'no'}, "
+              f"aliases: {'yes' if signature[1][1] else 'no'})")
+        _shared.update(signature=signature, index=index)
+    return _shared['index']
+
+def resolution_summary(matches):
+    """'3 of 5 venues (1 alias)' for a list of resolve_many results."""
+    found = [m for m in matches if m is not None]
+    aliased = sum(m.method == 'alias' for m in found)
+    return f"{len(found)} of {len(matches)} venues" + (f" ({aliased} alias)" if aliased else "")
+
+def main():
+    parser = argparse.ArgumentParser(description="Look up venue MICs and MPIDs in the local venue reference index.")
+    parser.add_argument("names", nargs="+", help="Venue names as they appear in client sheets.")
+    parser.add_argument("--mic-file", default=DEFAULT_MIC_FILE_PATH, help="ISO 10383 MIC list (CSV).")
+    parser.add_argument("--alias-file", default=DEFAULT_ALIAS_FILE_PATH, help="Venue alias table (CSV).")
+    args = parser.parse_args()
+
+    index = VenueIndex.from_files(args.mic_file, args.alias_file)
+    for name, match in zip(args.names, index.resolve_many(args.names)):
+        if match is None:
+            candidate = index.suggest(name)
+            print(f"{name}: not found" + (f" (closest: {candidate.venue}, MIC {candidate.mic or '-'} | MPID {candidate.mpid or '-'}; "
+                                          "not used until added to the alias table)" if candidate else ""))
+        else:
+            print(f"{name}: MIC {match.mic or '-'} | MPID {match.mpid or '-'} | {match.venue} ({match.method})")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,380 @@
+import os
+import re
+import glob
+import gzip
+import json
+import time
+import shutil
+import hashlib
+import secrets
+import tempfile
+import email.utils
+from concurrent.futures import Future
+from holdings_rules import format_violation
+from holdings_input import SUPPORTED_HOLDINGS_EXTENSIONS
+from cusip_reference import DEFAULT_CUSIP_INDEX_PATH
+from conversion_scheduler import shared_scheduler
+from conversion_profiler import profiling_allowed, profile_paths
+from conversion_progress import valid_progress_id, start_progress, fail_progress, finish_progress
+from chunked_uploads import shared_upload_store, link_or_copy
+from workbook_cache import file_content_hash
+from xlsx_to_corrected_edgar_xml import EDGAR_13F_XSD_FILE_PATH
+from venue_reference import DEFAULT_MIC_FILE_PATH, DEFAULT_ALIAS_FILE_PATH
+from report_snapshot import snapshot_path
+
+# The single-file /convert flow, independent of the web framework. app.py (Flask, sync workers) and asgi_app.py
+# (Starlette on uvicorn) both use it, so the two servers accept the same forms and show the same messages:
+#   submit_conversion()       -> validates the form and submits the conversion to the shared scheduler; with the
+#                                page's progress_id field its progress is streamed by /progress/<id>. A file already
+#                                converted with the same parameters gets the saved result instead (see
+#                                conversion_cache_key) with UPLOAD_DEDUP=1, unless WEB_RECORD_FILINGS=1
+#   new_request_folder()      -> a fresh uploads/<token>/ folder for one request's upload and outputs; downloads are
+#                                served from /download/<token>/<file> (request_file_path), so users' files with the
+#                                same name never collide and cannot be fetched without the random token
+#   conversion_result_page()  -> turns the converter's result into flash messages and index.html variables
+#   download_variant()        -> picks the (cached) gzip copy of a download for clients that accept gzip
+
+UPLOAD_FOLDER = 'uploads'
+MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16MB limit
+# 13F workbooks larger than this are converted with the constant-memory streaming pipeline
+STREAMING_THRESHOLD_BYTES = int(float(os.environ.get('STREAMING_THRESHOLD_MB', '8')) * 1024 * 1024)
+# Random per-request folder names under UPLOAD_FOLDER (secrets.token_urlsafe)
+REQUEST_TOKEN_BYTES = 16
+REQUEST_TOKEN_PATTERN = re.compile(r'^[A-Za-z0-9_-]{16,64}$')
+# Servers that convert several files at once keep uploads and results this long instead of clearing the folder
+UPLOAD_RETENTION_SECONDS = int(os.environ.get('UPLOAD_RETENTION_SECONDS', '3600'))
+# Web conversions are only recorded in the filings history (filings_store.py) with WEB_RECORD_FILINGS=1: uploads
+# are often trial runs, and a recorded one replaces the client's stored filing for that period. Recorded conversions
+# always run, even when an identical one was saved: a saved result holds no positions to record
+WEB_RECORD_FILINGS = os.environ.get('WEB_RECORD_FILINGS', '').lower() in ('1', 'true', 'yes')
+# Downloads of these types are sent gzip-compressed to clients that accept it (see download_variant)
+DOWNLOAD_GZIP_SUFFIXES = ('.xml', '.csv', '.txt', '.jsonl')
+DOWNLOAD_GZIP_MIN_BYTES = 1024
+DOWNLOAD_GZIP_LEVEL = int(os.environ.get('DOWNLOAD_GZIP_LEVEL', '6'))
+GZIP_SUFFIX = '.gz'
+_BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+class ConversionRequestError(ValueError):
+    """A form problem reported to the user as an error message (followed by a redirect to the index page)."""
+
+def allowed_extensions(conversion_type):
+    # 13F also accepts CSV/Parquet holdings exports; 6151 reports are always Excel workbooks
+    return SUPPORTED_HOLDINGS_EXTENSIONS if conversion_type == '13F' else ('.xlsx',)
+
+def cleanup_uploads(upload_folder=UPLOAD_FOLDER, older_than_seconds=None):
+    """Remove all files and request folders from uploads directory. With older_than_seconds, only those not
+    modified for that long (a server handling several conversions at once must not delete the ones still in progress)."""
+    if older_than_seconds is None:
+        if os.path.exists(upload_folder):
+            shutil.rmtree(upload_folder)
+        os.makedirs(upload_folder)
+        return
+    os.makedirs(upload_folder, exist_ok=True)
+    cutoff = time.time() - older_than_seconds
+    for entry in os.scandir(upload_folder):
+        try:
+            if entry.stat().st_mtime >= cutoff:
+                continue
+            if entry.is_dir():
+                shutil.rmtree(entry.path)
+            else:
+                os.remove(entry.path)
+        except OSError:
+            pass  # Removed by another request in the meantime
+
+def new_request_folder(upload_folder=UPLOAD_FOLDER):
+    """(token, folder): a new folder named by a random token under upload_folder for one request's files."""
+    token = secrets.token_urlsafe(REQUEST_TOKEN_BYTES)
+    folder = os.path.join(upload_folder, token)
+    os.makedirs(folder)
+    return token, folder
+
+def request_file_path(token, filename, upload_folder=UPLOAD_FOLDER):
+    """Path of a file in a request's folder, or None for a malformed token or a file name that is not a plain
+    name in that folder."""
+    if not REQUEST_TOKEN_PATTERN.match(token or '') or not filename or filename != os.path.basename(filename) \
+            or filename in ('.', '..'):
+        return None
+    return os.path.join(upload_folder, token, filename)
+
+def submit_conversion(conversion_type, filepath, form, logger, upload_folder=UPLOAD_FOLDER,
+                      streaming_threshold_bytes=STREAMING_THRESHOLD_BYTES, admin_token=None, input_sha256=None):
+    """Submits the conversion of an uploaded file (already saved to filepath) to the shared scheduler.
+    form is the request's form fields (anything with .get); profile=1 profiles the conversion when admin_token
+    (or the admin_token field) matches PROFILE_ADMIN_TOKEN; progress_id publishes the conversion's progress
+    (conversion_progress.py); input_sha256 is the file's SHA-256 when the caller already knows it. Returns
+    (future, output XML file name or None, profiled); the future's result goes to conversion_result_page, and is
+    already set when an identical conversion's saved result was reused. Raises ConversionRequestError for bad form
+    input and SchedulerBusy when the scheduler does not take the task."""
+    original_filename = os.path.basename(filepath)
+    progress_id = valid_progress_id(form.get('progress_id'))
+    profile = profiling_allowed(form.get('profile') in ('1', 'on', 'true'), admin_token or form.get('admin_token'))
+    if profile:
+        logger.info(f"Profiling the conversion of '{original_filename}'.")
+    if conversion_type == '13F':
+        output_xml_filename = os.path.splitext(original_filename.lower())[0] + '.xml'
+        output_path = os.path.join(upload_folder, output_xml_filename)
+        aggregate = form.get('aggregate_holdings') == 'on'
+        logger.info(f"Starting 13F conversion for '{original_filename}' to '{output_xml_filename}'. Aggregate: {aggregate}")
+        # Fill blank class/issuer from the local 13F List index when one has been built
+        cusip_index_path = DEFAULT_CUSIP_INDEX_PATH if os.path.exists(DEFAULT_CUSIP_INDEX_PATH) else None
+        stream = not aggregate and os.path.getsize(filepath) > streaming_threshold_bytes
+        cache_key = None if profile or WEB_RECORD_FILINGS else conversion_cache_key('13F', filepath, input_sha256,
+                                                                                    aggregate=aggregate, stream=stream)
+        # Conversions run on the scheduler's worker pool, most urgent filing deadline first
+        if stream:
+            logger.info(f"Using streaming 13F conversion for large workbook '{original_filename}'.")
+            task = _submit('13F', progress_id, cache_key, logger, input_xlsx=filepath, output_xml=output_path, stream=True,
+                           cusip_index_path=cusip_index_path, validate=True, profile=profile, record_history=WEB_RECORD_FILINGS)
+        else:
+            task = _submit('13F', progress_id, cache_key, logger, input_xlsx=filepath, output_xml=output_path, aggregate=aggregate,
+                           cusip_index_path=cusip_index_path, validate=True, profile=profile, record_history=WEB_RECORD_FILINGS)
+        return task, output_xml_filename, profile
+
+    if conversion_type == '6151':
+        firm_name = form.get('firm_name')
+        year = form.get('year')
+        qtr = form.get('qtr')
+        if not all([firm_name, year, qtr]):
+            logger.warning(f"Missing parameters for 6151 conversion of '{original_filename}'. Firm: {firm_name}, Year: {year}, Qtr: {qtr}")
+            raise ConversionRequestError('Firm Name, Year, and Quarter are required for 6151 conversion.')
+        logger.info(f"Starting 6151 conversion for '{original_filename}'. Firm: {firm_name}, Year: {year}, Qtr: {qtr}")
+        cache_key = None if profile or WEB_RECORD_FILINGS else conversion_cache_key('6151', filepath, input_sha256,
+                                                                                    firm_name=firm_name, year=year, qtr=qtr)
+        task = _submit('6151', progress_id, cache_key, logger, excel_filepath=filepath, output_dir=upload_folder,
+                       firm_name=firm_name, year=year, qtr=qtr, profile=profile, record_history=WEB_RECORD_FILINGS)
+        return task, None, profile
+
+    logger.error(f"Invalid conversion type '{conversion_type}' selected for file '{original_filename}'.")
+    raise ConversionRequestError('Invalid conversion type selected.')
+
+def _submit(conversion_type, progress_id, cache_key, logger, **kwargs):
+    """shared_scheduler().submit(); with a progress_id the conversion shows as queued until a worker starts it,
+    and as failed when the scheduler rejects it. With a cache_key, a result saved under it is returned instead
+    (as a finished future), and a new result is saved under it before the returned future completes, so an
+    identical conversion submitted as soon as this one's request answers reuses it."""
+    if cache_key is not None:
+        result = _saved_conversion(conversion_type, cache_key, kwargs)
+        if result is not None:
+            logger.info(f"Reusing the saved result of an identical {conversion_type} conversion ({cache_key[:12]}).")
+            finish_progress(progress_id, deduplicated=True)
+            task = Future()
+            task.set_result(result)
+            return task
+    start_progress(progress_id)
+    try:
+        task = shared_scheduler().submit(conversion_type, progress_id=progress_id, **kwargs)
+    except Exception as e:
+        fail_progress(progress_id, e)
+        raise
+    if cache_key is None:
+        return task
+    saved = Future()
+    task.add_done_callback(lambda done: _save_conversion(conversion_type, cache_key, kwargs, done, saved))
+    return saved
+
+# --- Saved conversion results (deduplication of identical uploads) ---
+def _code_fingerprint():
+    """Modification times and sizes of the converter code and of the reference files and schemas the output
+    depends on, so saved results are not reused after any of them changed."""
+    paths = sorted(glob.glob(os.path.join(_BASE_DIR, '*.py')) + glob.glob(os.path.join(_BASE_DIR, 'reference', '*'))
+                   + glob.glob(os.path.join(_BASE_DIR, 'schemas', '*'))) + [
+        EDGAR_13F_XSD_FILE_PATH, DEFAULT_CUSIP_INDEX_PATH, DEFAULT_MIC_FILE_PATH, DEFAULT_ALIAS_FILE_PATH]
+    fingerprint = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            fingerprint.append((path, stat.st_mtime_ns, stat.st_size))
+        except OSError:
+            fingerprint.append((path, None, None))
+    return fingerprint
+
+def conversion_cache_key(conversion_type, filepath, input_sha256=None, **parameters):
+    """Key of a conversion's saved result: the input's content hash (computed when input_sha256 is not given),
+    the conversion parameters and _code_fingerprint(). None unless deduplication is switched on (UPLOAD_DEDUP=1)."""
+    if not shared_upload_store().dedup:
+        return None
+    key = {"type": conversion_type, "sha256": input_sha256 or file_content_hash(filepath),
+           "parameters": parameters, "code": _code_fingerprint()}
+    return hashlib.sha256(json.dumps(key, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+# Name of a saved 13F output in the result store
+SAVED_OUTPUT_NAME = 'output.xml'
+
+def _saved_conversion(conversion_type, cache_key, kwargs):
+    """The saved result under cache_key with its output files copied to where this conversion writes them, or None."""
+    saved = shared_upload_store().load_result(cache_key)
+    if saved is None:
+        return None
+    result, files = saved
+    try:
+        if conversion_type == '13F':
+            link_or_copy(files[SAVED_OUTPUT_NAME], kwargs['output_xml'])
+            return result
+        # The 6151 XML keeps its name (it comes from the firm, year and quarter), as does its saved report model
+        for name, path in files.items():
+            link_or_copy(path, os.path.join(kwargs['output_dir'], name))
+        return [os.path.join(kwargs['output_dir'], os.path.basename(result[0]))] + result[1:]
+    except (OSError, KeyError) as e:
+        print(f"Warning: could not reuse the saved conversion result {cache_key[:12]}: {e}")
+        return None
+
+def _json_value(value):
+    # numpy scalars from the converters; anything else as its text
+    return value.item() if hasattr(value, 'item') else str(value)
+
+def _save_conversion(conversion_type, cache_key, kwargs, task, saved):
+    """Done-callback saving a successful conversion's result and output files under cache_key, then passing the
+    task's outcome on to saved (the future the request waits on)."""
+    try:
+        if task.cancelled() or task.exception() is not None:
+            return
+        result = task.result()
+        if conversion_type == '13F':
+            # Saved under a fixed name: the 13F XML is named after the upload, which can differ next time
+            files = {SAVED_OUTPUT_NAME: kwargs['output_xml']}
+        elif result[0]:
+            files = {os.path.basename(path): path for path in (result[0], snapshot_path(result[0]))}
+        else:
+            return
+        files = {name: path for name, path in files.items() if os.path.exists(path)}
+        if files:
+            shared_upload_store().save_result(cache_key, json.loads(json.dumps(result, default=_json_value)), files)
+    except Exception as e:
+        print(f"Warning: could not save the conversion result {cache_key[:12]}: {e}")
+    finally:
+        if task.cancelled():
+            saved.cancel()
+        elif task.exception() is not None:
+            saved.set_exception(task.exception())
+        else:
+            saved.set_result(task.result())
+
+def conversion_result_page(conversion_type, original_filename, output_xml_filename, result, logger, profiled=False,
+                           upload_folder=UPLOAD_FOLDER, download_token=None):
+    """(messages, page) for a finished conversion: messages are (category, text) pairs to flash, page the
+    index.html template variables, or None when the user should be sent back to the index page instead.
+    upload_folder is the request's folder and download_token its name, which the page's download links use.
+    For a profiled conversion the page links the profile files written next to the output."""
+    messages = []
+    if conversion_type == '13F':
+        summary = result
+        xml_is_valid = summary['xml_valid']  # None when the 13F schema could not be loaded
+        xml_validation_errors = summary['validation_errors'] if xml_is_valid is False else []
+        if summary['aggregated']:
+            messages.append(('success', f"Successfully converted (13F) {original_filename} to {output_xml_filename}. Combined {summary['rows_read']} rows into {summary['rows_written']} holdings."))
+        else:
+            messages.append(('success', f'Successfully converted (13F) {original_filename} to {output_xml_filename}'))
+        if summary['invalid_cusip_count']:
+            invalid_summary = ", ".join(f"row {row}: {cusip}" for row, cusip in summary['invalid_cusips'][:5])
+            messages.append(('warning', f"{summary['invalid_cusip_count']} CUSIP(s) failed check-digit validation ({invalid_summary})."))
+        if summary['rule_violation_count']:
+            rule_summary = "; ".join(format_violation(v) for v in summary['rule_violations'][:3])
+            messages.append(('warning', f"{summary['rule_violation_count']} data-quality issue(s) found ({rule_summary})."))
+        if xml_is_valid is False:
+            messages.append(('warning', f"XML validation failed: {'; '.join(xml_validation_errors[:3])}"))
+            logger.warning(f"XML validation failed for '{output_xml_filename}'. Errors: {xml_validation_errors}")
+        logger.info(f"13F conversion successful for '{original_filename}'. Output: {output_xml_filename}")
+    else:
+        generated_xml_full_path, xml_is_valid, xml_validation_errors = result
+        if not generated_xml_full_path:
+            error_summary = "; ".join(xml_validation_errors[:3]) if xml_validation_errors else "Unknown error during XML creation."
+            logger.error(f"6151 XML creation failed for '{original_filename}'. Errors: {xml_validation_errors}")
+            return [('error', f'Failed to convert (6151) {original_filename}: {error_summary}')], None
+        output_xml_filename = os.path.basename(generated_xml_full_path)
+        logger.info(f"6151 conversion for '{original_filename}' produced '{output_xml_filename}'. Validation status: {'VALID' if xml_is_valid else 'INVALID'}")
+        if xml_is_valid:
+            messages.append(('success', f'Successfully converted (6151) {original_filename} to {output_xml_filename}. XML is valid.'))
+        else:
+            error_summary = "; ".join(xml_validation_errors[:3])
+            messages.append(('warning', f'Converted (6151) {original_filename} to {output_xml_filename}, but XML validation failed: {error_summary}'))
+            logger.warning(f"XML validation failed for '{output_xml_filename}'. Errors: {xml_validation_errors}")
+
+    profile_files = []
+    if profiled:
+        profile_files = [os.path.basename(path) for path in profile_paths(os.path.join(upload_folder, output_xml_filename))
+                         if os.path.exists(path)]
+    return messages, {
+        'converted_file': output_xml_filename,
+        'download_token': download_token,
+        'profile_files': profile_files,
+        'original_filename': original_filename,
+        'conversion_type_processed': conversion_type,
+        'xml_is_valid': xml_is_valid,
+        'xml_validation_errors': xml_validation_errors,
+    }
+
+# --- Downloads: gzip negotiation and conditional requests ---
+def accepts_gzip(accept_encoding):
+    """Whether an Accept-Encoding header value allows gzip (explicitly or through *, with q > 0)."""
+    accepted = {}
+    for item in (accept_encoding or '').split(','):
+        coding, _, params = item.strip().partition(';')
+        quality = 1.0
+        for param in params.split(';'):
+            name, _, value = param.strip().partition('=')
+            if name == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        accepted[coding.strip().lower()] = quality
+    return accepted.get('gzip', accepted.get('*', 0.0)) > 0
+
+def gzip_artifact(file_path):
+    """Path of the gzip-compressed copy cached next to file_path (<file>.gz), written the first time it is asked
+    for and again whenever the file changes. The copy carries the file's modification time, which is how a
+    stale copy is recognized."""
+    artifact_path = file_path + GZIP_SUFFIX
+    source_stat = os.stat(file_path)
+    try:
+        if os.stat(artifact_path).st_mtime_ns == source_stat.st_mtime_ns:
+            return artifact_path
+    except FileNotFoundError:
+        pass
+    # A unique temporary file in the same directory: threads of one process may compress the same file at once
+    fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(artifact_path) + '.', suffix='.tmp',
+                                    dir=os.path.dirname(artifact_path) or '.')
+    try:
+        with open(file_path, 'rb') as source, os.fdopen(fd, 'wb') as raw:
+            # mtime=0 keeps the compressed bytes (and so the ETag's size part) the same for the same content
+            with gzip.GzipFile(filename='', mode='wb', fileobj=raw, compresslevel=DOWNLOAD_GZIP_LEVEL, mtime=0) as compressed:
+                shutil.copyfileobj(source, compressed, 1024 * 1024)
+        os.utime(tmp_path, ns=(source_stat.st_atime_ns, source_stat.st_mtime_ns))
+        os.replace(tmp_path, artifact_path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    return artifact_path
+
+def download_variant(file_path, accept_encoding):
+    """(path to send, Content-Encoding or None) for a download: the cached gzip copy of text outputs when the
+    client accepts gzip, otherwise the file itself."""
+    if (file_path.lower().endswith(DOWNLOAD_GZIP_SUFFIXES) and accepts_gzip(accept_encoding)
+            and os.path.getsize(file_path) >= DOWNLOAD_GZIP_MIN_BYTES):
+        return gzip_artifact(file_path), 'gzip'
+    return file_path, None
+
+def file_etag(path):
+    """Strong entity tag of a file from its modification time and size, unquoted (send_file quotes it); different
+    for a file and its gzip copy."""
+    stat = os.stat(path)
+    return f"{stat.st_mtime_ns:x}-{stat.st_size:x}"
+
+def is_not_modified(headers, etag, modified_time):
+    """Whether a request's If-None-Match (or, without one, If-Modified-Since) header shows the client already
+    has this version (etag as returned by file_etag). headers is any case-insensitive mapping with .get."""
+    if_none_match = headers.get('if-none-match')
+    if if_none_match is not None:
+        tags = [tag.strip().removeprefix('W/') for tag in if_none_match.split(',')]
+        return '*' in tags or f'"{etag}"' in tags
+    if_modified_since = headers.get('if-modified-since')
+    if if_modified_since:
+        try:
+            return int(modified_time) <= email.utils.parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
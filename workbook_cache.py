@@ -0,0 +1,225 @@
+import os
+import json
+import hashlib
+import argparse
+import numpy as np
+import pandas as pd
+from conversion_metrics import record_cache_lookup
+
+try:
+    import pyarrow as pa
+    import pyarrow.feather as feather
+except ImportError:  # The cache is an optimisation; without pyarrow every read goes to pd.read_excel
+    pa = None
+    feather = None
+
+_BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+# Parsed workbooks are stored as uncompressed Feather (Arrow IPC) files so they can be memory-mapped on load.
+# WORKBOOK_CACHE_DIR / WORKBOOK_CACHE_MAX_MB override the defaults; WORKBOOK_CACHE_DISABLED=1 turns the cache off.
+CACHE_DIR = os.environ.get('WORKBOOK_CACHE_DIR', os.path.join(_BASE_DIR, 'cache', 'workbooks'))
+CACHE_MAX_BYTES = int(float(os.environ.get('WORKBOOK_CACHE_MAX_MB', '512')) * 1024 * 1024)
+# Bump when the on-disk encoding changes so stale entries are never read back
+CACHE_FORMAT_VERSION = "2"
+
+# Cell kinds used to round-trip object columns that mix text and numbers (common in 6151 sheets read with header=None)
+_KIND_NULL, _KIND_STR, _KIND_INT, _KIND_FLOAT, _KIND_OTHER = 0, 1, 2, 3, 4
+
+def cache_enabled() -> bool:
+    return feather is not None and os.environ.get('WORKBOOK_CACHE_DISABLED', '').lower() not in ('1', 'true', 'yes')
+
+def file_content_hash(filepath) -> str:
+    """SHA-256 of the file contents, read in 1 MB blocks."""
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def cache_key(filepath, read_kwargs) -> str:
+    """Key = file contents + reader settings + encoding/pandas version, so any of them changing misses."""
+    settings = json.dumps(read_kwargs, sort_keys=True, default=str)
+    material = f"{file_content_hash(filepath)}|{settings}|{CACHE_FORMAT_VERSION}|{pd.__version__}"
+    return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+class UncacheableFrame(ValueError):
+    """A parsed workbook the cache cannot give back exactly as pd.read_excel returned it."""
+
+def _encode_frame(df):
+    """Converts a DataFrame into an Arrow table. Pure-text object columns are stored as strings; object columns
+    mixing text and numbers are split into text/number/kind columns so ints, floats and strings come back as-is.
+    Raises UncacheableFrame for column labels other than str/int and for object columns holding other values
+    (booleans, dates) mixed in, which would come back as text."""
+    for col in df.columns:
+        if not isinstance(col, (str, int)) or isinstance(col, bool):
+            raise UncacheableFrame(f"column label {col!r} is a {type(col).__name__}")
+    arrays, names, columns_meta = [], [], []
+    for position, col in enumerate(df.columns):
+        series = df[col]
+        stored_name = f"c{position}"
+        values = series.to_numpy(dtype=object) if series.dtype == object else None
+        if values is None:
+            arrays.append(pa.array(series, from_pandas=True))
+            names.append(stored_name)
+            columns_meta.append({"name": col, "encoding": "plain"})
+            continue
+
+        kinds = np.fromiter((_cell_kind(v) for v in values), dtype=np.int8, count=len(values))
+        if np.isin(kinds, [_KIND_NULL, _KIND_STR]).all():
+            arrays.append(pa.array(series, type=pa.string(), from_pandas=True))
+            names.append(stored_name)
+            columns_meta.append({"name": col, "encoding": "string"})
+            continue
+
+        if (kinds == _KIND_OTHER).any():
+            other = values[kinds == _KIND_OTHER][0]
+            raise UncacheableFrame(f"column {col!r} holds {type(other).__name__} values among text and numbers")
+        text = [v if k == _KIND_STR else None for v, k in zip(values, kinds)]
+        numbers = [float(v) if k in (_KIND_INT, _KIND_FLOAT) else None for v, k in zip(values, kinds)]
+        arrays += [pa.array(text, type=pa.string()), pa.array(numbers, type=pa.float64()), pa.array(kinds)]
+        names += [stored_name, f"{stored_name}.num", f"{stored_name}.kind"]
+        columns_meta.append({"name": col, "encoding": "mixed"})
+
+    table = pa.Table.from_arrays(arrays, names=names)
+    meta = {"columns": columns_meta, "column_name_types": [type(c).__name__ for c in df.columns]}
+    return table.replace_schema_metadata({b"workbook_cache": json.dumps(meta, default=str).encode('utf-8')})
+
+def _cell_kind(value):
+    if value is None or (isinstance(value, float) and np.isnan(value)):
+        return _KIND_NULL
+    if isinstance(value, str):
+        return _KIND_STR
+    if isinstance(value, (bool, np.bool_)):
+        return _KIND_OTHER
+    if isinstance(value, (int, np.integer)):
+        return _KIND_INT
+    if isinstance(value, (float, np.floating)):
+        return _KIND_FLOAT
+    return _KIND_OTHER
+
+def _decode_frame(table):
+    meta = json.loads(table.schema.metadata[b"workbook_cache"])
+    data = {}
+    for position, col_meta in enumerate(meta["columns"]):
+        stored_name = f"c{position}"
+        if col_meta["encoding"] == "plain":
+            data[position] = table.column(stored_name).to_pandas()
+        elif col_meta["encoding"] == "string":
+            data[position] = table.column(stored_name).to_pandas().astype(object).where(lambda s: s.notna(), np.nan)
+        else:
+            text = table.column(stored_name).to_numpy(zero_copy_only=False)
+            numbers = table.column(f"{stored_name}.num").to_numpy(zero_copy_only=False)
+            kinds = table.column(f"{stored_name}.kind").to_numpy()
+            values = np.full(len(kinds), np.nan, dtype=object)
+            values[kinds == _KIND_STR] = text[kinds == _KIND_STR]
+            values[kinds == _KIND_FLOAT] = numbers[kinds == _KIND_FLOAT]
+            int_mask = kinds == _KIND_INT
+            values[int_mask] = [int(v) for v in numbers[int_mask]]
+            data[position] = pd.Series(values, dtype=object)
+
+    df = pd.DataFrame(data)
+    # Restore original labels (header=None gives integer column labels, header=0 gives strings)
+    df.columns = [int(c["name"]) if t == "int" else c["name"] for c, t in zip(meta["columns"], meta["column_name_types"])]
+    return df
+
+def read_excel_cached(filepath, **read_kwargs) -> pd.DataFrame:
+    """Drop-in replacement for pd.read_excel(filepath, **read_kwargs) that reuses a previously parsed copy
+    of the same workbook contents (and reader settings) from the Feather cache."""
+    if not cache_enabled():
+        record_cache_lookup('workbook', 'disabled')
+        return pd.read_excel(filepath, **read_kwargs)
+
+    key = cache_key(filepath, read_kwargs)
+    cache_path = os.path.join(CACHE_DIR, f"{key}.feather")
+    if os.path.exists(cache_path):
+        try:
+            table = feather.read_table(cache_path, memory_map=True)
+            os.utime(cache_path)  # Mark as recently used for eviction
+            print(f"Workbook cache hit for '{filepath}' ({key[:12]})")
+            frame = _decode_frame(table)
+            record_cache_lookup('workbook', 'hit')
+            return frame
+        except Exception as e:
+            print(f"Warning: Discarding unreadable workbook cache entry {cache_path}: {e}")
+            _remove_quietly(cache_path)
+
+    record_cache_lookup('workbook', 'miss')
+    df = pd.read_excel(filepath, **read_kwargs)
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        feather.write_feather(_encode_frame(df), tmp_path, compression='uncompressed')
+        os.replace(tmp_path, cache_path)  # Atomic, so concurrent workers never read a partial file
+        evict_to_size(CACHE_MAX_BYTES)
+    except UncacheableFrame as e:
+        print(f"Workbook '{filepath}' not cached: {e}")
+    except Exception as e:
+        print(f"Warning: Could not write workbook cache entry for '{filepath}': {e}")
+    return df
+
+def _cache_entries():
+    if not os.path.isdir(CACHE_DIR):
+        return []
+    entries = []
+    for name in os.listdir(CACHE_DIR):
+        if name.endswith('.feather'):
+            path = os.path.join(CACHE_DIR, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((path, stat.st_size, stat.st_mtime))
+    return entries
+
+def _remove_quietly(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+def evict_to_size(max_bytes):
+    """Deletes least recently used entries until the cache fits in max_bytes. Returns the number removed."""
+    entries = sorted(_cache_entries(), key=lambda e: e[2])
+    total = sum(size for _, size, _ in entries)
+    removed = 0
+    for path, size, _ in entries:
+        if total <= max_bytes:
+            break
+        _remove_quietly(path)
+        total -= size
+        removed += 1
+    return removed
+
+def cache_stats():
+    entries = _cache_entries()
+    return {"directory": CACHE_DIR, "entries": len(entries), "total_bytes": sum(size for _, size, _ in entries),
+            "max_bytes": CACHE_MAX_BYTES, "enabled": cache_enabled()}
+
+def clear_cache():
+    """Removes every cache entry. Returns the number of entries removed."""
+    entries = _cache_entries()
+    for path, _, _ in entries:
+        _remove_quietly(path)
+    return len(entries)
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect or clear the parsed-workbook cache.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("stats", help="Show the cache location, entry count and size.")
+    subparsers.add_parser("list", help="List cache entries, most recently used first.")
+    subparsers.add_parser("clear", help="Remove all cache entries.")
+    args = parser.parse_args()
+
+    if args.command == "stats":
+        stats = cache_stats()
+        print(f"Cache directory: {stats['directory']}")
+        print(f"Enabled: {stats['enabled']}")
+        print(f"Entries: {stats['entries']}")
+        print(f"Size: {stats['total_bytes'] / (1024 * 1024):.2f} MB of {stats['max_bytes'] / (1024 * 1024):.0f} MB")
+    elif args.command == "list":
+        for path, size, mtime in sorted(_cache_entries(), key=lambda e: e[2], reverse=True):
+            print(f"{pd.Timestamp(mtime, unit='s'):%Y-%m-%d %H:%M:%S}  {size / 1024:10.1f} KB  {os.path.basename(path)}")
+    elif args.command == "clear":
+        print(f"Removed {clear_cache()} cache entries from {CACHE_DIR}")
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,26 @@
 import pandas as pd
-from xml.etree.ElementTree import Element, SubElement, ElementTree, tostring
 import os
 import glob
-import xml.dom.minidom as minidom
 import re
+import sys
+import json
+import time
+import itertools
+import argparse
+import contextlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from xml.sax.saxutils import escape
+from lxml import etree
+from cusip_reference import CusipIndex, enrich_holdings
+from holdings_input import SUPPORTED_HOLDINGS_EXTENSIONS, DEFAULT_STREAM_CHUNK_SIZE, read_holdings_table, iter_holdings_chunks
+from conversion_metrics import tracked_conversion, observe_stage, timed_iteration
+from xml_validation import (validate_xml_file, load_schema, SourceMap, first_sheet_name, issues_as_dicts,
+                            format_validation_stats, MAX_VALIDATION_ERRORS)
+from holdings_rules import build_holdings_rules, check_holdings, new_rule_report, merge_rule_report, format_violation
+from holdings_coercion import compile_coercion_plan, coerce_holdings, merge_coercion_stats, integer_texts
+from filings_store import HoldingsRecording, record_holdings_filing
+from conversion_profiler import profiled_conversion, output_argument
+from conversion_progress import report_progress, count_progress
 
 # Define mappings for expected Excel column headers, their synonyms, and requirements
 COLUMN_MAPPINGS = {
@@ -11,17 +28,60 @@ COLUMN_MAPPINGS = {
     "title_of_class": {"primary": "Title of Class", "synonyms": ["Instrument Subtype", "Equity", "Debt", "Option", "Class Title", "Security Type"], "required": True},
     "cusip": {"primary": "Cusip", "synonyms": ["CUSIP ID", "CUSIP/CINS"], "required": True},
     "figi": {"primary": "FIGI", "synonyms": [], "required": False},
-    "value_col": {"primary": "Value (to the nearest dollar)", "synonyms": ["Value", "Market Value"], "required": True, "is_numeric": True, "numeric_type": float},
+    "value_col": {"primary": "Value (to the nearest dollar)", "synonyms": ["Value", "Market Value"], "required": True, "is_numeric": True, "numeric_type": float, "fill_value": 0.0},
     "shares_amount_col": {"primary": "Shares or Principal Amount", "synonyms": ["Shares", "Principal Amount", "Quantity", "Shares Amount"], "required": True, "is_numeric": True, "numeric_type": int},
     "shares_type_col": {"primary": "Shares/Principal", "synonyms": ["Shrs/Prn Typ", "Type", "SH/PRN", "Amount Type", "Share Type"], "required": True, "positional_fallback": "Unnamed: 5"},
     "put_call": {"primary": "put/call", "synonyms": ["Put/Call Option", "Put Call Indicator"], "required": False},
     "investment_discretion_col": {"primary": "Investment Discretion", "synonyms": ["Discretion"], "required": True, "positional_fallback": "Unnamed: 6"},
-    "other_managers_col": {"primary": "Other Managers", "synonyms": ["Other Manager"], "required": False, "is_numeric": True, "numeric_type": int, "positional_fallback": "Unnamed: 7"},
+    # Other managers is text in EDGAR (sequence numbers such as "1,3"); whole numbers are written without ".0"
+    "other_managers_col": {"primary": "Other Managers", "synonyms": ["Other Manager"], "required": False, "positional_fallback": "Unnamed: 7"},
     "sole_voting_col": {"primary": "Sole", "synonyms": ["Sole Voting", "Voting Authority Sole"], "required": True, "is_numeric": True, "numeric_type": int, "positional_fallback": "Unnamed: 8"},
     "shared_voting_col": {"primary": "Shared", "synonyms": ["Shared Voting", "Voting Authority Shared"], "required": True, "is_numeric": True, "numeric_type": int, "positional_fallback": "Unnamed: 9"},
     "none_voting_col": {"primary": "None", "synonyms": ["No Voting", "None Voting", "Voting Authority None"], "required": False, "is_numeric": True, "numeric_type": int, "positional_fallback": "Unnamed: 10"}
 }
 
+# Per-field dtypes compiled from the mappings; applied to whole columns by prepare_holdings
+COERCION_PLAN = compile_coercion_plan(COLUMN_MAPPINGS)
+# Pre-flight data-quality rules (see holdings_rules.py), evaluated on the raw resolved columns before conversion
+HOLDINGS_RULES = build_holdings_rules(COLUMN_MAPPINGS)
+
+_INFORMATION_TABLE_OPEN = ('<ns1:informationTable xmlns:ns1="http://www.sec.gov/edgar/document/thirteenf/informationtable" '
+                           'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">')
+_INFORMATION_TABLE_CLOSE = '</ns1:informationTable>'
+# minidom escapes double quotes in text as well as &, < and >; keep doing the same
+_XML_TEXT_ESCAPES = {'"': "&quot;"}
+
+_BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+# EDGAR information table schema. It imports eis_Common.xsd from the same folder; EDGAR_13F_XSD_PATH points
+# validation at another copy of the EDGAR 13F schema set.
+EDGAR_13F_XSD_FILE_PATH = os.environ.get('EDGAR_13F_XSD_PATH', os.path.join(_BASE_DIR, 'Conversion specs', 'eis_13FDocument.xsd'))
+
+# infoTable child elements -> COLUMN_MAPPINGS key of the column they are written from
+XML_ELEMENT_FIELDS = {
+    "nameOfIssuer": "name_of_issuer", "titleOfClass": "title_of_class", "cusip": "cusip", "figi": "figi",
+    "value": "value_col", "sshPrnamt": "shares_amount_col", "sshPrnamtType": "shares_type_col", "putCall": "put_call",
+    "investmentDiscretion": "investment_discretion_col", "otherManager": "other_managers_col",
+    "Sole": "sole_voting_col", "Shared": "shared_voting_col", "None": "none_voting_col",
+}
+
+# Invalid CUSIPs listed individually in the summary/log (the total is always counted)
+MAX_REPORTED_INVALID_CUSIPS = 1000
+
+# Master workbooks holding several filing managers are split on this column (see split_perfect_edgar_xml)
+MANAGER_KEY_COLUMN = {"primary": "Manager", "synonyms": ["CIK", "Manager CIK", "Filer CIK", "Filing Manager", "Manager Name"]}
+# Managers of a split workbook converted at the same time (one process each)
+SPLIT_MAX_WORKERS = int(os.environ.get('SPLIT_MAX_WORKERS', str(min(4, os.cpu_count() or 1))))
+# Write information tables without indentation, one infoTable entry per line (XML_COMPACT_OUTPUT=1 or --compact).
+# Schema-equivalent to the indented layout and quicker to write and download; validation errors still map to Excel rows.
+XML_COMPACT_OUTPUT = os.environ.get('XML_COMPACT_OUTPUT', '').lower() in ('1', 'true', 'yes')
+
+# Mapping keys that identify one reportable holding. Rows that agree on all of these are combined
+# into a single infoTable entry when aggregation is enabled (SH and PRN, puts and calls stay separate).
+AGGREGATION_KEY_FIELDS = ["name_of_issuer", "title_of_class", "cusip", "shares_type_col", "put_call",
+                          "investment_discretion_col", "other_managers_col"]
+# Mapping keys whose values are summed across the combined rows
+AGGREGATION_SUM_FIELDS = ["value_col", "shares_amount_col", "sole_voting_col", "shared_voting_col", "none_voting_col"]
+
 def find_actual_column_name(df_columns, primary_name, synonyms, positional_fallback=None):
     """Try to find the actual column name in df_columns using primary_name, synonyms (case-insensitive, stripped),
        the positional_fallback name, or the column at the index specified by positional_fallback."""
@@ -65,13 +125,48 @@ def find_actual_column_name(df_columns, primary_name, synonyms, positional_fallb
 
     return None
 
-def create_perfect_edgar_xml(input_xlsx, output_xml):
-    print(f"\n--- Debugging for {input_xlsx} ---")
-    # Read the Excel file, explicitly setting header to row 0
-    df = pd.read_excel(input_xlsx, header=0)
-    df_columns = df.columns.tolist()
-    print(f"Excel columns found in '{input_xlsx}' (using header=0): {df_columns}")
-
+def aggregate_holdings(df, resolved_cols):
+    """Combine rows that describe the same holding (same issuer, class, CUSIP, share type, put/call,
+       discretion and other managers), summing value, shares and voting authority.
+       Returns (aggregated_df, stats) where stats holds the before/after row counts."""
+    # dict.fromkeys de-duplicates while keeping order, in case a positional fallback resolved twice
+    key_cols = list(dict.fromkeys(resolved_cols[k] for k in AGGREGATION_KEY_FIELDS if k in resolved_cols))
+    sum_cols = [col for col in dict.fromkeys(resolved_cols[k] for k in AGGREGATION_SUM_FIELDS if k in resolved_cols)
+                if col not in key_cols]
+    rows_before = len(df)
+
+    df = df.copy()
+    # Strip text keys so that e.g. "SOLE" and "SOLE " fall into the same group; NaN stays NaN
+    for col in key_cols:
+        if df[col].dtype == object:
+            df[col] = df[col].where(df[col].isna(), df[col].astype(str).str.strip())
+    for col in sum_cols:
+        df[col] = pd.to_numeric(df[col], errors='coerce').fillna(0)
+
+    agg_spec = {col: "sum" if col in sum_cols else "first" for col in df.columns if col not in key_cols}
+    # Each combined holding keeps the index of its first source row, so errors can still point at a sheet row
+    df["__source_index"] = df.index
+    agg_spec["__source_index"] = "first"
+    aggregated = df.groupby(key_cols, sort=False, dropna=False).agg(agg_spec).reset_index()
+    aggregated.index = pd.Index(aggregated.pop("__source_index").to_numpy())
+    aggregated = aggregated[[col for col in df.columns if col in aggregated.columns]]
+
+    # groupby turns blank (None) text keys into NaN; the writer expects None for blank text
+    for field_key, col in resolved_cols.items():
+        if COERCION_PLAN[field_key]["kind"] == "text" and col in aggregated.columns:
+            aggregated[col] = aggregated[col].astype(object).where(aggregated[col].notna(), None)
+
+    # Summed share and voting counts are whole numbers; keep them integral so they are written as such
+    for field_key in AGGREGATION_SUM_FIELDS:
+        col = resolved_cols.get(field_key)
+        if col in sum_cols and COLUMN_MAPPINGS[field_key].get("numeric_type") == int:
+            aggregated[col] = aggregated[col].round().astype("int64")
+
+    stats = {"rows_before": rows_before, "rows_after": len(aggregated)}
+    return aggregated, stats
+
+def resolve_column_map(df_columns, source_label):
+    """Resolve every COLUMN_MAPPINGS field to an actual column name. Raises ValueError if a required one is missing."""
     resolved_cols = {}
     missing_required_cols = []
     print("--- Attempting to resolve column names: ---")
@@ -89,7 +184,214 @@ def create_perfect_edgar_xml(input_xlsx, output_xml):
     if missing_required_cols:
         raise ValueError(f"Missing required Excel columns: {'; '.join(missing_required_cols)}.")
 
-    print(f"--- Final resolved column map for '{input_xlsx}': {resolved_cols} ---")
+    print(f"--- Final resolved column map for '{source_label}': {resolved_cols} ---")
+    return resolved_cols
+
+def prepare_holdings(df, resolved_cols):
+    """Coerce every resolved column to its declared type (see holdings_coercion.py) in one pass per column.
+       Returns (df, stats) with per-column conversion statistics."""
+    return coerce_holdings(df, resolved_cols, COERCION_PLAN)
+
+def _check_cusips(df, resolved_cols, cusip_index, correct_from_13f_list, cusip_report):
+    """Runs enrich_holdings on df and folds its findings into the running cusip_report. Returns the enriched df."""
+    df, chunk_report = enrich_holdings(df, resolved_cols, cusip_index, correct=correct_from_13f_list)
+    for excel_row, bad_cusip in chunk_report["invalid_cusips"]:
+        if cusip_report["invalid_cusip_count"] < MAX_REPORTED_INVALID_CUSIPS:
+            cusip_report["invalid_cusips"].append((excel_row, bad_cusip))
+            print(f"    --> Warning: Invalid CUSIP '{bad_cusip}' in Excel row {excel_row}.")
+        cusip_report["invalid_cusip_count"] += 1
+    for key in ["not_on_list", "titles_updated", "issuers_updated"]:
+        cusip_report[key] += chunk_report[key]
+    return df
+
+def _new_cusip_report():
+    return {"invalid_cusips": [], "invalid_cusip_count": 0, "not_on_list": 0, "titles_updated": 0, "issuers_updated": 0}
+
+def _print_cusip_summary(cusip_report, source_label, cusip_index_path):
+    if cusip_report["invalid_cusip_count"] > len(cusip_report["invalid_cusips"]):
+        print(f"    --> ... and {cusip_report['invalid_cusip_count'] - len(cusip_report['invalid_cusips'])} more invalid CUSIPs.")
+    if cusip_index_path:
+        print(f"--- 13F List check for '{source_label}': {cusip_report['not_on_list']} valid CUSIPs not on the list, "
+              f"{cusip_report['titles_updated']} titles and {cusip_report['issuers_updated']} issuer names updated ---")
+
+def _print_rule_summary(rule_report, source_label):
+    for violation in rule_report["violations"][:20]:
+        print(f"    --> {violation['severity'].capitalize()}: {format_violation(violation)}")
+    if rule_report["violation_count"] > 20:
+        print(f"    --> ... and {rule_report['violation_count'] - 20} more rule violations.")
+    print(f"--- Data-quality check for '{source_label}': {rule_report['rows_checked']} rows, "
+          f"{rule_report['violation_count']} violations {rule_report['counts']} in {rule_report['seconds'] * 1000:.1f} ms ---")
+
+def _print_coercion_summary(coercion_stats, source_label):
+    problems = {col: {key: count for key, count in stats.items() if key in ("invalid", "fractional", "filled") and count}
+                for col, stats in coercion_stats.items()}
+    problems = {col: counts for col, counts in problems.items() if counts}
+    print(f"--- Type coercion for '{source_label}': {len(coercion_stats)} columns, "
+          f"{'cells not converted ' + str(problems) if problems else 'all non-blank cells converted'} ---")
+
+def _rule_summary_fields(rule_report):
+    return {"rule_violation_count": rule_report["violation_count"], "rule_counts": rule_report["counts"],
+            "rule_violations": rule_report["violations"]}
+
+def _text_elements(texts, tag, indent, optional=False, newline="\n"):
+    """Element lines for a typed text column (str, None when blank), formatted as minidom's tab-indented
+       toprettyxml() wrote them (or unindented on one line with indent="" and newline=""). Blank optional
+       elements are left out."""
+    start, end = f"{indent}<{tag}>", f"</{tag}>{newline}"
+    empty = "" if optional else f"{indent}<{tag}/>{newline}"
+    return [f"{start}{escape(text, _XML_TEXT_ESCAPES)}{end}" if text else empty for text in texts]
+
+def _info_table_entries(df, resolved_cols, compact=False):
+    """Yields the XML text of one ns1:infoTable element per DataFrame row. Expects the typed columns produced by
+       prepare_holdings: integers are serialized straight from their Int64 arrays and text is already stripped.
+       Compact entries have no indentation and take exactly one line each."""
+    # Indentation of the infoTable, its children and grandchildren, and the line break after each element
+    t1, t2, t3, nl = ("", "", "", "") if compact else ("\t", "\t\t", "\t\t\t", "\n")
+
+    def column(field_key):
+        col = resolved_cols.get(field_key)
+        return df[col] if col else None
+
+    def text_elements(field_key, tag, indent=t2, optional=False):
+        values = column(field_key)
+        texts = values.tolist() if values is not None else [None] * len(df)
+        return _text_elements(texts, tag, indent, optional, nl)
+
+    def integer_elements(field_key, tag, indent=t3, default=None):
+        values = column(field_key)
+        if values is None:
+            texts = [default] * len(df)
+        else:
+            texts = integer_texts(values)
+        return _text_elements(texts, tag, indent, newline=nl)
+
+    # Value rounded to nearest dollar
+    values = column("value_col")
+    value_texts = integer_texts(values.round().astype("Int64")) if values is not None else ["0"] * len(df)
+    element_columns = [
+        text_elements("name_of_issuer", "ns1:nameOfIssuer"),
+        text_elements("title_of_class", "ns1:titleOfClass"),
+        text_elements("cusip", "ns1:cusip"),
+        text_elements("figi", "ns1:figi", optional=True),
+        _text_elements(value_texts, "ns1:value", t2, newline=nl),
+        [f"{t2}<ns1:shrsOrPrnAmt>{nl}"] * len(df),
+        integer_elements("shares_amount_col", "ns1:sshPrnamt"),
+        text_elements("shares_type_col", "ns1:sshPrnamtType", t3),
+        [f"{t2}</ns1:shrsOrPrnAmt>{nl}"] * len(df),
+        text_elements("put_call", "ns1:putCall", optional=True),
+        text_elements("investment_discretion_col", "ns1:investmentDiscretion"),
+        text_elements("other_managers_col", "ns1:otherManager", optional=True),
+        [f"{t2}<ns1:votingAuthority>{nl}"] * len(df),
+        integer_elements("sole_voting_col", "ns1:Sole"),
+        integer_elements("shared_voting_col", "ns1:Shared"),
+        # None voting is optional and defaults to 0 if the column was not found
+        integer_elements("none_voting_col", "ns1:None", default="0"),
+    ]
+    entry_start, entry_end = f"{t1}<ns1:infoTable>{nl}", f"{t2}</ns1:votingAuthority>{nl}{t1}</ns1:infoTable>\n"
+    for parts in zip(*element_columns):
+        yield entry_start + "".join(parts) + entry_end
+
+def write_information_table(frames, output_xml, resolved_cols, source_map=None, compact=None):
+    """Write the information table XML from an iterable of DataFrames (a single frame or a stream of chunks).
+       Each frame is serialized and written as soon as it arrives, so memory is bounded by the largest frame.
+       The layout (tab indentation, standalone="yes" declaration) matches the original minidom output, or is
+       compact (one unindented infoTable per line) when compact is True (default XML_COMPACT_OUTPUT).
+       When a SourceMap is given, the lines of each infoTable entry are recorded against its Excel row.
+       Returns the number of infoTable entries written."""
+    compact = XML_COMPACT_OUTPUT if compact is None else compact
+    rows_written = 0
+    next_line = 3 # Line 1 is the XML declaration, line 2 the informationTable start tag
+    with open(output_xml, "wb") as file:
+        # Write the XML to file with standalone="yes" in the declaration
+        file.write(b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n')
+        for frame in frames:
+            if len(frame) == 0:
+                continue
+            if rows_written == 0:
+                file.write(f"{_INFORMATION_TABLE_OPEN}\n".encode("utf-8"))
+            entries = list(_info_table_entries(frame, resolved_cols, compact))
+            if source_map is not None:
+                # Excel row = DataFrame index + 2 (header row is row 1)
+                next_line = source_map.add_blocks(next_line, [entry.count("\n") for entry in entries], frame.index + 2)
+            file.write("".join(entries).encode("utf-8"))
+            rows_written += len(frame)
+            count_progress(rows_emitted=len(frame))
+        if rows_written:
+            file.write(_INFORMATION_TABLE_CLOSE.encode("utf-8"))
+        else:
+            file.write(_INFORMATION_TABLE_OPEN.replace(">", "/>").encode("utf-8"))
+    return rows_written
+
+def information_table_source_map(input_path, resolved_cols):
+    """Empty SourceMap for a holdings file; infoTable element names resolve to the holdings column they came from."""
+    tag_columns = {tag: resolved_cols[field_key] for tag, field_key in XML_ELEMENT_FIELDS.items() if resolved_cols.get(field_key)}
+    return SourceMap(first_sheet_name(input_path), tag_columns)
+
+def validate_information_table(output_xml, source_map=None, max_errors=MAX_VALIDATION_ERRORS, streaming=None):
+    """Validates a generated information table against the EDGAR 13F schema. Large files are validated while
+       streaming (see xml_validation.validate_xml_file); at most max_errors errors are reported.
+       Returns (is_valid, errors, stats); is_valid is None when the schema itself cannot be loaded."""
+    try:
+        load_schema(EDGAR_13F_XSD_FILE_PATH)
+    except (OSError, etree.XMLSchemaParseError, etree.XMLSyntaxError) as e:
+        print(f"Warning: 13F schema '{EDGAR_13F_XSD_FILE_PATH}' could not be loaded, skipping validation: {e}")
+        return None, [f"13F schema unavailable: {e}"], None
+    is_valid, errors, stats = validate_xml_file(output_xml, EDGAR_13F_XSD_FILE_PATH, source_map, max_errors, streaming)
+    if is_valid:
+        print("XML validation successful.")
+    else:
+        print(f"XML validation failed with {len(errors)} error(s):")
+        for err in errors[:20]:
+            print(f"- {err}")
+    print(f"--- {format_validation_stats(stats)} ---")
+    return is_valid, errors, stats
+
+@profiled_conversion(output_argument('output_xml', 1))
+@tracked_conversion('13F', lambda summary: summary["rows_written"])
+def create_perfect_edgar_xml(input_xlsx, output_xml, aggregate=False, cusip_index_path=None, correct_from_13f_list=False,
+                             validate=False, client=None, period=None, compact=None, record_history=True):
+    """Convert a 13F holdings workbook (or a .csv/.parquet export) to an EDGAR information table XML file.
+       Every CUSIP's check digit is validated. When cusip_index_path points at a local 13F List index
+       (see cusip_reference.py), blank title of class / issuer name are filled from it, or replaced by the
+       official values when correct_from_13f_list is True.
+       When aggregate is True, rows for the same holding are combined first (see aggregate_holdings).
+       When validate is True the XML is checked against the EDGAR schema and each error is mapped back to
+       its sheet row and column.
+       The converted holdings are recorded in the filings history (filings_store.py) as the filing of client for
+       period, unless record_history is False; client and period default to what the input file name says.
+       compact writes one unindented infoTable per line (default XML_COMPACT_OUTPUT).
+       Returns a summary dict with the number of rows read and infoTable entries written.
+       The read, build, serialize and validate stages are also callable one at a time (batch_pipeline.py runs
+       them for different files concurrently)."""
+    df = read_holdings_stage(input_xlsx)
+    prepared = build_holdings_stage(df, input_xlsx, aggregate, cusip_index_path, correct_from_13f_list)
+    rows_written, source_map = serialize_holdings_stage(prepared, output_xml, validate, client, period, compact, record_history)
+    validation = validate_holdings_stage(output_xml, source_map) if validate else (None, [], None)
+    return holdings_summary(prepared, rows_written, validation)
+
+# --- Conversion stages ---
+def read_holdings_stage(input_xlsx):
+    """Read stage: the holdings table exactly as read from the file."""
+    print(f"\n--- Debugging for {input_xlsx} ---")
+    # Read the holdings (.xlsx, .csv or .parquet), explicitly setting header to row 0
+    stage_started = time.perf_counter()
+    report_progress('reading')
+    df = read_holdings_table(input_xlsx)
+    observe_stage('13F', 'read', time.perf_counter() - stage_started)
+    report_progress('building', rows_read=len(df))
+    return df
+
+def build_holdings_stage(df, input_xlsx, aggregate=False, cusip_index_path=None, correct_from_13f_list=False,
+                         resolved_cols=None):
+    """Build stage: resolves the columns (unless resolved_cols is given), checks the data-quality rules, coerces
+       types, checks CUSIPs and aggregates. Returns a dict with input_xlsx, df, resolved_cols, rows_read,
+       aggregated, rule_report, coercion_stats and cusip_report."""
+    stage_started = time.perf_counter()
+    df_columns = df.columns.tolist()
+    print(f"Excel columns found in '{input_xlsx}' (using header=0): {df_columns}")
+
+    if resolved_cols is None:
+        resolved_cols = resolve_column_map(df_columns, input_xlsx)
 
     # Display relevant parts of the DataFrame before numeric conversion
     # Filter to only show columns that were successfully resolved AND exist in the DataFrame
@@ -105,14 +407,13 @@ def create_perfect_edgar_xml(input_xlsx, output_xml):
         print(f"--- DataFrame head for '{input_xlsx}': No valid resolved columns to display or an issue with resolved names. All columns head (first 3 rows): ---")
         print(df.head(3).to_string())
 
-    # Pre-process numeric columns to handle NaN and ensure correct types, using resolved names
-    # Value (to the nearest dollar)
-    value_actual_col = resolved_cols.get("value_col")
-    if value_actual_col:
-        df[value_actual_col] = pd.to_numeric(df[value_actual_col], errors='coerce').fillna(0.0)
+    # Check every data-quality rule on the raw values, before blanks are filled in
+    rule_report = check_holdings(df, resolved_cols, HOLDINGS_RULES)
+    _print_rule_summary(rule_report, input_xlsx)
 
-    # Integer columns - combining logic for all numeric int types
-    integer_field_keys = [k for k, v in COLUMN_MAPPINGS.items() if v.get("is_numeric") and v.get("numeric_type") == int]
+    # Convert every resolved column to its declared type (Int64 counts, float64 value, stripped text)
+    df, coercion_stats = prepare_holdings(df, resolved_cols)
+    _print_coercion_summary(coercion_stats, input_xlsx)
 
     # Display relevant parts of the DataFrame AFTER numeric conversion
     if display_columns: # Re-use display_columns from before, assuming they are still relevant
@@ -126,73 +427,231 @@ def create_perfect_edgar_xml(input_xlsx, output_xml):
         print(f"--- DataFrame head for '{input_xlsx}' after numeric: No valid resolved columns. All columns head (first 3 rows): ---")
         print(df.head(3).to_string())
 
-    # Create the root element with proper namespace declaration and prefix
-    root = Element("ns1:informationTable", attrib={
-        "xmlns:ns1": "http://www.sec.gov/edgar/document/thirteenf/informationtable",
-        "xmlns:xsi": "http://www.w3.org/2001/XMLSchema-instance"
-    })
-
-    # Iterate through each row in the dataframe
-    for _, row in df.iterrows():
-        # Create an infoTable entry with namespace prefix
-        info_table = SubElement(root, "ns1:infoTable")
-
-        # Required fields with namespace prefix, using resolved column names
-        SubElement(info_table, "ns1:nameOfIssuer").text = str(row[resolved_cols["name_of_issuer"]]).strip()
-        SubElement(info_table, "ns1:titleOfClass").text = str(row[resolved_cols["title_of_class"]]).strip()
-        SubElement(info_table, "ns1:cusip").text = str(row[resolved_cols["cusip"]]).strip()
-
-        # Optional FIGI field with namespace prefix
-        figi_actual_col = resolved_cols.get("figi")
-        if figi_actual_col and pd.notnull(row.get(figi_actual_col, None)):
-            SubElement(info_table, "ns1:figi").text = str(row[figi_actual_col]).strip()
-
-        # Value rounded to nearest dollar with namespace prefix
-        value_data = 0
-        if value_actual_col:
-            value_data = round(float(row[value_actual_col]))
-        SubElement(info_table, "ns1:value").text = str(int(value_data)).strip()
-
-        # Shares or principal amount with namespace prefix
-        shrs_or_prn_amt = SubElement(info_table, "ns1:shrsOrPrnAmt")
-        SubElement(shrs_or_prn_amt, "ns1:sshPrnamt").text = str(row[resolved_cols["shares_amount_col"]]).strip()
-        SubElement(shrs_or_prn_amt, "ns1:sshPrnamtType").text = str(row[resolved_cols["shares_type_col"]]).strip()
-
-        # Optional put/call field with namespace prefix
-        put_call_actual_col = resolved_cols.get("put_call")
-        if put_call_actual_col and pd.notnull(row.get(put_call_actual_col, None)):
-            SubElement(info_table, "ns1:putCall").text = str(row[put_call_actual_col]).strip()
-
-        # Required investment discretion with namespace prefix
-        SubElement(info_table, "ns1:investmentDiscretion").text = str(row[resolved_cols["investment_discretion_col"]]).strip()
-
-        # Optional other manager field with namespace prefix
-        other_managers_actual_col = resolved_cols.get("other_managers_col")
-        if other_managers_actual_col and pd.notnull(row.get(other_managers_actual_col, None)):
-            SubElement(info_table, "ns1:otherManager").text = str(row[other_managers_actual_col]).strip()
-
-        # Voting authority with namespace prefix
-        voting_authority = SubElement(info_table, "ns1:votingAuthority")
-        SubElement(voting_authority, "ns1:Sole").text = str(row[resolved_cols["sole_voting_col"]]).strip()
-        SubElement(voting_authority, "ns1:Shared").text = str(row[resolved_cols["shared_voting_col"]]).strip()
-
-        # Handle None voting (now optional, defaults to 0 if not found)
-        none_voting_value = 0 # Default to 0
-        none_voting_actual_col = resolved_cols.get("none_voting_col")
-        if none_voting_actual_col: # If column was resolved
-            none_voting_value = row[none_voting_actual_col] # Value is already pre-processed to int
-        SubElement(voting_authority, "ns1:None").text = str(none_voting_value).strip()
-
-    # Convert the XML tree to a string with proper indentation
-    raw_xml = tostring(root, encoding="utf-8", method="xml")
-    pretty_xml = minidom.parseString(raw_xml).toprettyxml(indent="	", encoding="utf-8")
-
-    # Write the XML to file with standalone="yes" in the declaration
-    with open(output_xml, "wb") as file:
-        file.write(b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n')
-        pretty_xml = pretty_xml.replace(b'<?xml version="1.0" encoding="utf-8"?>\n', b'')
-        file.write(pretty_xml.strip())
+    rows_read = len(df)
+
+    # Validate CUSIPs and enrich from the 13F List before aggregating, so corrected keys group together
+    cusip_report = _new_cusip_report()
+    cusip_index = CusipIndex(cusip_index_path) if cusip_index_path else None
+    try:
+        df = _check_cusips(df, resolved_cols, cusip_index, correct_from_13f_list, cusip_report)
+    finally:
+        if cusip_index:
+            cusip_index.close()
+    _print_cusip_summary(cusip_report, input_xlsx, cusip_index_path)
+
+    if aggregate:
+        df, aggregation_stats = aggregate_holdings(df, resolved_cols)
+        print(f"--- Aggregated holdings for '{input_xlsx}': {aggregation_stats['rows_before']} rows -> {aggregation_stats['rows_after']} rows ---")
+
+    observe_stage('13F', 'build', time.perf_counter() - stage_started)
+    return {"input_xlsx": input_xlsx, "df": df, "resolved_cols": resolved_cols, "rows_read": rows_read,
+            "aggregated": aggregate, "rule_report": rule_report, "coercion_stats": coercion_stats,
+            "cusip_report": cusip_report}
+
+def serialize_holdings_stage(prepared, output_xml, validate=False, client=None, period=None, compact=None,
+                             record_history=True):
+    """Serialize stage: writes the information table and records it in the filings history (unless
+       record_history is False). Returns
+       (rows_written, source_map); the source map is only recorded when the file is going to be validated."""
+    stage_started = time.perf_counter()
+    report_progress('writing')
+    source_map = information_table_source_map(prepared["input_xlsx"], prepared["resolved_cols"]) if validate else None
+    rows_written = write_information_table([prepared["df"]], output_xml, prepared["resolved_cols"], source_map, compact)
+    observe_stage('13F', 'serialize', time.perf_counter() - stage_started)
     print(f"Perfect EDGAR-compliant XML file created: {output_xml}")
+    record_holdings_filing([prepared["df"]], prepared["resolved_cols"], prepared["input_xlsx"], client, period,
+                           enabled=record_history)
+    return rows_written, source_map
+
+def holdings_summary(prepared, rows_written, validation=(None, [], None)):
+    """The summary dict create_perfect_edgar_xml returns, from the build stage's result, the number of rows
+       written and the (is_valid, errors, stats) of the validate stage."""
+    xml_valid, validation_errors, validation_stats = validation
+    cusip_report = prepared["cusip_report"]
+    return {"rows_read": prepared["rows_read"], "rows_written": rows_written, "aggregated": prepared["aggregated"],
+            "invalid_cusips": cusip_report["invalid_cusips"], "invalid_cusip_count": cusip_report["invalid_cusip_count"],
+            "cusips_not_on_list": cusip_report["not_on_list"], "xml_valid": xml_valid, "validation_errors": validation_errors,
+            "validation_stats": validation_stats, **_rule_summary_fields(prepared["rule_report"]),
+            "coercion_stats": prepared["coercion_stats"]}
+
+def validate_holdings_stage(output_xml, source_map):
+    """Validate stage: (is_valid, errors, stats) as returned by validate_information_table."""
+    stage_started = time.perf_counter()
+    result = validate_information_table(output_xml, source_map)
+    observe_stage('13F', 'validate', time.perf_counter() - stage_started)
+    return result
+
+
+@profiled_conversion(output_argument('output_xml', 1))
+@tracked_conversion('13F', lambda summary: summary["rows_written"])
+def stream_perfect_edgar_xml(input_xlsx, output_xml, chunk_size=DEFAULT_STREAM_CHUNK_SIZE,
+                             cusip_index_path=None, correct_from_13f_list=False, validate=False, client=None, period=None,
+                             compact=None, record_history=True):
+    """Constant-memory variant of create_perfect_edgar_xml for very large workbooks or CSV/Parquet exports.
+       Rows are streamed from the file in chunks, resolved against COLUMN_MAPPINGS once, then prepared,
+       CUSIP-checked and written chunk by chunk, so peak memory depends on chunk_size rather than row count.
+       Aggregation needs the whole table and is not available here. Returns the same summary dict."""
+    print(f"\n--- Streaming conversion for {input_xlsx} (chunk size {chunk_size}) ---")
+    state = {"resolved_cols": None, "rows_read": 0}
+    cusip_report = _new_cusip_report()
+    rule_report = new_rule_report()
+    coercion_stats = {}
+    cusip_index = CusipIndex(cusip_index_path) if cusip_index_path else None
+    recording = HoldingsRecording(input_xlsx, client, period, enabled=record_history)
+
+    # Reading, preparing and writing interleave chunk by chunk, so each stage's time is accumulated separately
+    stage_seconds = {"read": 0.0, "build": 0.0}
+
+    def prepared_chunks():
+        for chunk in timed_iteration(iter_holdings_chunks(input_xlsx, chunk_size), stage_seconds, "read"):
+            build_started = time.perf_counter()
+            if state["resolved_cols"] is None:
+                print(f"Excel columns found in '{input_xlsx}' (using header=0): {chunk.columns.tolist()}")
+                state["resolved_cols"] = resolve_column_map(chunk.columns.tolist(), input_xlsx)
+            merge_rule_report(rule_report, check_holdings(chunk, state["resolved_cols"], HOLDINGS_RULES))
+            chunk, chunk_stats = prepare_holdings(chunk, state["resolved_cols"])
+            merge_coercion_stats(coercion_stats, chunk_stats)
+            chunk = _check_cusips(chunk, state["resolved_cols"], cusip_index, correct_from_13f_list, cusip_report)
+            state["rows_read"] += len(chunk)
+            count_progress(rows_read=len(chunk))
+            recording.add(chunk, state["resolved_cols"])
+            stage_seconds["build"] += time.perf_counter() - build_started
+            yield chunk
+
+    try:
+        stream_started = time.perf_counter()
+        # Rows are read and emitted chunk by chunk, so both counts grow during this one stage
+        report_progress('converting')
+        chunks = prepared_chunks()
+        first_chunk = next(chunks, None)
+        if first_chunk is None:
+            # None only without a header row; a header without data gives one empty chunk (an empty table, as in memory)
+            raise ValueError(f"No header row found in '{input_xlsx}'.")
+        # The source map keeps two integers per holding, so it stays small even for very large files
+        source_map = information_table_source_map(input_xlsx, state["resolved_cols"]) if validate else None
+        rows_written = write_information_table(itertools.chain([first_chunk], chunks), output_xml, state["resolved_cols"],
+                                               source_map, compact)
+        stream_seconds = time.perf_counter() - stream_started
+        observe_stage('13F', 'read', stage_seconds["read"])
+        observe_stage('13F', 'build', stage_seconds["build"])
+        observe_stage('13F', 'serialize', max(0.0, stream_seconds - stage_seconds["read"] - stage_seconds["build"]))
+    finally:
+        if cusip_index:
+            cusip_index.close()
+    _print_cusip_summary(cusip_report, input_xlsx, cusip_index_path)
+    _print_rule_summary(rule_report, input_xlsx)
+    _print_coercion_summary(coercion_stats, input_xlsx)
+
+    print(f"Perfect EDGAR-compliant XML file created: {output_xml} ({rows_written} holdings)")
+    recording.finish()
+    xml_valid, validation_errors, validation_stats = validate_holdings_stage(output_xml, source_map) if validate else (None, [], None)
+    return {"rows_read": state["rows_read"], "rows_written": rows_written, "aggregated": False,
+            "invalid_cusips": cusip_report["invalid_cusips"], "invalid_cusip_count": cusip_report["invalid_cusip_count"],
+            "cusips_not_on_list": cusip_report["not_on_list"], "xml_valid": xml_valid, "validation_errors": validation_errors,
+            "validation_stats": validation_stats, **_rule_summary_fields(rule_report), "coercion_stats": coercion_stats}
+
+# --- Multi-manager split ---
+def manager_label(value):
+    """Text of a manager key value; whole-number CIKs that were read as floats lose their ".0"."""
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value).strip()
+
+def split_output_filenames(labels, input_filename):
+    """Output file name per manager label, from generate_output_filename("<label> <input file name>").
+       Labels that clean to the same name get a numeric suffix."""
+    names, used = {}, set()
+    for label in labels:
+        name = generate_output_filename(f"{label} {input_filename}")
+        base, suffix = os.path.splitext(name)[0], 2
+        while name in used:
+            name, suffix = f"{base}{suffix}.xml", suffix + 1
+        used.add(name)
+        names[label] = name
+    return names
+
+def _convert_manager_partition(job):
+    """Build, serialize and validate one manager's rows of a master workbook (runs in a worker process)."""
+    prepared = build_holdings_stage(job["df"], job["input_xlsx"], job["aggregate"], job["cusip_index_path"],
+                                    job["correct_from_13f_list"], resolved_cols=job["resolved_cols"])
+    rows_written, source_map = serialize_holdings_stage(prepared, job["output_xml"], job["validate"], job["manager"], job["period"],
+                                                        job["compact"])
+    validation = validate_holdings_stage(job["output_xml"], source_map) if job["validate"] else (None, [], None)
+    return {**holdings_summary(prepared, rows_written, validation), "output_xml": job["output_xml"]}
+
+@tracked_conversion('13F', lambda result: sum(summary.get("rows_written", 0) for summary in result["managers"].values()))
+def split_perfect_edgar_xml(input_xlsx, output_dir, key_column=None, aggregate=False, cusip_index_path=None,
+                            correct_from_13f_list=False, validate=False, period=None, max_workers=SPLIT_MAX_WORKERS,
+                            compact=None):
+    """Generates one information table per filing manager from a master workbook holding several managers.
+       The workbook is read and its columns resolved once; the rows are then partitioned on the manager column
+       (key_column, or the first MANAGER_KEY_COLUMN name found) and each manager's table is built, written to
+       output_dir (named with generate_output_filename) and validated in parallel, up to max_workers processes.
+       Rows keep their index, so validation errors still point at rows of the master sheet; rows with a blank
+       manager are skipped. Each table is recorded in the filings history with the manager as the client.
+       Returns {"input_xlsx", "key_column", "rows_read", "rows_without_manager", "managers": {label: summary}};
+       a manager whose conversion failed has {"output_xml", "error"} instead of a summary."""
+    df = read_holdings_stage(input_xlsx)
+    df_columns = df.columns.tolist()
+    resolved_cols = resolve_column_map(df_columns, input_xlsx)
+    if key_column:
+        key = find_actual_column_name(df_columns, key_column, [])
+    else:
+        key = find_actual_column_name(df_columns, MANAGER_KEY_COLUMN["primary"], MANAGER_KEY_COLUMN["synonyms"])
+    if key is None:
+        expected = key_column or ", ".join([MANAGER_KEY_COLUMN["primary"]] + MANAGER_KEY_COLUMN["synonyms"])
+        raise ValueError(f"No manager column ({expected}) found in '{input_xlsx}'; columns: {df_columns}.")
+
+    has_manager = df[key].notna() & (df[key].astype(str).str.strip() != "")
+    rows_without_manager = int((~has_manager).sum())
+    if rows_without_manager:
+        print(f"    --> Warning: {rows_without_manager} row(s) of '{input_xlsx}' have no '{key}' and are not in any output.")
+    keyed = df[has_manager]
+    partitions = dict(tuple(keyed.groupby(keyed[key].map(manager_label), sort=False)))
+    output_names = split_output_filenames(list(partitions), os.path.basename(input_xlsx))
+    print(f"--- Splitting '{input_xlsx}' on '{key}': {len(partitions)} manager(s) ---")
+
+    os.makedirs(output_dir, exist_ok=True)
+    jobs = [{"input_xlsx": input_xlsx, "manager": manager, "df": partition, "resolved_cols": resolved_cols,
+             "output_xml": os.path.join(output_dir, output_names[manager]), "aggregate": aggregate,
+             "cusip_index_path": cusip_index_path, "correct_from_13f_list": correct_from_13f_list,
+             "validate": validate, "period": period, "compact": compact} for manager, partition in partitions.items()]
+    managers = {}
+    worker_count = max(1, min(max_workers, len(jobs)))
+    if worker_count == 1:
+        for job in jobs:
+            try:
+                managers[job["manager"]] = _convert_manager_partition(job)
+            except Exception as e:
+                managers[job["manager"]] = {"output_xml": job["output_xml"], "error": str(e)}
+    else:
+        with ProcessPoolExecutor(max_workers=worker_count) as executor:
+            futures = {executor.submit(_convert_manager_partition, job): job for job in jobs}
+            for future in as_completed(futures):
+                job = futures[future]
+                try:
+                    managers[job["manager"]] = future.result()
+                except Exception as e:
+                    managers[job["manager"]] = {"output_xml": job["output_xml"], "error": str(e)}
+    for manager in partitions:
+        summary = managers[manager]
+        if "error" in summary:
+            print(f"    --> Error: manager '{manager}' failed: {summary['error']}")
+        else:
+            print(f"    Manager '{manager}': {summary['rows_written']} holdings -> {summary['output_xml']}")
+    return {"input_xlsx": input_xlsx, "key_column": key, "rows_read": len(df), "rows_without_manager": rows_without_manager,
+            "managers": {manager: managers[manager] for manager in partitions}}
+
+def check_holdings_file(input_path, stream=False, chunk_size=DEFAULT_STREAM_CHUNK_SIZE):
+    """Runs only the data-quality rules on a holdings file, without writing XML. Returns the rule report."""
+    chunks = iter_holdings_chunks(input_path, chunk_size) if stream else [read_holdings_table(input_path)]
+    rule_report, resolved_cols = new_rule_report(), None
+    for chunk in chunks:
+        if resolved_cols is None:
+            resolved_cols = resolve_column_map(chunk.columns.tolist(), input_path)
+        merge_rule_report(rule_report, check_holdings(chunk, resolved_cols, HOLDINGS_RULES))
+    _print_rule_summary(rule_report, input_path)
+    return rule_report
 
 def generate_output_filename(input_filename):
     """Generate output filename in SEC-compliant format"""
@@ -218,14 +677,16 @@ def generate_output_filename(input_filename):
 
     return output_filename
 
-def process_all_xlsx_in_directory():
-    xlsx_files = glob.glob("Input/*.xlsx")
+def process_all_xlsx_in_directory(aggregate=False, stream=False, chunk_size=DEFAULT_STREAM_CHUNK_SIZE, cusip_index_path=None,
+                                  validate=False, compact=None):
+    xlsx_files = sorted(f for ext in SUPPORTED_HOLDINGS_EXTENSIONS for f in glob.glob(f"Input/*{ext}"))
 
     for xlsx_file in xlsx_files:
         print(f"\nProcessing file: {xlsx_file}")
 
-        df = pd.read_excel(xlsx_file)
-        print("Columns found in Excel file:", df.columns.tolist())
+        if not stream: # Streaming never loads the whole sheet, not even to list its columns
+            df = read_holdings_table(xlsx_file)
+            print("Columns found in Excel file:", df.columns.tolist())
 
         base_name = os.path.basename(xlsx_file)
         output_filename = generate_output_filename(base_name)
@@ -233,7 +694,87 @@ def process_all_xlsx_in_directory():
         print(f"Generated output filename: {output_filename}")
         print(f"Final output path: {output_xml}")
 
-        create_perfect_edgar_xml(xlsx_file, output_xml)
+        if stream:
+            stream_perfect_edgar_xml(xlsx_file, output_xml, chunk_size=chunk_size, cusip_index_path=cusip_index_path,
+                                     validate=validate, compact=compact)
+        else:
+            create_perfect_edgar_xml(xlsx_file, output_xml, aggregate=aggregate, cusip_index_path=cusip_index_path,
+                                     validate=validate, compact=compact)
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert 13F holdings (.xlsx, .csv or .parquet) to EDGAR information table XML.")
+    parser.add_argument("input_path", nargs="?", help="Holdings file to convert. If omitted, every .xlsx/.csv/.parquet in Input/ is converted into Output/.")
+    parser.add_argument("output_xml", nargs="?", help="Output XML path (default: Output/<generated name>.xml).")
+    parser.add_argument("--aggregate", action="store_true", help="Combine rows for the same holding before writing.")
+    parser.add_argument("--stream", action="store_true", help="Constant-memory chunked conversion for very large workbooks.")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_STREAM_CHUNK_SIZE, help="Rows per chunk with --stream.")
+    parser.add_argument("--cusip-index", help="Path to a 13F List index built with cusip_reference.py.")
+    parser.add_argument("--validate", action="store_true", help="Validate the XML against the EDGAR 13F schema, mapping errors to sheet rows/columns.")
+    parser.add_argument("--json", action="store_true", help="Print the conversion summary (with validation errors and their source cells) as JSON.")
+    parser.add_argument("--check", action="store_true", help="Only run the data-quality rules and list every violation; no XML is written.")
+    parser.add_argument("--client", help="Client the filing is recorded under in the filings history (default: from the file name).")
+    parser.add_argument("--period", help="Reporting period for the filings history, e.g. 2024Q1 (default: from the file name).")
+    parser.add_argument("--profile", action="store_true", help="Profile the conversion; writes <output>.prof and <output>.collapsed.txt next to the XML.")
+    parser.add_argument("--split-by", nargs="?", const="", metavar="COLUMN",
+                        help="Master workbook with several managers: write one information table per value of COLUMN "
+                             f"(default: the first of {', '.join([MANAGER_KEY_COLUMN['primary']] + MANAGER_KEY_COLUMN['synonyms'])}) "
+                             "into the directory given as output_xml (default Output/).")
+    parser.add_argument("--workers", type=int, default=SPLIT_MAX_WORKERS, help="Managers converted at the same time with --split-by.")
+    parser.add_argument("--compact", action="store_true", default=None, help="Write one unindented infoTable per line instead of the tab-indented layout.")
+    args = parser.parse_args()
+
+    if args.aggregate and args.stream:
+        parser.error("--aggregate needs the whole table in memory and cannot be combined with --stream.")
+
+    if not args.input_path:
+        # These only apply to one file; without it the whole Input/ directory would be converted instead
+        single_file_options = {"--check": args.check, "--split-by": args.split_by is not None, "--json": args.json,
+                               "--client": args.client, "--period": args.period, "--profile": args.profile}
+        given = [option for option, value in single_file_options.items() if value]
+        if given:
+            parser.error(f"{', '.join(given)}: only valid with an input_path.")
+        process_all_xlsx_in_directory(aggregate=args.aggregate, stream=args.stream,
+                                      chunk_size=args.chunk_size, cusip_index_path=args.cusip_index, validate=args.validate,
+                                      compact=args.compact)
+        return
+
+    if args.check:
+        with contextlib.redirect_stdout(sys.stderr) if args.json else contextlib.nullcontext():
+            rule_report = check_holdings_file(args.input_path, stream=args.stream, chunk_size=args.chunk_size)
+        if args.json:
+            print(json.dumps(rule_report, indent=2, default=str))
+        sys.exit(1 if rule_report["error_count"] else 0)
+
+    if args.split_by is not None:
+        if args.stream:
+            parser.error("--split-by partitions the whole table in memory and cannot be combined with --stream.")
+        with contextlib.redirect_stdout(sys.stderr) if args.json else contextlib.nullcontext():
+            result = split_perfect_edgar_xml(args.input_path, args.output_xml or "Output", key_column=args.split_by or None,
+                                             aggregate=args.aggregate, cusip_index_path=args.cusip_index, validate=args.validate,
+                                             period=args.period, max_workers=args.workers, compact=args.compact)
+        if args.json:
+            for summary in result["managers"].values():
+                if "validation_errors" in summary:
+                    summary["validation_errors"] = issues_as_dicts(summary["validation_errors"])
+            print(json.dumps(result, indent=2, default=str))
+        sys.exit(1 if any("error" in summary for summary in result["managers"].values()) else 0)
+
+    output_xml = args.output_xml or os.path.join("Output", generate_output_filename(os.path.basename(args.input_path)))
+    # With --json the progress output goes to stderr so stdout is only the JSON summary
+    with contextlib.redirect_stdout(sys.stderr) if args.json else contextlib.nullcontext():
+        if args.stream:
+            summary = stream_perfect_edgar_xml(args.input_path, output_xml, chunk_size=args.chunk_size,
+                                               cusip_index_path=args.cusip_index, validate=args.validate,
+                                               client=args.client, period=args.period, compact=args.compact,
+                                               profile=args.profile or None)
+        else:
+            summary = create_perfect_edgar_xml(args.input_path, output_xml, aggregate=args.aggregate,
+                                               cusip_index_path=args.cusip_index, validate=args.validate,
+                                               client=args.client, period=args.period, compact=args.compact,
+                                               profile=args.profile or None)
+    if args.json:
+        summary = {**summary, "output_xml": output_xml, "validation_errors": issues_as_dicts(summary["validation_errors"])}
+        print(json.dumps(summary, indent=2, default=str))
 
 if __name__ == "__main__":
-    process_all_xlsx_in_directory()
+    main()
@@ -0,0 +1,186 @@
+import os
+import argparse
+import dataclasses
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from lxml import etree
+from holdings_input import DEFAULT_STREAM_CHUNK_SIZE
+from holdings_coercion import coerce_holdings
+from report_formatting import to_numbers
+from xlsx_to_corrected_edgar_xml import COLUMN_MAPPINGS, XML_ELEMENT_FIELDS, COERCION_PLAN
+from finra_6151_converter import VenueData, VENUE_XML_FIELDS, CATEGORY_XSD_ELEMENTS
+
+# Reverse converter: reads a generated (or filed) EDGAR 13F information table or FINRA 6151 held-order-routing
+# report back into rows, for audits and re-ingestion. Files are read with iterparse and every record is cleared
+# once it has been turned into a row, so memory depends on chunk_size, not on the file size.
+#   13F:  one row per <ns1:infoTable>, columns named like the holdings workbook (COLUMN_MAPPINGS primary names),
+#         so the table can be fed straight back into xlsx_to_corrected_edgar_xml.py
+#   6151: one row per <rVenue>, columns named like the VenueData attributes, plus the month and category
+# Values are kept as the text in the XML unless typed=True, so writing a table back gives the same XML.
+
+SUPPORTED_TABLE_EXTENSIONS = ('.csv', '.parquet')
+
+# 13F columns in workbook order; XML element name -> column
+INFORMATION_TABLE_COLUMNS = [COLUMN_MAPPINGS[field_key]["primary"] for field_key in COLUMN_MAPPINGS
+                             if field_key in XML_ELEMENT_FIELDS.values()]
+_INFO_TABLE_TAG_COLUMNS = {tag: COLUMN_MAPPINGS[field_key]["primary"] for tag, field_key in XML_ELEMENT_FIELDS.items()}
+# The typed=True coercion resolves every field to its own primary column name
+_PRIMARY_COLUMNS = {field_key: COLUMN_MAPPINGS[field_key]["primary"] for field_key in XML_ELEMENT_FIELDS.values()}
+
+_VENUE_DATA_FIELDS = [f.name for f in dataclasses.fields(VenueData) if f.name != "source_row"]
+VENUE_COLUMNS = ["year", "mon", "category"] + _VENUE_DATA_FIELDS + ["order_pct"]
+_VENUE_TAG_COLUMNS = {**VENUE_XML_FIELDS, "orderPct": "order_pct"}
+# Numeric venue columns (percentages, USD and CPH amounts), parsed to float64 when typed=True
+_VENUE_NUMERIC_COLUMNS = [column for tag, column in VENUE_XML_FIELDS.items() if tag.endswith(("Pct", "Usd", "Cph"))] + ["order_pct"]
+_CATEGORY_NAMES = {element: name for name, element in CATEGORY_XSD_ELEMENTS.items()}
+
+def report_kind(xml_path):
+    """'13F' or '6151', from the root element (only the first start tag is parsed)."""
+    for _, element in etree.iterparse(xml_path, events=("start",)):
+        root_name = etree.QName(element).localname
+        break
+    else:
+        raise ValueError(f"'{xml_path}' has no root element.")
+    if root_name == "informationTable":
+        return '13F'
+    if root_name == "heldOrderRoutingPublicReport":
+        return '6151'
+    raise ValueError(f"'{xml_path}' is neither an EDGAR information table nor a 6151 report (root <{root_name}>).")
+
+def _release(element):
+    """Frees an element that has been read, and the already-read siblings before it."""
+    element.clear()
+    while element.getprevious() is not None:
+        del element.getparent()[0]
+
+def _chunks(records, columns, chunk_size):
+    """Groups row dicts into DataFrames of at most chunk_size rows, indexed by record number. Columns are
+    object dtype (element text, None when missing) whatever the values in the chunk."""
+    rows, offset = [], 0
+    for record in records:
+        rows.append(record)
+        if len(rows) >= chunk_size:
+            yield pd.DataFrame(rows, columns=columns, dtype=object, index=pd.RangeIndex(offset, offset + len(rows)))
+            offset += len(rows)
+            rows = []
+    if rows or offset == 0:
+        yield pd.DataFrame(rows, columns=columns, dtype=object, index=pd.RangeIndex(offset, offset + len(rows)))
+
+# --- 13F information tables ---
+def _info_table_records(xml_path):
+    for _, info_table in etree.iterparse(xml_path, events=("end",), tag="{*}infoTable"):
+        record = {}
+        for element in info_table.iter():
+            column = _INFO_TABLE_TAG_COLUMNS.get(etree.QName(element).localname)
+            if column is not None:
+                record[column] = element.text
+        yield record
+        _release(info_table)
+
+def iter_information_table(xml_path, chunk_size=DEFAULT_STREAM_CHUNK_SIZE, typed=False):
+    """Yields the infoTable entries of an EDGAR information table as DataFrames of at most chunk_size rows.
+    Missing optional elements are NaN. With typed=True the columns get the dtypes the converter coerces them to
+    (Int64 counts, float64 value, stripped text); otherwise every value is the element text."""
+    for frame in _chunks(_info_table_records(xml_path), INFORMATION_TABLE_COLUMNS, chunk_size):
+        if typed:
+            frame, _ = coerce_holdings(frame, _PRIMARY_COLUMNS, COERCION_PLAN)
+        yield frame
+
+def read_information_table(xml_path, typed=False):
+    """The whole information table as one DataFrame."""
+    return pd.concat(list(iter_information_table(xml_path, typed=typed)))
+
+# --- 6151 held-order-routing reports ---
+def _venue_records(xml_path):
+    month = {"year": None, "mon": None}
+    for _, element in etree.iterparse(xml_path, events=("end",), tag=("rVenue", "year", "mon")):
+        if element.tag != "rVenue":
+            if element.getparent() is not None and element.getparent().tag == "rMonthly":
+                month[element.tag] = element.text
+            continue
+        category_element = element.getparent().getparent()  # <rSP500><rVenues><rVenue>
+        record = {**month, "category": _CATEGORY_NAMES.get(category_element.tag, category_element.tag)}
+        for child in element:
+            column = _VENUE_TAG_COLUMNS.get(child.tag)
+            if column is not None:
+                record[column] = child.text
+        yield record
+        _release(element)
+
+def iter_venue_records(xml_path, chunk_size=DEFAULT_STREAM_CHUNK_SIZE, typed=False):
+    """Yields the rVenue entries of a 6151 report as DataFrames of at most chunk_size rows. With typed=True the
+    percentage and payment columns are float64 (NM becomes NaN)."""
+    for frame in _chunks(_venue_records(xml_path), VENUE_COLUMNS, chunk_size):
+        if typed:
+            frame[_VENUE_NUMERIC_COLUMNS] = to_numbers(frame[_VENUE_NUMERIC_COLUMNS].to_numpy(dtype=object))
+        yield frame
+
+def read_venue_records(xml_path, typed=False):
+    return pd.concat(list(iter_venue_records(xml_path, typed=typed)))
+
+def venue_data_from_records(frame):
+    """Venue rows -> {(year, mon, category): [VenueData, ...]} in file order, ready for the 6151 writer."""
+    categories = {}
+    for row in frame.to_dict("records"):
+        venue = VenueData(**{name: (None if pd.isna(row[name]) else row[name]) for name in _VENUE_DATA_FIELDS})
+        categories.setdefault((row["year"], row["mon"], row["category"]), []).append(venue)
+    return categories
+
+# --- Output ---
+def iter_report_table(xml_path, chunk_size=DEFAULT_STREAM_CHUNK_SIZE, typed=False):
+    """iter_information_table or iter_venue_records, whichever fits the file."""
+    if report_kind(xml_path) == '13F':
+        return iter_information_table(xml_path, chunk_size, typed)
+    return iter_venue_records(xml_path, chunk_size, typed)
+
+def _arrow_type(series):
+    if pd.api.types.is_integer_dtype(series.dtype):
+        return pa.int64()
+    if pd.api.types.is_float_dtype(series.dtype):
+        return pa.float64()
+    return pa.string()
+
+def write_table(frames, output_path):
+    """Writes DataFrame chunks to a .csv or .parquet file one chunk at a time. Returns the number of rows."""
+    extension = os.path.splitext(output_path)[1].lower()
+    if extension not in SUPPORTED_TABLE_EXTENSIONS:
+        raise ValueError(f"Unsupported table file type '{extension}'. Expected one of: {', '.join(SUPPORTED_TABLE_EXTENSIONS)}.")
+    rows, writer = 0, None
+    try:
+        for position, frame in enumerate(frames):
+            if extension == '.csv':
+                frame.to_csv(output_path, mode='w' if position == 0 else 'a', header=position == 0, index=False)
+            else:
+                if writer is None:
+                    # The schema comes from the column dtypes, not the values, so a column that is empty in the
+                    # first chunk still gets the type later chunks need
+                    schema = pa.schema([(col, _arrow_type(frame[col])) for col in frame.columns])
+                    writer = pq.ParquetWriter(output_path, schema)
+                writer.write_table(pa.Table.from_pandas(frame, schema=writer.schema, preserve_index=False))
+            rows += len(frame)
+    finally:
+        if writer is not None:
+            writer.close()
+    return rows
+
+def convert_xml_to_table(xml_path, output_path, chunk_size=DEFAULT_STREAM_CHUNK_SIZE, typed=False):
+    """Reads a 13F or 6151 XML file and writes its records to output_path (.csv or .parquet)."""
+    kind = report_kind(xml_path)
+    rows = write_table(iter_report_table(xml_path, chunk_size, typed), output_path)
+    print(f"Wrote {rows} {'infoTable' if kind == '13F' else 'rVenue'} record(s) from '{xml_path}' to '{output_path}'.")
+    return rows
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert an EDGAR 13F information table or FINRA 6151 report XML back to CSV or Parquet.")
+    parser.add_argument("xml_path", help="13F information table or 6151 held-order-routing XML file.")
+    parser.add_argument("output_path", nargs="?", help="Output .csv or .parquet file (default: <xml name>.csv).")
+    parser.add_argument("--typed", action="store_true", help="Numeric columns as numbers instead of the XML text.")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_STREAM_CHUNK_SIZE, help="Records held in memory at a time.")
+    args = parser.parse_args()
+
+    output_path = args.output_path or os.path.splitext(args.xml_path)[0] + '.csv'
+    convert_xml_to_table(args.xml_path, output_path, args.chunk_size, args.typed)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,361 @@
+import os
+import re
+import time
+import zipfile
+import argparse
+import functools
+import urllib.parse
+from array import array
+from lxml import etree
+from conversion_progress import report_progress
+
+# Validation stops after this many schema errors (later errors are usually repeats of the same mistake)
+MAX_VALIDATION_ERRORS = int(os.environ.get('MAX_VALIDATION_ERRORS', '100'))
+# Outputs at least this large are validated while streaming instead of being parsed into a tree first
+STREAMING_VALIDATION_MIN_BYTES = int(os.environ.get('STREAMING_VALIDATION_MIN_BYTES', str(16 * 1024 * 1024)))
+
+# --- Schema loading ---
+class _SchemaDirectoryResolver(etree.Resolver):
+    """Resolves xs:import/xs:include locations against the schema's own directory.
+    libxml2 URL-escapes paths, so imports next to a schema in e.g. 'Conversion specs/' are not found otherwise."""
+
+    def __init__(self, schema_dir):
+        super().__init__()
+        self.schema_dir = schema_dir
+
+    def resolve(self, system_url, public_id, context):
+        if '://' in system_url and not system_url.startswith('file://'):
+            return None
+        path = urllib.parse.unquote(urllib.parse.urlparse(system_url).path if '://' in system_url else system_url)
+        if not os.path.isabs(path):
+            path = os.path.join(self.schema_dir, path)
+        if os.path.exists(path):
+            return self.resolve_filename(path, context)
+        return None
+
+@functools.lru_cache(maxsize=8)
+def load_schema(xsd_filepath):
+    """Parses and compiles an XSD once per process; later validations reuse the compiled schema."""
+    parser = etree.XMLParser()
+    parser.resolvers.add(_SchemaDirectoryResolver(os.path.dirname(os.path.abspath(xsd_filepath))))
+    with open(xsd_filepath, 'rb') as xsd_file:
+        return etree.XMLSchema(etree.parse(xsd_file, parser))
+
+# --- Validation errors that know where they came from ---
+class ValidationIssue(str):
+    """An XSD validation error message. It is a plain string ("Line X, Col Y: message (source location)") for the
+    UI and logs, and also carries the XML position and, when known, the source sheet/row/column."""
+
+    def __new__(cls, message, line=None, column=None, source=None):
+        text = f"Line {line}, Col {column}: {message}"
+        if source:
+            text += f" ({describe_source(source)})"
+        issue = super().__new__(cls, text)
+        issue.message, issue.line, issue.column, issue.source = message, line, column, source
+        return issue
+
+    def __getnewargs__(self):  # Keeps the extra fields when results are pickled across worker processes
+        return (self.message, self.line, self.column, self.source)
+
+    def as_dict(self):
+        return {"message": self.message, "line": self.line, "column": self.column, **(self.source or {})}
+
+def issues_as_dicts(errors):
+    """Validation errors as JSON-ready dicts (for CLI --json output and batch reports)."""
+    return [error.as_dict() if isinstance(error, ValidationIssue) else {"message": str(error)} for error in errors]
+
+def describe_source(source):
+    text = f"sheet '{source['sheet']}' row {source['row']}"
+    if source.get("source_column"):
+        text += f", column {source['source_column']}"
+    return text
+
+def validate_xml_against_xsd(xml_filepath, xsd_filepath, source_map=None):
+    """Validates an XML file against an XSD schema.
+
+    Args:
+        xml_filepath (str): The path to the XML file to validate.
+        xsd_filepath (str): The path to the XSD schema file.
+        source_map (SourceMap, optional): Recorded by the converter while writing; used to point each
+            error at the sheet, row and column it came from.
+
+    Returns:
+        tuple: (bool, list) where bool is True if valid, False otherwise,
+               and list contains error messages (ValidationIssue strings) if invalid, or is empty if valid.
+    """
+    if not os.path.exists(xml_filepath):
+        return False, [f"XML file not found at {xml_filepath}"]
+    if not os.path.exists(xsd_filepath):
+        return False, [f"XSD schema file not found at {xsd_filepath}"]
+
+    try:
+        xml_doc = etree.parse(xml_filepath)
+        xmlschema = load_schema(xsd_filepath)
+
+        if xmlschema.validate(xml_doc):
+            return True, []
+        error_messages = []
+        for error in xmlschema.error_log:
+            source = source_map.locate(error.line, _element_name(error.message)) if source_map else None
+            error_messages.append(ValidationIssue(error.message, error.line, error.column, source))
+        return False, error_messages
+    except etree.XMLSyntaxError as e:
+        return False, [f"XML Syntax Error: {e}"]
+    except Exception as e:
+        return False, [f"Unexpected validation error: {e}"]
+
+# --- Streaming validation for large outputs ---
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+# Memory is sampled every this many lines while streaming
+_RSS_SAMPLE_LINES = 4096
+
+def _rss_bytes():
+    """Resident set size of this process, or None where /proc is not available."""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * _PAGE_SIZE
+    except (OSError, ValueError, IndexError):
+        return None
+
+class _ValidatingLineReader:
+    """File wrapper handing the parser one line per read. libxml2 reports streamed schema errors without a line
+    number, but every error logged while a line is being parsed belongs to that line, so errors are collected
+    here, between reads, with the line they occurred on."""
+
+    def __init__(self, xml_file, source_map, max_errors):
+        self.xml_file = xml_file
+        self.source_map = source_map
+        self.max_errors = max_errors
+        self.error_log = None  # Set to a callable returning the parser's error log once the parser exists
+        self.line = 0
+        self.logged = 0
+        self.errors = []
+        self.syntax_error = False
+        self.stopped_early = False
+        self.peak_rss = _rss_bytes()
+
+    def collect_errors(self):
+        log = self.error_log()
+        if len(log) == self.logged:
+            return
+        for error in list(log)[self.logged:]:
+            if len(self.errors) >= self.max_errors:
+                self.stopped_early = True
+                break
+            if error.domain_name != 'SCHEMASV':
+                self.syntax_error = True
+                self.errors.append(f"XML Syntax Error: {error.message} (line {error.line or self.line})")
+                continue
+            line = error.line or self.line
+            source = self.source_map.locate(line, _element_name(error.message)) if self.source_map else None
+            self.errors.append(ValidationIssue(error.message, line, error.column, source))
+        self.logged = len(log)
+
+    def read(self, size=-1):
+        if self.error_log is not None:
+            self.collect_errors()
+        if self.stopped_early or self.syntax_error:
+            return b''  # Ends the parse; the parser's complaint about the truncated document is not reported
+        self.line += 1
+        if self.line % _RSS_SAMPLE_LINES == 0:
+            self.peak_rss = max(self.peak_rss or 0, _rss_bytes() or 0) or None
+        return self.xml_file.readline()
+
+def validate_xml_streaming(xml_filepath, xsd_filepath, source_map=None, max_errors=MAX_VALIDATION_ERRORS):
+    """Validates an XML file against an XSD while parsing it incrementally: elements are discarded as soon as
+    they have been checked, so memory stays flat however large the file is. Stops after max_errors errors.
+
+    Returns:
+        tuple: (bool, list, dict) - validity and errors as in validate_xml_against_xsd, plus validation
+               statistics (see _validation_stats).
+    """
+    started = time.perf_counter()
+    start_rss = _rss_bytes()
+    if not os.path.exists(xml_filepath):
+        return False, [f"XML file not found at {xml_filepath}"], _validation_stats("streaming", started, start_rss)
+    if not os.path.exists(xsd_filepath):
+        return False, [f"XSD schema file not found at {xsd_filepath}"], _validation_stats("streaming", started, start_rss)
+
+    with open(xml_filepath, 'rb') as xml_file:
+        reader = _ValidatingLineReader(xml_file, source_map, max_errors)
+        try:
+            events = etree.iterparse(reader, events=('end',), schema=load_schema(xsd_filepath))
+            reader.error_log = lambda: events.error_log
+            for _, element in events:
+                element.clear()
+                parent = element.getparent()
+                if parent is not None and len(parent) > 1:
+                    del parent[0]  # The previous sibling, already validated and cleared
+            reader.collect_errors()
+        except etree.XMLSyntaxError as e:
+            # Raised at the end of any document with errors; the errors themselves were collected line by line
+            if not reader.stopped_early and not reader.syntax_error:
+                reader.collect_errors()
+                if not reader.errors:
+                    reader.errors.append(f"XML Syntax Error: {e}")
+        except Exception as e:
+            reader.errors.append(f"Unexpected validation error: {e}")
+    stats = _validation_stats("streaming", started, start_rss, max(reader.peak_rss or 0, _rss_bytes() or 0) or None)
+    stats.update(lines=reader.line, error_count=len(reader.errors), stopped_early=reader.stopped_early)
+    return not reader.errors, reader.errors, stats
+
+def _validation_stats(mode, started, start_rss, peak_rss=None):
+    """mode ("streaming" or "in_memory"), seconds, peak_rss_mb (highest resident memory sampled while validating)
+    and rss_growth_mb (how far it rose above where it started). Memory figures are None without /proc."""
+    to_mb = lambda size: round(size / (1024 * 1024), 1)
+    return {"mode": mode, "seconds": round(time.perf_counter() - started, 3),
+            "peak_rss_mb": to_mb(peak_rss) if peak_rss else None,
+            "rss_growth_mb": to_mb(max(0, peak_rss - start_rss)) if peak_rss and start_rss else None,
+            "lines": None, "error_count": 0, "stopped_early": False}
+
+def validate_xml_file(xml_filepath, xsd_filepath, source_map=None, max_errors=MAX_VALIDATION_ERRORS, streaming=None):
+    """Validates a generated file, streaming it when it is at least STREAMING_VALIDATION_MIN_BYTES (or when
+    streaming is True) and parsing it whole otherwise, which is faster for small files.
+    At most max_errors errors are returned. Returns (is_valid, errors, stats)."""
+    if streaming is None:
+        streaming = os.path.exists(xml_filepath) and os.path.getsize(xml_filepath) >= STREAMING_VALIDATION_MIN_BYTES
+    report_progress('validating')
+    if streaming:
+        is_valid, errors, stats = validate_xml_streaming(xml_filepath, xsd_filepath, source_map, max_errors)
+    else:
+        started = time.perf_counter()
+        start_rss = _rss_bytes()
+        is_valid, errors = validate_xml_against_xsd(xml_filepath, xsd_filepath, source_map)
+        stats = _validation_stats("in_memory", started, start_rss, _rss_bytes())
+        stats.update(error_count=min(len(errors), max_errors), stopped_early=len(errors) > max_errors)
+        errors = errors[:max_errors]
+    report_progress('validated', valid=bool(is_valid), validation_errors=stats["error_count"])
+    return is_valid, errors, stats
+
+def format_validation_stats(stats):
+    text = f"{stats['mode']} validation took {stats['seconds']:.2f}s"
+    if stats["peak_rss_mb"] is not None:
+        text += f", peak memory {stats['peak_rss_mb']} MB (+{stats['rss_growth_mb']} MB)"
+    if stats["stopped_early"]:
+        text += f"; stopped after {stats['error_count']} errors"
+    return text
+
+_ELEMENT_IN_MESSAGE = re.compile(r"Element '(?:\{[^}]*\})?([^']+)'")
+
+def _element_name(message):
+    """Local name of the element a libxml2 schema error is about ("Element '{ns}Shared': ..." -> "Shared")."""
+    match = _ELEMENT_IN_MESSAGE.match(message or "")
+    return match.group(1) if match else None
+
+# --- Source map: XML line -> sheet / row / column ---
+# Lines are grouped into buckets of this size; each bucket remembers the block covering its first line,
+# so finding a block is a bucket lookup plus at most a few steps forward (O(1) per error).
+_BUCKET_LINES = 64
+
+class SourceMap:
+    """Maps line numbers of a generated XML file back to the sheet, row and column each element came from.
+
+    Single elements are recorded with add_line() (6151 reports: a few hundred elements). Repeated per-row
+    blocks are recorded with add_blocks() (13F infoTable entries: one block of lines per holding), which only
+    stores the first line and row of each block. Inside a block the column is taken from the element named
+    in the error, via tag_columns (e.g. {"Shared": "Shared"}).
+    """
+
+    def __init__(self, sheet, tag_columns=None):
+        self.sheet = sheet
+        self.tag_columns = tag_columns or {}
+        self._lines = {}
+        self._block_starts = array('q')
+        self._block_rows = array('q')
+        self._bucket_blocks = array('q')
+        self._next_line = None
+
+    def add_line(self, line, row, source_column=None):
+        self._lines[line] = (row, source_column)
+
+    def add_blocks(self, first_line, line_counts, rows):
+        """Records consecutive blocks starting at first_line, one per (line_count, row). Returns the line after them."""
+        line = first_line
+        for line_count, row in zip(line_counts, rows):
+            block = len(self._block_starts)
+            self._block_starts.append(line)
+            self._block_rows.append(int(row))
+            line += line_count
+            # Buckets are counted from the first block's line; each one points at the block covering its first line
+            while self._block_starts[0] + len(self._bucket_blocks) * _BUCKET_LINES < line:
+                self._bucket_blocks.append(block)
+        self._next_line = line
+        return line
+
+    def _block_for_line(self, line):
+        if not self._block_starts or not self._block_starts[0] <= line < self._next_line:
+            return None
+        block = self._bucket_blocks[(line - self._block_starts[0]) // _BUCKET_LINES]
+        while block + 1 < len(self._block_starts) and self._block_starts[block + 1] <= line:
+            block += 1
+        return block
+
+    def locate(self, line, element_name=None):
+        """Returns {"sheet", "row", "source_column"} for an XML line, or None if the line has no recorded source."""
+        if line in self._lines:
+            row, source_column = self._lines[line]
+        else:
+            block = self._block_for_line(line)
+            if block is None:
+                return None
+            row, source_column = self._block_rows[block], self.tag_columns.get(element_name)
+        return {"sheet": self.sheet, "row": row, "source_column": source_column}
+
+def pretty_printed_lines(root, first_line=2):
+    """Yields (element, line) for every element of an lxml tree, giving the line its start tag lands on when the
+    tree is written with pretty_print=True after an XML declaration. Only valid for trees without mixed content."""
+    line = first_line
+    stack = [(root, False)]
+    while stack:
+        element, closing = stack.pop()
+        if closing:
+            line += 1  # The container's closing tag has a line of its own
+            continue
+        yield element, line
+        children = list(element)
+        if children:
+            line += 1
+            stack.append((element, True))
+            stack.extend((child, False) for child in reversed(children))
+        else:
+            line += 1 + (element.text or "").count("\n")
+
+def excel_column_letter(column_index):
+    """0 -> 'A', 25 -> 'Z', 26 -> 'AA'."""
+    letters = ""
+    column_index += 1
+    while column_index:
+        column_index, remainder = divmod(column_index - 1, 26)
+        letters = chr(ord('A') + remainder) + letters
+    return letters
+
+def first_sheet_name(input_path):
+    """Name of the sheet pandas reads by default (the first in the workbook), or the file name for CSV/Parquet.
+    Read straight from xl/workbook.xml so the workbook itself is not loaded again."""
+    if input_path.lower().endswith('.xlsx'):
+        try:
+            with zipfile.ZipFile(input_path) as workbook:
+                match = re.search(rb'<(?:\w+:)?sheet\b[^>]*\bname="([^"]*)"', workbook.read('xl/workbook.xml'))
+            if match:
+                return match.group(1).decode('utf-8').replace('&amp;', '&').replace('&quot;', '"').replace('&lt;', '<').replace('&gt;', '>')
+        except (KeyError, zipfile.BadZipFile, OSError):
+            pass
+    return os.path.basename(input_path)
+
+def main():
+    parser = argparse.ArgumentParser(description="Validate an XML file against an XSD schema.")
+    parser.add_argument("xml_path", help="XML file to validate.")
+    parser.add_argument("xsd_path", help="XSD schema (imports are resolved next to it).")
+    parser.add_argument("--stream", action="store_true", default=None, help="Validate while parsing incrementally (default for files of STREAMING_VALIDATION_MIN_BYTES or more).")
+    parser.add_argument("--in-memory", dest="stream", action="store_false", help="Parse the whole file before validating.")
+    parser.add_argument("--max-errors", type=int, default=MAX_VALIDATION_ERRORS, help="Stop after this many errors.")
+    args = parser.parse_args()
+
+    is_valid, errors, stats = validate_xml_file(args.xml_path, args.xsd_path, max_errors=args.max_errors, streaming=args.stream)
+    for error in errors:
+        print(f"- {error}")
+    print(f"{'Valid' if is_valid else 'Invalid'}: {format_validation_stats(stats)}")
+    raise SystemExit(0 if is_valid else 1)
+
+if __name__ == "__main__":
+    main()